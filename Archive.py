@@ -0,0 +1,243 @@
+"""
+Long term storage of expired sensor readings.
+
+Instead of deleting weather and water_temp rows once they are older than
+history_days, the telemetry writer can move them into compact columnar
+files, one set per table and month:
+
+    <directory>/weather/2016-05.ts           uint32 milliseconds since the
+                                             start of the month
+    <directory>/weather/2016-05.humidity     float32
+    <directory>/weather/2016-05.temperature  float32
+
+That is 12 bytes a weather reading against the 50 or so SQLite needs with
+its index, and a month of readings can be memory mapped and binary
+searched by timestamp without reading the rest of it. Files are only ever
+appended to. Values are written before timestamps and a reader only trusts
+as many rows as every column has, so a crash mid-append loses at most the
+batch being written, which is still in the database.
+
+query() reads a range across the archive and the live database as one
+stream of rows, oldest first.
+"""
+
+import itertools
+import datetime
+import logging
+import numpy
+import os
+
+from Rollups import METRICS
+
+# Rows converted from the memory mapped columns at a time
+CHUNK = 4096
+
+def directory(config):
+    """The archive directory, by default named after the database"""
+    return config.get('archive', {}).get('directory') or os.path.splitext(config['sqlite_db'])[0] + '-archive'
+
+def monthStart(month):
+    return datetime.datetime.strptime(month, '%Y-%m')
+
+def nextMonth(start):
+    return datetime.datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+
+def milliseconds(delta):
+    return (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds // 1000
+
+class Archive:
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, table, month, column):
+        return os.path.join(self.directory, table, '%s.%s' % (month, column))
+
+    def months(self, table):
+        """The months archived for a table, oldest first"""
+        try:
+            names = os.listdir(os.path.join(self.directory, table))
+        except OSError:
+            return []
+
+        return sorted(name[:-3] for name in names if name.endswith('.ts'))
+
+    def rows(self, table, month):
+        """Rows every column of a month has, anything beyond is a torn append"""
+        sizes = []
+
+        for column in ('ts',) + METRICS[table]:
+            path = self.path(table, month, column)
+            sizes.append(os.path.getsize(path) // 4 if os.path.exists(path) else 0)
+
+        return min(sizes)
+
+    def columns(self, table, month):
+        """Memory map a month, returns (timestamps, [values per metric]) or None if it is empty"""
+        count = self.rows(table, month)
+
+        if not count:
+            return None
+
+        ts = numpy.memmap(self.path(table, month, 'ts'), dtype = numpy.uint32, mode = 'r', shape = (count,))
+        values = [numpy.memmap(self.path(table, month, m), dtype = numpy.float32, mode = 'r', shape = (count,)) for m in METRICS[table]]
+
+        return (ts, values)
+
+    def appendMonth(self, table, month, rows):
+        base = monthStart(month)
+        count = self.rows(table, month)
+
+        if not os.path.isdir(os.path.join(self.directory, table)):
+            os.makedirs(os.path.join(self.directory, table))
+
+        # Cut off whatever a crash left beyond the last complete row
+        for column in ('ts',) + METRICS[table]:
+            with open(self.path(table, month, column), 'ab') as f:
+                f.truncate(count * 4)
+
+        offsets = numpy.array([milliseconds(row[0] - base) for row in rows], dtype = numpy.uint32)
+        keep = numpy.ones(len(rows), dtype = bool)
+
+        if count:
+            # Rows archived before a crash stopped them being deleted
+            last = numpy.memmap(self.path(table, month, 'ts'), dtype = numpy.uint32, mode = 'r', shape = (count,))[-1]
+            keep = offsets > last
+
+        if not keep.any():
+            return 0
+
+        for (i, metric) in enumerate(METRICS[table]):
+            values = numpy.array([row[i + 1] for row in rows], dtype = numpy.float32)
+
+            with open(self.path(table, month, metric), 'ab') as f:
+                f.write(values[keep].tostring())
+
+        with open(self.path(table, month, 'ts'), 'ab') as f:
+            f.write(offsets[keep].tostring())
+
+        return int(keep.sum())
+
+    def append(self, table, rows):
+        """Archive rows (recorded_at first, in time order), returns how many were written"""
+        written = 0
+
+        for (month, group) in itertools.groupby(rows, lambda row: row[0].strftime('%Y-%m')):
+            written += self.appendMonth(table, month, list(group))
+
+        return written
+
+    def read(self, table, start = None, end = None):
+        """Yield the archived (recorded_at, values...) from start up to but excluding end, oldest first"""
+        for month in self.months(table):
+            base = monthStart(month)
+            following = nextMonth(base)
+
+            if end is not None and base >= end:
+                break
+
+            if start is not None and following <= start:
+                continue
+
+            columns = self.columns(table, month)
+
+            if columns is None:
+                continue
+
+            (ts, values) = columns
+
+            lo = 0 if start is None or start <= base else int(numpy.searchsorted(ts, milliseconds(start - base)))
+            hi = len(ts) if end is None or end >= following else int(numpy.searchsorted(ts, milliseconds(end - base)))
+
+            for i in range(lo, hi, CHUNK):
+                j = min(i + CHUNK, hi)
+                chunk = zip(ts[i:j].tolist(), *[v[i:j].tolist() for v in values])
+
+                for row in chunk:
+                    yield (base + datetime.timedelta(milliseconds = row[0]),) + row[1:]
+
+    def expire(self, sqlite, lock, table, cutoff):
+        """
+        Move the rows recorded up to cutoff from the database into the
+        archive, a day at a time so neither memory nor the lock is held for
+        long. Returns how many rows were moved.
+        """
+        with lock:
+            oldest = sqlite.execute("SELECT recorded_at FROM %s WHERE recorded_at IS NOT NULL ORDER BY recorded_at LIMIT 1" % table).fetchone()
+
+        if oldest is None or oldest[0] > cutoff:
+            return 0
+
+        start = oldest[0]
+        moved = 0
+
+        while True:
+            end = start + datetime.timedelta(days = 1)
+            last = end > cutoff
+            where = "recorded_at >= ? AND recorded_at %s ?" % ('<=' if last else '<')
+            bounds = (start, cutoff if last else end)
+
+            with lock:
+                rows = sqlite.execute("SELECT * FROM %s WHERE %s ORDER BY recorded_at" % (table, where), bounds).fetchall()
+
+            self.append(table, rows)
+
+            with lock:
+                c = sqlite.cursor()
+                c.execute("BEGIN")
+
+                try:
+                    c.execute("DELETE FROM %s WHERE %s" % (table, where), bounds)
+                except Exception:
+                    c.execute("ROLLBACK")
+                    raise
+
+                c.execute("COMMIT")
+
+            moved += len(rows)
+
+            if last:
+                break
+
+            start = end
+
+        logging.debug("Archived %d %s readings up to %s", moved, table, cutoff)
+
+        return moved
+
+def query(sqlite, table, start = None, end = None, archive = None):
+    """
+    Yield (recorded_at, values...) from start up to but excluding end, from
+    the archive and then the database, oldest first. Nothing is read ahead,
+    so any range can be exported without holding it in memory. Rows in both
+    (archived but not yet deleted) are only read from the database.
+    """
+    oldest = sqlite.execute("SELECT recorded_at FROM %s WHERE recorded_at IS NOT NULL ORDER BY recorded_at LIMIT 1" % table).fetchone()
+
+    if archive is not None:
+        for row in archive.read(table, start, end):
+            if oldest is not None and row[0] >= oldest[0]:
+                break
+
+            yield row
+
+    conditions = ["recorded_at IS NOT NULL"]
+    params = []
+
+    if start is not None:
+        conditions.append("recorded_at >= ?")
+        params.append(start)
+
+    if end is not None:
+        conditions.append("recorded_at < ?")
+        params.append(end)
+
+    for row in sqlite.execute("SELECT * FROM %s WHERE %s ORDER BY recorded_at" % (table, ' AND '.join(conditions)), params):
+        yield row
+
+def create(config):
+    """The Archive expired readings are moved to, or None if they are simply deleted"""
+    if not config.get('archive', {}).get('enabled', False):
+        return None
+
+    return Archive(directory(config))
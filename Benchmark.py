@@ -0,0 +1,1441 @@
+#!/usr/bin/env python
+
+"""
+Off-device benchmarks for the birdhouse daemon.
+
+Each benchmark prints a small report and, with --json, writes its results
+together with the commit and library versions they were measured with, so
+runs can be compared across commits. `suite` runs the motion (at several
+resolutions), schedule, storage and DHT22 benchmarks in one go. Frame
+sources are the synthetic or video file sources from FrameSource and the
+hardware comes from Simulator, so none of this needs a Pi.
+
+    python Benchmark.py suite --json results.json
+    python Benchmark.py motion --video clip.h264 --width 1280 --height 720
+"""
+
+from MotionDetector import MotionDetector
+from Pipeline import Pipeline, Feed, FrameRing, StageStats
+from MotionProcesses import MotionProcesses
+from Scheduler import OutletScheduler
+from Telemetry import TelemetryWriter
+from Outlets import OutletCache, OutletController
+from Metrics import LatencyWindow
+from BirdHouse import annotate
+
+import FrameSource
+import imutils
+import cv2
+import Migrations
+import Rollups
+import argparse
+import threading
+import logging
+import datetime
+import sqlite3
+import collections
+import subprocess
+import multiprocessing
+import platform
+import tempfile
+import shutil
+import socket
+import random
+import signal
+import resource
+import ctypes.util
+import ctypes
+import json
+import cronex
+import time
+import sys
+import os
+
+def benchConfig(args):
+    return {
+        'camera' : {
+            'source' : 'video' if args.video else 'synthetic',
+            'video_file' : args.video,
+            'resolution' : [args.width, args.height],
+            'format' : args.format,
+            'fps' : args.fps,
+            'realtime' : args.fps > 0,
+            'frames' : args.frames,
+            'threshold' : 5,
+            'min_area' : 500,
+            'rotate' : 180
+        }
+    }
+
+def benchPipeline(args):
+    """Push frames through the capture ring and motion analysis"""
+    config = benchConfig(args)
+    detector = MotionDetector(config)
+    hits = [0]
+
+    def analyze(frame, timestamp):
+        rects = detector.detect(frame)
+
+        if rects:
+            hits[0] += 1
+
+        if args.delay:
+            time.sleep(args.delay)
+
+    pipeline = Pipeline([Feed('bench', FrameSource.create(config), analyze, ring_size = args.ring_size)], [])
+
+    started = time.time()
+    pipeline.run()
+    elapsed = time.time() - started
+
+    stats = pipeline.stats()['feeds']['bench']
+
+    print("Captured %d frames in %.2fs (%.1f fps)" % (stats['capture']['processed'], elapsed, stats['capture']['processed'] / elapsed))
+    print("Analysed %d frames (%.1f fps), %d with motion" % (stats['analysis']['processed'], stats['analysis']['processed'] / elapsed, hits[0]))
+    print("Dropped %d frames, max ring depth %d" % (stats['capture']['dropped'], stats['capture']['max_depth']))
+    print("Analysis busy %.1f ms/frame" % (1000.0 * stats['analysis']['busy'] / max(stats['analysis']['processed'], 1)))
+
+    return {
+        'seconds' : elapsed,
+        'capture_fps' : stats['capture']['processed'] / elapsed,
+        'analysis_fps' : stats['analysis']['processed'] / elapsed,
+        'dropped' : stats['capture']['dropped'],
+        'motion_frames' : hits[0],
+        'analysis_ms' : 1000.0 * stats['analysis']['busy'] / max(stats['analysis']['processed'], 1)
+    }
+
+class BenchPi:
+    """Just enough of pigpio.pi to drive outlets"""
+
+    def __init__(self):
+        self.levels = {}
+
+    def read(self, gpio):
+        return self.levels.get(gpio, 0)
+
+    def write(self, gpio, level):
+        self.levels[gpio] = level
+
+    def set_bank_1(self, bits):
+        self.levels.update((gpio, 1) for gpio in range(32) if bits & (1 << gpio))
+
+    def clear_bank_1(self, bits):
+        self.levels.update((gpio, 0) for gpio in range(32) if bits & (1 << gpio))
+
+def outletDatabase(outlets, path = ':memory:'):
+    sqlite = sqlite3.connect(path, detect_types = sqlite3.PARSE_DECLTYPES, isolation_level = None, check_same_thread = False)
+    sqlite.execute('''CREATE TABLE IF NOT EXISTS outlets (outlet_id INT, name TEXT, schedule TEXT, override_until timestamp, last_ran timestamp, initial_state INT, schedule_active INT, state INT)''')
+
+    for i in range(outlets):
+        sqlite.execute("INSERT INTO outlets VALUES(?, ?, ?, NULL, NULL, 0, 1, NULL)", (i, "Outlet %d" % i, "*/%d * * * *" % (i % 15 + 1)))
+
+    return sqlite
+
+def legacySchedule(sqlite, pi):
+    """processSchedule as it ran on every frame before the OutletScheduler"""
+    c = sqlite.cursor()
+    results = c.execute('SELECT * FROM outlets').fetchall()
+
+    for outlet in results:
+        if not outlet[6]:
+            continue
+
+        job = cronex.CronExpression(outlet[2].encode('ascii', 'ignore'))
+
+        if job.check_trigger(time.localtime(time.time())[:5]):
+            c2 = sqlite.cursor()
+            c2.execute("SELECT * FROM outlets WHERE outlet_id = :outlet_id LIMIT 1", {'outlet_id' : outlet[0]})
+
+            currentOutlet = c2.fetchone()
+
+            if currentOutlet[3] is not None and currentOutlet[3] > datetime.datetime.now():
+                continue
+
+            if currentOutlet[4] is None:
+                secondsSinceExecution = 61
+            else:
+                secondsSinceExecution = (datetime.datetime.now() - currentOutlet[4]).total_seconds()
+
+            if secondsSinceExecution > 60:
+                c2.execute("UPDATE outlets SET last_ran = ? WHERE outlet_id = ?", (datetime.datetime.now(), outlet[0]))
+                pi.write(outlet[0], 0 if pi.read(outlet[0]) else 1)
+
+def benchSchedule(args):
+    """CPU per hour of schedule handling, per-frame polling against the OutletScheduler"""
+    results = {}
+
+    for outlets in args.outlets:
+        sqlite = outletDatabase(outlets)
+        frames = args.fps_target * 60
+
+        started = time.clock()
+
+        for i in range(frames):
+            legacySchedule(sqlite, BenchPi())
+
+        legacy = (time.clock() - started) * 60
+
+        # Simulate an hour on a fake clock, the scheduler only runs when it would wake
+        sqlite = outletDatabase(outlets)
+        now = [time.time()]
+        scheduler = OutletScheduler(OutletCache(sqlite, threading.RLock()), OutletController(BenchPi()), clock = lambda: now[0])
+        end = now[0] + 3600
+        wakeups = 0
+
+        started = time.clock()
+        scheduler.outlets.reload()
+        scheduler.reload()
+
+        while now[0] < end:
+            now[0] = max(scheduler.runPending(), now[0])
+            wakeups += 1
+
+        heap = time.clock() - started
+
+        print("%3d outlets: per-frame %.2fs CPU/hour (%d calls), scheduler %.3fs CPU/hour (%d wakeups, %d fired)" % (outlets, legacy, frames * 60, heap, wakeups, scheduler.fired))
+
+        results[str(outlets)] = {
+            'per_frame_cpu_per_hour' : legacy,
+            'scheduler_cpu_per_hour' : heap,
+            'wakeups' : wakeups,
+            'fired' : scheduler.fired
+        }
+
+    return results
+
+def benchOutlets(args):
+    """pigpio calls spent on the outlets over an hour of visits and schedules: one outlet at a time against the shadowed controller"""
+    from MotionEvents import MotionEventTracker
+    import MotionEvents
+    import Simulator
+
+    results = {}
+
+    for outlets in args.outlets:
+        sqlite = outletDatabase(outlets)
+        MotionEvents.createTable(sqlite.cursor())
+
+        lock = threading.RLock()
+        cache = OutletCache(sqlite, lock)
+        cache.reload()
+
+        now = [time.time()]
+        pi = Simulator.pi({ 'dht22' : { 'gpio' : None } })
+        controller = OutletController(pi)
+        tracker = MotionEventTracker(sqlite, lock, cache, controller, { 'motion_timeout' : 1 })
+        scheduler = OutletScheduler(cache, controller, clock = lambda: now[0])
+
+        controller.restore(dict((outlet.outlet_id, outlet.initial_state) for outlet in cache.all()))
+        scheduler.reload()
+
+        visits = random.Random(0)
+        end = now[0] + 3600
+        frame = 1.0 / args.fps_target
+        due = scheduler.runPending()
+        reconcile = now[0] + controller.reconcile_interval
+        visiting = 0
+        drift = now[0] + 1800
+
+        # Birds visit for 10s at a time, about once every 20s
+        while now[0] < end:
+            if visiting <= 0 and visits.random() < frame / 20:
+                visiting = 10.0
+
+            if visiting > 0:
+                visiting -= frame
+                tracker.update([(10, 10, 50, 50)] * visits.randint(1, 3), datetime.datetime.fromtimestamp(now[0]))
+            else:
+                tracker.update([], datetime.datetime.fromtimestamp(now[0]))
+
+            if now[0] >= due:
+                due = scheduler.runPending()
+
+            if now[0] >= reconcile:
+                if drift is not None and now[0] >= drift:
+                    # Someone switched an outlet by hand half way through
+                    pi.levels[0] = 1 - pi.levels.get(0, 0)
+                    drift = None
+
+                controller.reconcile()
+                reconcile += controller.reconcile_interval
+
+            now[0] += frame
+
+        stats = controller.stats()
+        contour = tracker.detections * outlets + scheduler.fired * 2
+        requested = sum(stats['requested'].values())
+        calls = sum(stats['calls'].values())
+
+        print("%3d outlets: per contour %7d calls (%.1fs), per outlet %5d (%.2fs), controller %4d (%.2fs) %s, %d fired, %d drifted" % (outlets,
+              contour, contour * args.gpio_latency, requested, requested * args.gpio_latency, calls, calls * args.gpio_latency,
+              stats['calls'], scheduler.fired, stats['drifted']))
+
+        results[str(outlets)] = {
+            'per_contour_calls' : contour,
+            'per_outlet_calls' : requested,
+            'controller_calls' : calls,
+            'calls' : stats['calls'],
+            'fired' : scheduler.fired,
+            'drifted' : stats['drifted']
+        }
+
+    return results
+
+def telemetryDatabase(path, days, indexed):
+    """A database holding `days` of readings at the daemon's 5 second cadence"""
+    sqlite = sqlite3.connect(path, detect_types = sqlite3.PARSE_DECLTYPES, isolation_level = None, check_same_thread = False)
+    sqlite.execute('PRAGMA journal_mode=WAL')
+    sqlite.execute('''CREATE TABLE IF NOT EXISTS weather (recorded_at timestamp, humidity REAL, temperature REAL)''')
+    sqlite.execute('''CREATE TABLE IF NOT EXISTS water_temp(recorded_at timestamp, temperature REAL)''')
+
+    if indexed:
+        sqlite.execute('''CREATE INDEX IF NOT EXISTS weather_recorded_at ON weather (recorded_at)''')
+        sqlite.execute('''CREATE INDEX IF NOT EXISTS water_temp_recorded_at ON water_temp (recorded_at)''')
+
+    start = datetime.datetime.now() - datetime.timedelta(days = days)
+    stamps = [start + datetime.timedelta(seconds = 5 * i) for i in range(days * 17280)]
+
+    sqlite.execute("BEGIN")
+    sqlite.executemany("INSERT INTO weather VALUES(?, 50.0, 70.0)", ((t,) for t in stamps))
+    sqlite.executemany("INSERT INTO water_temp VALUES(?, 60.0)", ((t,) for t in stamps))
+    sqlite.execute("COMMIT")
+    sqlite.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    # Let the WAL grow for the run so its size shows what was written
+    sqlite.execute("PRAGMA wal_autocheckpoint=0")
+
+    return sqlite
+
+def walBytes(path):
+    try:
+        return os.path.getsize(path + '-wal')
+    except OSError:
+        return 0
+
+def benchStorage(args):
+    """Insert and prune throughput and WAL volume, per-reading writes against the TelemetryWriter"""
+    config = {
+        'dht22' : { 'history_days' : args.days },
+        'ds18b20' : { 'history_days' : args.days },
+        'telemetry' : { 'batch_size' : args.batch_size }
+    }
+
+    directory = tempfile.mkdtemp()
+    results = {}
+
+    try:
+        path = os.path.join(directory, 'legacy.db')
+        sqlite = telemetryDatabase(path, args.days, False)
+        cutoff = datetime.timedelta(days = args.days)
+
+        started = time.time()
+
+        for i in range(args.readings):
+            c = sqlite.cursor()
+            c.execute("DELETE FROM weather WHERE recorded_at <= :history_cutoff", { 'history_cutoff' : datetime.datetime.now() - cutoff })
+            c.execute("INSERT INTO weather VALUES(?, ?, ?)", (datetime.datetime.now(), 50.0, 70.0))
+            c.execute("DELETE FROM water_temp WHERE recorded_at <= :history_cutoff", { 'history_cutoff' : datetime.datetime.now() - cutoff })
+            c.execute("INSERT INTO water_temp VALUES(?, ?)", (datetime.datetime.now(), 60.0))
+
+        elapsed = time.time() - started
+
+        print("per-reading: %d readings in %.2fs (%.0f/s), %d WAL bytes" % (args.readings, elapsed, args.readings / elapsed, walBytes(path)))
+
+        results['per_reading'] = { 'readings_per_second' : args.readings / elapsed, 'wal_bytes' : walBytes(path) }
+
+        path = os.path.join(directory, 'batched.db')
+        sqlite = telemetryDatabase(path, args.days, True)
+
+        # Flushes maintain the rollups, which start out empty here
+        Rollups.createTables(sqlite.cursor())
+        writer = TelemetryWriter(sqlite, threading.RLock(), config)
+
+        started = time.time()
+
+        for i in range(args.readings):
+            writer.record('weather', (datetime.datetime.now(), 50.0, 70.0))
+            writer.record('water_temp', (datetime.datetime.now(), 60.0))
+
+            if writer.buffered >= writer.batch_size:
+                writer.flush()
+
+        writer.flush()
+        writer.prune()
+
+        elapsed = time.time() - started
+
+        print("batched:     %d readings in %.2fs (%.0f/s), %d WAL bytes, %d flushes" % (args.readings, elapsed, args.readings / elapsed, walBytes(path), writer.flushes))
+
+        results['batched'] = { 'readings_per_second' : args.readings / elapsed, 'wal_bytes' : walBytes(path), 'flushes' : writer.flushes }
+    finally:
+        shutil.rmtree(directory)
+
+    return results
+
+def benchRollup(args):
+    """Weekly and monthly reads from the raw tables against the hourly rollups"""
+    directory = tempfile.mkdtemp()
+    results = {}
+
+    try:
+        path = os.path.join(directory, 'rollup.db')
+        sqlite = telemetryDatabase(path, args.days, True)
+
+        started = time.time()
+        Migrations.migrate(sqlite)
+        print("Backfilled rollups for %d days in %.2fs" % (args.days, time.time() - started))
+
+        now = datetime.datetime.now()
+
+        for (name, days) in (('daily', 1), ('weekly', 7), ('monthly', 30)):
+            since = now - datetime.timedelta(days = days)
+
+            started = time.time()
+            raw = sqlite.execute("SELECT * FROM weather WHERE recorded_at BETWEEN ? AND ? ORDER BY recorded_at DESC", (since, now)).fetchall()
+            rawTime = time.time() - started
+
+            resolution = 'minute' if days == 1 else 'hour'
+
+            started = time.time()
+            rollup = sqlite.execute('''SELECT bucket_start, humidity_sum / count, humidity_min, humidity_max, temperature_sum / count, temperature_min, temperature_max
+                                       FROM weather_rollup WHERE resolution = ? AND bucket_start BETWEEN ? AND ? ORDER BY bucket_start DESC''',
+                                    (resolution, since.strftime(Rollups.RESOLUTIONS[0][1]), now)).fetchall()
+            rollupTime = time.time() - started
+
+            print("%-8s raw %7d rows in %7.1fms, %s rollup %5d rows in %5.1fms" % (name, len(raw), rawTime * 1000, resolution, len(rollup), rollupTime * 1000))
+
+            results[name] = { 'raw_rows' : len(raw), 'raw_ms' : rawTime * 1000, 'rollup_rows' : len(rollup), 'rollup_ms' : rollupTime * 1000 }
+    finally:
+        shutil.rmtree(directory)
+
+    return results
+
+def legacyDump(sqlite, table, since, now):
+    """What the dashboard's API controllers return: every raw row of the range, as JSON objects"""
+    columns = ('recorded_at',) + Rollups.METRICS[table]
+    rows = sqlite.execute("SELECT * FROM %s WHERE recorded_at BETWEEN ? AND ? ORDER BY recorded_at DESC" % table, (since, now)).fetchall()
+
+    return json.dumps([dict(zip(columns, (row[0].strftime('%Y-%m-%d %H:%M:%S'),) + tuple(row[1:]))) for row in rows])
+
+def forked(work):
+    """Run work() in a forked child, so it starts from this process' heap but leaves it alone, and return its (JSON) result"""
+    (r, w) = os.pipe()
+    pid = os.fork()
+
+    if pid == 0:
+        os.close(r)
+
+        try:
+            os.write(w, json.dumps(work()))
+        except Exception:
+            logging.exception("Forked benchmark failed")
+
+        os._exit(0)
+
+    os.close(w)
+    result = []
+
+    while True:
+        data = os.read(r, 65536)
+
+        if not data:
+            break
+
+        result.append(data)
+
+    os.close(r)
+    os.waitpid(pid, 0)
+
+    return json.loads(''.join(result))
+
+def peakMemory(work):
+    """How much work() grows the peak RSS by (kB), run in a forked child so runs don't share a heap"""
+    (r, w) = os.pipe()
+    pid = os.fork()
+
+    if pid == 0:
+        os.close(r)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        work()
+        os.write(w, str(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before))
+        os._exit(0)
+
+    os.close(w)
+    grown = os.read(r, 64)
+    os.close(r)
+    os.waitpid(pid, 0)
+
+    return int(grown)
+
+class NullOutput:
+    def write(self, data):
+        pass
+
+def benchQuery(args):
+    """Latency, size and memory of the query service's downsampled responses against the dashboard's full dumps"""
+    import urllib2
+    import Query
+
+    directory = tempfile.mkdtemp()
+    results = {}
+
+    try:
+        path = os.path.join(directory, 'query.db')
+        sqlite = telemetryDatabase(path, args.days, True)
+        Migrations.migrate(sqlite)
+
+        server = Query.QueryServer([('bench', { 'sqlite_db' : path })], { 'query' : { 'port' : 0 } })
+        server.start()
+
+        base = 'http://%s:%d' % server.server.server_address
+
+        def fetch(url, etag = None):
+            request = urllib2.Request(base + url, headers = { 'If-None-Match' : etag } if etag else {})
+            started = time.time()
+
+            try:
+                response = urllib2.urlopen(request)
+                body = response.read()
+                etag = response.info().get('ETag')
+            except urllib2.HTTPError as e:
+                if e.code != 304:
+                    raise
+
+                body = ''
+
+            return (time.time() - started, len(body), etag)
+
+        # Closed ranges, as a dashboard asking for whole days would send
+        end = datetime.datetime.now().replace(second = 0, microsecond = 0) - datetime.timedelta(minutes = 5)
+
+        for (name, days) in (('daily', 1), ('weekly', 7), ('monthly', 30)):
+            since = end - datetime.timedelta(days = days)
+
+            started = time.time()
+            size = len(legacyDump(sqlite, 'weather', since, end))
+            elapsed = time.time() - started
+            memory = peakMemory(lambda: legacyDump(sqlite, 'weather', since, end))
+
+            print("%-8s full dump      %7.1fms, %8d bytes, %6d kB" % (name, elapsed * 1000, size, memory))
+
+            results[name] = { 'dump' : { 'ms' : elapsed * 1000, 'bytes' : size, 'memory_kb' : memory } }
+
+            for method in ('avg', 'lttb'):
+                url = '/weather?method=%s&points=%d&start=%s&end=%s' % (method, args.points, since.strftime('%Y-%m-%dT%H:%M'), end.strftime('%Y-%m-%dT%H:%M'))
+                params = { 'method' : method, 'points' : str(args.points), 'start' : since.strftime('%Y-%m-%dT%H:%M'), 'end' : end.strftime('%Y-%m-%dT%H:%M') }
+
+                (miss, size, etag) = fetch(url)
+                (hit, _, _) = fetch(url)
+                (notModified, _, _) = fetch(url, etag)
+
+                def render():
+                    series = Query.Series('weather', params)
+                    Query.writeJSON(NullOutput(), 'bench', series, series.rows(sqlite))
+
+                memory = peakMemory(render)
+
+                print("%-8s %-4s %4d pts  %7.1fms, %8d bytes, %6d kB, cached %.1fms, 304 %.1fms" % (name, method, args.points, miss * 1000, size, memory, hit * 1000, notModified * 1000))
+
+                results[name][method] = { 'ms' : miss * 1000, 'cached_ms' : hit * 1000, 'not_modified_ms' : notModified * 1000, 'bytes' : size, 'memory_kb' : memory }
+
+        server.stop()
+    finally:
+        shutil.rmtree(directory)
+
+    return results
+
+class LegacyMotionDetector:
+    """The motion detection BirdHouse.run did inline before MotionDetector"""
+
+    def __init__(self, config):
+        self.config = config
+        self.avg = None
+
+    def detect(self, frame):
+        frame = imutils.resize(frame, width = 500)
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        gray = cv2.GaussianBlur(gray, (21, 21), 0)
+
+        if self.avg is None:
+            self.avg = gray.copy().astype("float")
+            return None
+
+        cv2.accumulateWeighted(gray, self.avg, 0.5)
+
+        frameDelta = cv2.absdiff(gray, cv2.convertScaleAbs(self.avg))
+
+        threshold = cv2.threshold(frameDelta, self.config['camera']['threshold'], 255, cv2.THRESH_BINARY)[1]
+        threshold = cv2.dilate(threshold, None, iterations = 2)
+        cnts = cv2.findContours(threshold.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+
+        return [cv2.boundingRect(c) for c in cnts if cv2.contourArea(c) >= self.config['camera']['min_area']]
+
+def replay(detector, config):
+    """Run a detector over every frame of the source, returns (per-frame motion flags, CPU seconds, wall seconds)"""
+    source = FrameSource.create(config)
+    flags = []
+    cpu = 0.0
+    wall = 0.0
+
+    for frame in source.frames():
+        startedCpu = time.clock()
+        startedWall = time.time()
+        rects = detector.detect(frame)
+        cpu += time.clock() - startedCpu
+        wall += time.time() - startedWall
+
+        flags.append(bool(rects))
+
+    source.close()
+
+    return (flags, cpu, wall)
+
+def benchMotion(args):
+    """Frame rate, CPU per frame and recall of the motion engine against the original algorithm"""
+    config = benchConfig(args)
+    config['camera']['realtime'] = False
+    config['camera']['format'] = FrameSource.BGR
+
+    (reference, legacyCpu, legacyWall) = replay(LegacyMotionDetector(config), config)
+    frames = len(reference)
+
+    print("legacy:  %5.1f fps, %5.2f ms CPU/frame, %d frames with motion" % (frames / legacyWall, 1000 * legacyCpu / frames, sum(reference)))
+
+    config['camera'].update({
+        'format' : args.format,
+        'analysis_width' : args.analysis_width,
+        'analyze_every' : args.every,
+        'rois' : [[float(v) for v in roi.split(',')] for roi in args.roi] or None,
+        'background' : { 'model' : args.background },
+        'adaptive' : { 'max_every' : args.max_every }
+    })
+
+    detector = MotionDetector(config)
+    (flags, cpu, wall) = replay(detector, config)
+
+    # A reference detection counts as recalled if motion was reported on any
+    # analysed frame within the (widest) skip window around it
+    window = detector.max_every
+    recalled = sum(1 for (i, hit) in enumerate(reference) if hit and any(flags[max(i - window + 1, 0):i + window]))
+
+    print("engine:  %5.1f fps, %5.2f ms CPU/frame, %d frames with motion, %d early exits, %d skipped" % (frames / wall, 1000 * cpu / frames, sum(flags), detector.early_exits, detector.skipped))
+    print("recall:  %.1f%% (%d of %d)" % (100.0 * recalled / max(sum(reference), 1), recalled, sum(reference)))
+    print("lighting changes: %d, %d frames suppressed" % (detector.lighting_changes, detector.suppressed))
+
+    return {
+        'frames' : frames,
+        'legacy_fps' : frames / legacyWall,
+        'legacy_cpu_ms' : 1000 * legacyCpu / frames,
+        'fps' : frames / wall,
+        'cpu_ms' : 1000 * cpu / frames,
+        'recall' : float(recalled) / max(sum(reference), 1)
+    }
+
+def loadClip(config, frames):
+    """Up to `frames` frames of the source held in memory, so decoding them isn't measured"""
+    source = FrameSource.create(config)
+    clip = []
+
+    for frame in source.frames():
+        clip.append(frame.copy())
+
+        if len(clip) >= frames:
+            break
+
+    source.close()
+
+    return clip
+
+def analyseClip(clip, config, processes = None):
+    """
+    Analyse the clip through a feed's ring as fast as it will go, on this
+    thread or the processes. Returns (seconds, frames with motion).
+    """
+    size = config['pipeline']['ring_size']
+    ring = FrameRing(size, StageStats('capture')) if processes is None else FrameRing(size, StageStats('capture'), processes.allocate)
+    detector = MotionDetector(config) if processes is None else None
+    hits = [0]
+
+    def handle(answered):
+        for (frame, timestamp, rects) in answered:
+            hits[0] += bool(rects)
+            ring.release(frame)
+
+    if processes is not None:
+        # Forking the workers is the daemon starting, not analysis
+        processes.start()
+
+    started = time.time()
+
+    for frame in clip:
+        ring.put(frame, datetime.datetime.now())
+        (_, timestamp, frame) = ring.get()
+
+        if processes is None:
+            hits[0] += bool(detector.detect(frame))
+        else:
+            ring.keep()
+            handle(processes.submit(frame, timestamp))
+
+    if processes is not None:
+        handle(processes.drain())
+
+    elapsed = time.time() - started
+
+    if processes is not None:
+        processes.stop()
+
+    return (elapsed, hits[0])
+
+def benchProcesses(args):
+    """Most frames per second motion analysis keeps up with on the analysis thread and on 1-N worker processes"""
+    config = benchConfig(args)
+    config['camera'].update({
+        'realtime' : False,
+        'analysis_width' : args.analysis_width,
+        'rois' : [[float(v) for v in roi.split(',')] for roi in args.roi] or None,
+        'background' : { 'model' : args.background }
+    })
+    config['pipeline'] = { 'ring_size' : args.ring_size, 'split' : args.split }
+
+    clip = loadClip(config, args.frames)
+
+    print("%d frames of %s, %d core(s)" % (len(clip), 'x'.join(str(v) for v in clip[0].shape), multiprocessing.cpu_count()))
+
+    (elapsed, hits) = analyseClip(clip, config)
+    baseline = len(clip) / elapsed
+
+    print("thread:         %6.1f fps, %d frames with motion" % (baseline, hits))
+
+    results = { 'thread' : { 'fps' : baseline, 'motion_frames' : hits } }
+
+    for count in args.processes:
+        config['pipeline']['processes'] = count
+        processes = MotionProcesses(config, MotionDetector(config))
+
+        (elapsed, hits) = analyseClip(clip, config, processes)
+        fps = len(clip) / elapsed
+        stats = processes.stats()
+
+        print("%d process(es): %6.1f fps (x%.2f), %d frames with motion, waited %.2fs on the workers" % (count, fps, fps / baseline, hits, stats['waited']))
+
+        results[count] = {
+            'fps' : fps,
+            'speedup' : fps / baseline,
+            'motion_frames' : hits,
+            'waited' : stats['waited']
+        }
+
+    return results
+
+# mallopt() parameters: the free memory at the top of the heap above which
+# glibc gives it back, how much extra it grows the heap by, and the size
+# above which it serves malloc with mmap
+M_TRIM_THRESHOLD = -1
+M_TOP_PAD = -2
+M_MMAP_THRESHOLD = -3
+
+def pinMmapThreshold():
+    """
+    Stop glibc recycling frame sized blocks, so every frame sized allocation
+    is a fresh mapping and shows up as minor page faults: its mmap threshold
+    no longer rises as they are freed, and memory freed at the top of the
+    heap is given straight back, as malloc would otherwise carve frames out
+    of it before reaching for mmap. Returns whether it could.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+        pinned = all(libc.mallopt(param, value) == 1 for (param, value) in ((M_MMAP_THRESHOLD, 128 * 1024), (M_TRIM_THRESHOLD, 0), (M_TOP_PAD, 0)))
+        libc.malloc_trim(0)
+
+        return pinned
+    except (OSError, AttributeError):
+        return False
+
+def minorFaults():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+
+def legacyFrame(detector, frame, timestamp, rotate):
+    """What BirdHouse.run did with every frame before the buffers were preallocated"""
+    rects = detector.detect(frame) or []
+
+    for (x, y, w, h) in rects:
+        cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 1)
+
+    frame = imutils.rotate(frame, angle = rotate)
+
+    ts = timestamp.strftime("%A %d %B %Y %I:%M:%S%p")
+    cv2.putText(frame, ts, (10, frame.shape[0] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.35, (0, 0, 255), 1)
+
+def engineFrame(detector, frame, timestamp, rotate, format, watched):
+    """The motion engine, annotating only when someone is watching"""
+    rects = detector.detect(frame) or []
+
+    if watched:
+        annotate(frame, format, rects, timestamp, rotate)
+
+def measureFrames(config, process):
+    """Time process(frame) over every frame of the source, returns (LatencyWindow, minor faults, frames)"""
+    source = FrameSource.create(config)
+    latency = LatencyWindow(size = config['camera']['frames'])
+    faults = 0
+    frames = 0
+
+    for frame in source.frames():
+        timestamp = datetime.datetime.now()
+        startedFaults = minorFaults()
+        started = time.time()
+        process(frame, timestamp)
+        latency.add(time.time() - started)
+        faults += minorFaults() - startedFaults
+        frames += 1
+
+    source.close()
+
+    return (latency, faults, frames)
+
+def benchFrame(args):
+    """Per-frame latency and frame sized allocations of the legacy loop against the engine, BGR and YUV, watched or not"""
+    config = benchConfig(args)
+    config['camera']['realtime'] = False
+    config['camera']['analysis_width'] = args.analysis_width
+    rotate = config['camera']['rotate']
+
+    variants = [('legacy', FrameSource.BGR, None)]
+
+    for format in (FrameSource.BGR, FrameSource.YUV):
+        variants.append(('%s' % format, format, False))
+        variants.append(('%s watched' % format, format, True))
+
+    def measure(format, watched):
+        # In its own process, so no variant reuses memory another one freed
+        pinned = pinMmapThreshold()
+        config['camera']['format'] = format
+
+        if watched is None:
+            detector = LegacyMotionDetector(config)
+            process = lambda frame, timestamp: legacyFrame(detector, frame, timestamp, rotate)
+        else:
+            detector = MotionDetector(config)
+            process = lambda frame, timestamp: engineFrame(detector, frame, timestamp, rotate, format, watched)
+
+        # The first pass pays for allocating whatever is kept, only the second, steady state, one is counted
+        (_, firstFaults, frames) = measureFrames(config, process)
+        (latency, faults, frames) = measureFrames(config, process)
+
+        samples = latency.percentiles((50, 99))
+
+        return {
+            'pinned' : pinned,
+            'frames' : frames,
+            'mean_ms' : sum(latency.samples) / max(len(latency.samples), 1) * 1000,
+            'p50_ms' : samples[50] * 1000,
+            'p99_ms' : samples[99] * 1000,
+            'faults_per_frame' : float(faults) / frames,
+            'first_pass_faults_per_frame' : float(firstFaults) / frames
+        }
+
+    results = {}
+
+    for (name, format, watched) in variants:
+        result = forked(lambda: measure(format, watched))
+
+        if not result['pinned'] and 'mmap_threshold_pinned' not in results:
+            print("could not pin the mmap threshold, page faults will undercount allocations")
+
+        results['mmap_threshold_pinned'] = result.pop('pinned')
+
+        print("%-12s %6.2f ms mean, %6.2f ms p50, %6.2f ms p99, %7.1f faults/frame (%.1f first pass)" % (name, result['mean_ms'], result['p50_ms'], result['p99_ms'], result['faults_per_frame'], result['first_pass_faults_per_frame']))
+
+        results[name.replace(' ', '_')] = result
+
+    results['max_rss_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    print("max RSS: %d kB (largest variant)" % results['max_rss_kb'])
+
+    return results
+
+def daemonConfig(args, directory):
+    """A complete daemon config for simulated hardware, keeping its files in directory"""
+    config = benchConfig(args)
+    config.update({
+        'hardware' : 'simulated',
+        'dht22' : { 'gpio' : 4, 'power' : None, 'history_days' : 60, 'interval' : args.sensor_interval },
+        'ds18b20' : { 'id' : 'simulated', 'history_days' : 60, 'interval' : args.sensor_interval },
+        'pipeline' : { 'ring_size' : args.ring_size },
+        'telemetry' : { 'flush_interval' : 1 },
+        'simulator' : {
+            'dht22' : { 'noise' : 0.5, 'error_rate' : 0.05, 'missing_rate' : 0.02, 'glitch_rate' : 0.02 },
+            'ds18b20' : { 'latency' : 0.75 }
+        },
+        'show_video' : False,
+        'sqlite_db' : os.path.join(directory, 'birdhouse.db'),
+        'clips' : { 'enabled' : args.clip_mb > 0, 'directory' : os.path.join(directory, 'clips'), 'preroll' : 2, 'postroll' : 2, 'max_mb' : args.clip_mb },
+        'motion_timeout' : 1,
+        'logfile' : None,
+        'loglevel' : 'WARNING'
+    })
+
+    return config
+
+def runSites(sites, seconds):
+    """Run the daemon for `seconds`, returns how long it actually ran"""
+    timer = threading.Timer(seconds, lambda: sites.pipeline.stop())
+    timer.start()
+
+    started = time.time()
+
+    try:
+        sites.run()
+    finally:
+        timer.cancel()
+
+    return time.time() - started
+
+def benchDaemon(args):
+    """The whole daemon loop on simulated hardware"""
+    from Sites import Sites
+
+    directory = tempfile.mkdtemp()
+
+    try:
+        sites = Sites(daemonConfig(args, directory))
+        birdhouse = sites.sites[0]
+
+        elapsed = runSites(sites, args.seconds)
+
+        pipeline = sites.pipeline.stats()
+        stats = pipeline['feeds'][birdhouse.name]
+
+        print("Ran %.1fs: captured %d frames (%.1f fps), analysed %d (%.1f fps), dropped %d" % (elapsed,
+              stats['capture']['processed'], stats['capture']['processed'] / elapsed,
+              stats['analysis']['processed'], stats['analysis']['processed'] / elapsed,
+              stats['capture']['dropped']))
+        print("Housekeeping tasks: %d runs, %d overran" % (pipeline['tasks']['processed'], pipeline['tasks']['dropped']))
+        print("Telemetry: %d readings in %d flushes" % (birdhouse.telemetry.written, birdhouse.telemetry.flushes))
+        print("DHT22: %d triggers, %s" % (birdhouse.pi.readings, birdhouse.weatherSampler.stats()))
+        print("Motion: %s" % birdhouse.motionEvents.stats())
+
+        if birdhouse.clips is not None:
+            print("Clips: %s" % birdhouse.clips.stats())
+
+            for (path, frames, size) in birdhouse.sqlite.execute("SELECT path, frames, bytes FROM clips ORDER BY started_at"):
+                print("  %s: %d frames, %d bytes" % (os.path.relpath(path, directory), frames, size))
+
+        for sampler in birdhouse.thermSamplers:
+            print("Temperature sensor %s: %s" % (sampler.name, sampler.stats()))
+
+        return {
+            'seconds' : elapsed,
+            'capture_fps' : stats['capture']['processed'] / elapsed,
+            'analysis_fps' : stats['analysis']['processed'] / elapsed,
+            'dropped' : stats['capture']['dropped'],
+            'readings_written' : birdhouse.telemetry.written,
+            'motion' : birdhouse.motionEvents.stats()
+        }
+    finally:
+        shutil.rmtree(directory)
+
+def benchSites(args):
+    """How analysis throughput scales with the number of sites sharing the worker pool"""
+    from Sites import Sites
+
+    results = {}
+
+    for count in args.sites:
+        directory = tempfile.mkdtemp()
+
+        try:
+            config = daemonConfig(args, directory)
+            config['camera']['frames'] = None
+            config['sites'] = [{
+                'name' : 'site%d' % (i + 1),
+                'simulator' : { 'dht22' : { 'seed' : i } },
+                'clips' : { 'directory' : os.path.join(directory, 'clips-%d' % (i + 1)) }
+            } for i in range(count)]
+            config['pipeline']['workers'] = args.workers
+
+            sites = Sites(config)
+            elapsed = runSites(sites, args.seconds)
+
+            feeds = sites.pipeline.stats()['feeds'].values()
+            captured = sum(feed['capture']['processed'] for feed in feeds)
+            analysed = sum(feed['analysis']['processed'] for feed in feeds)
+            dropped = sum(feed['capture']['dropped'] for feed in feeds)
+            written = sum(site.telemetry.written for site in sites.sites)
+
+            print("%d site(s), %d worker(s): analysed %.1f fps (%.1f fps per site), captured %.1f fps, dropped %d, %d readings written" % (
+                  count, sites.workers, analysed / elapsed, analysed / elapsed / count, captured / elapsed, dropped, written))
+
+            results[count] = {
+                'workers' : sites.workers,
+                'seconds' : elapsed,
+                'analysis_fps' : analysed / elapsed,
+                'analysis_fps_per_site' : analysed / elapsed / count,
+                'capture_fps' : captured / elapsed,
+                'dropped' : dropped,
+                'readings_written' : written
+            }
+        finally:
+            shutil.rmtree(directory)
+
+    return results
+
+def benchRestart(args):
+    """How long the daemon is down when the supervisor restarts a crashed (killed) or hung (stopped) worker"""
+    from Supervisor import Supervisor
+
+    directory = tempfile.mkdtemp()
+
+    try:
+        config = daemonConfig(args, directory)
+        config['camera'].update({ 'frames' : None, 'fps' : args.fps or 16, 'realtime' : True })
+        config['supervisor'] = {
+            'enabled' : True,
+            'heartbeat_interval' : 0.5,
+            'stall_timeout' : args.stall_timeout,
+            'grace' : 1,
+            'backoff' : args.backoff,
+            'stable_after' : 2
+        }
+
+        supervisor = Supervisor(config)
+        failures = []
+
+        def fail():
+            for i in range(args.restarts):
+                # Let the worker settle, then crash or hang it
+                while not supervisor.up and not supervisor.stopping:
+                    time.sleep(0.05)
+
+                time.sleep(3)
+
+                (name, signum) = ('crash', signal.SIGKILL) if i % 2 == 0 else ('stall', signal.SIGSTOP)
+                failures.append(name)
+                supervisor.up = False
+                os.kill(supervisor.pid, signum)
+
+            while not supervisor.up and not supervisor.stopping:
+                time.sleep(0.05)
+
+            supervisor.stop()
+
+        thread = threading.Thread(target = fail)
+        thread.daemon = True
+        thread.start()
+
+        supervisor.run()
+        thread.join(5)
+
+        downtimes = supervisor.recovery.samples
+
+        for (name, downtime) in zip(failures, downtimes):
+            print("%-6s down for %.2fs" % (name, downtime))
+
+        print("restarts: %s, backoff %.1fs, stall timeout %.1fs" % (dict(supervisor.restarts), args.backoff, args.stall_timeout))
+
+        return {
+            'restarts' : dict(supervisor.restarts),
+            'downtime_s' : [{ 'failure' : name, 'seconds' : downtime } for (name, downtime) in zip(failures, downtimes)]
+        }
+    finally:
+        shutil.rmtree(directory)
+
+def importSeconds(module, runs = 3):
+    """Best of `runs` fresh interpreters importing module"""
+    best = None
+
+    for i in range(runs):
+        started = time.time()
+        subprocess.check_call([sys.executable, '-c', 'import %s' % module], cwd = os.path.dirname(os.path.abspath(__file__)))
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+def benchStartup(args):
+    """Time from nothing to detecting motion with two sites: imports, sites and their hardware opened one after another or together, and a restored background"""
+    from Sites import Sites
+    import Startup
+
+    results = {}
+
+    for module in ('birdhouse', 'Sites'):
+        results['import_%s' % module] = importSeconds(module)
+
+    print("import: %.3fs for birdhouse.py (stop, reload, ...), %.3fs for the daemon" % (results['import_birdhouse'], results['import_Sites']))
+
+    directory = tempfile.mkdtemp()
+    parallel = Startup.parallel
+
+    try:
+        for (name, concurrent, persist) in (('serial', False, False), ('parallel', True, True), ('restored', True, True)):
+            config = daemonConfig(args, directory)
+            config['camera'].update({ 'frames' : None, 'fps' : args.fps or 16, 'realtime' : True })
+            config['camera']['background'] = { 'persist' : persist }
+            # Powered from a gpio, as on the Pi, the DHT22 gets 2s to come up
+            config['dht22']['power'] = 22
+            config['sites'] = [{
+                'name' : 'site%d' % (i + 1),
+                'clips' : { 'directory' : os.path.join(directory, 'clips-%d' % (i + 1)) }
+            } for i in range(2)]
+
+            if not concurrent:
+                Startup.parallel = lambda calls: [call() for call in calls]
+
+            try:
+                started = time.time()
+                sites = Sites(config)
+                built = time.time() - started
+            finally:
+                Startup.parallel = parallel
+
+            runSites(sites, args.seconds)
+
+            site = sites.sites[0]
+            phases = collections.OrderedDict(sites.startup.items() + site.startup.items())
+            phases['ready'] = built + phases.get('detecting', float('nan'))
+
+            print("%-9s %s, restored %d" % (name, ', '.join('%s %.2fs' % item for item in phases.items()), site.motion.restores))
+
+            results[name] = dict(phases, restores = site.motion.restores)
+    finally:
+        shutil.rmtree(directory)
+
+    return results
+
+class SlowStream:
+    """A log file on storage that takes `delay` seconds a write, like a busy SD card"""
+
+    def __init__(self, stream, delay):
+        self.stream = stream
+        self.delay = delay
+
+    def write(self, data):
+        time.sleep(self.delay)
+        self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        self.stream.close()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+def slowHandler(handler, delay):
+    if delay > 0:
+        handler.stream = SlowStream(handler.stream, delay)
+
+    return handler
+
+def eagerFrameLogging(frame, now):
+    """What a frame during motion logged before the pipeline, every message formatted up front"""
+    logging.info("Motion detected")
+    logging.debug("Motion Detected, overriding outlets to ON state until %s" % now)
+    logging.debug("Lighting changed, ignoring motion for %.1fs" % 1.0)
+    logging.debug("%s frame stats: %s" % ('bench', { 'processed' : frame, 'dropped' : 0 }))
+
+def lazyFrameLogging(frame, now):
+    """The same records as the frame path logs them now"""
+    logging.info("Motion detected")
+    logging.debug("Motion Detected, overriding outlets to ON state until %s", now)
+    logging.debug("Lighting changed, ignoring motion for %.1fs", 1.0)
+    logging.debug("%s frame stats: %s", 'bench', { 'processed' : frame, 'dropped' : 0 })
+
+def benchLog(args):
+    """Per-frame logging overhead of basicConfig's synchronous file handler against the pipeline, at DEBUG and WARNING"""
+    import LogPipeline
+
+    directory = tempfile.mkdtemp()
+    root = logging.getLogger()
+    frames = args.frames * 20
+    results = {}
+
+    try:
+        for level in ('DEBUG', 'WARNING'):
+            for variant in ('basicConfig', 'pipeline'):
+                path = os.path.join(directory, '%s-%s.log' % (variant, level))
+                config = { 'logfile' : path, 'loglevel' : level, 'log' : { 'window' : args.log_window } }
+
+                for handler in root.handlers[:]:
+                    root.removeHandler(handler)
+
+                root.setLevel(getattr(logging, level))
+
+                if variant == 'basicConfig':
+                    handler = slowHandler(logging.FileHandler(path), args.write_delay)
+                    handler.setFormatter(logging.Formatter(LogPipeline.FORMAT))
+                    frameLogging = eagerFrameLogging
+                else:
+                    listener = LogPipeline.QueueListener(config)
+                    createHandler = listener.createHandler
+                    listener.createHandler = lambda: slowHandler(createHandler(), args.write_delay)
+                    handler = LogPipeline.QueueHandler(listener)
+                    frameLogging = lazyFrameLogging
+
+                root.addHandler(handler)
+
+                latency = LatencyWindow(size = frames)
+
+                for frame in range(frames):
+                    started = time.time()
+                    frameLogging(frame, datetime.datetime.now())
+                    latency.add(time.time() - started)
+
+                # The pipeline's writing isn't over when the frames are
+                started = time.time()
+                root.removeHandler(handler)
+                handler.close()
+                drained = time.time() - started
+
+                # Nothing at all may have been logged
+                if not os.path.exists(path):
+                    open(path, 'w').close()
+
+                with open(path) as log:
+                    lines = sum(1 for line in log)
+
+                samples = latency.percentiles((50, 99))
+                mean = sum(latency.samples) / len(latency.samples)
+                name = '%s_%s' % (variant, level.lower())
+
+                print("%-20s %7.1f us/frame mean, %7.1f us p50, %7.1f us p99, %6d lines (%d kB), %.2fs to finish writing" % (
+                      name, mean * 1e6, samples[50] * 1e6, samples[99] * 1e6, lines, os.path.getsize(path) // 1024, drained))
+
+                results[name] = {
+                    'frames' : frames,
+                    'mean_us' : mean * 1e6,
+                    'p50_us' : samples[50] * 1e6,
+                    'p99_us' : samples[99] * 1e6,
+                    'lines' : lines,
+                    'bytes' : os.path.getsize(path),
+                    'drain_seconds' : drained
+                }
+    finally:
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+
+        shutil.rmtree(directory)
+
+    return results
+
+def streamClient(address, stopping, received, delay = 0):
+    """A viewer reading /stream.mjpg, pausing `delay` seconds between reads to act as a slow link"""
+    sock = socket.create_connection(address)
+    sock.sendall('GET /stream.mjpg HTTP/1.0\r\n\r\n')
+
+    try:
+        while not stopping.is_set():
+            data = sock.recv(16384 if delay else 65536)
+
+            if not data:
+                break
+
+            received.append(len(data))
+
+            if delay:
+                time.sleep(delay)
+    finally:
+        sock.close()
+
+def benchStream(args):
+    """CPU cost of the MJPEG stream against the number of viewers"""
+    from Stream import StreamServer
+
+    config = benchConfig(args)
+    config['camera']['realtime'] = True
+    config['camera']['fps'] = args.fps or 15
+    config['camera']['frames'] = int(args.seconds * config['camera']['fps'])
+    config['stream'] = { 'bind' : '127.0.0.1', 'port' : 0, 'quality' : 80, 'max_fps' : 0 }
+
+    print("%7s %8s %8s %8s %10s %12s %14s" % ('clients', 'CPU %', 'encoded', 'sent', 'dropped', 'encode ms', 'per-client ms'))
+
+    results = {}
+
+    for clients in [c for c in (0, 1, 2, 4, 8, 16) if c <= args.clients]:
+        stream = StreamServer(config)
+        stream.start()
+
+        stopping = threading.Event()
+        received = []
+        viewers = [threading.Thread(target = streamClient, args = (stream.address(), stopping, received, args.client_delay)) for i in range(clients)]
+
+        for v in viewers:
+            v.daemon = True
+            v.start()
+
+        source = FrameSource.create(config)
+        started = os.times()
+
+        for frame in source.frames():
+            stream.publish(imutils.rotate(frame, angle = 180))
+
+        finished = os.times()
+
+        stopping.set()
+        stream.stop()
+
+        for v in viewers:
+            v.join(5)
+
+        stats = stream.stats()
+        cpu = (finished[0] + finished[1]) - (started[0] + started[1])
+        wall = finished[4] - started[4]
+        encodeMs = stats['encode_ms'].get('p50', 0)
+
+        # Encoding once per viewer would cost this much encoder time per frame instead
+        print("%7d %8.1f %8d %8d %10d %12.2f %14.2f" % (clients, 100 * cpu / wall, stats['encoded'], stats['sent'], stats['dropped'], encodeMs, encodeMs * clients))
+
+        results[str(clients)] = { 'cpu_percent' : 100 * cpu / wall, 'encoded' : stats['encoded'], 'sent' : stats['sent'], 'dropped' : stats['dropped'], 'encode_ms' : encodeMs }
+
+    return results
+
+def benchDHT22(args):
+    """DHT22.sensor._cb decoding throughput on synthetic edge streams"""
+    import Simulator
+    import DHT22
+
+    rng = random.Random(0)
+    pi = Simulator.pi({ 'dht22' : { 'gpio' : 4 } })
+    sensor = DHT22.sensor(pi, 4)
+    outcomes = collections.defaultdict(int)
+
+    def reading(status, humidity, temperature):
+        outcomes[status] += 1
+
+    sensor.reading = reading
+
+    # Readings 3s apart like the sampler spaces them, 5% with a bad checksum
+    streams = [Simulator.dht22Edges(rng.uniform(0, 100), rng.uniform(-40, 80), i * 3000000, rng.random() < 0.05) for i in range(1, args.readings + 1)]
+    edges = sum(len(s) for s in streams)
+
+    started = time.clock()
+
+    for stream in streams:
+        for (level, tick) in stream:
+            sensor._cb(4, level, tick)
+
+    cpu = time.clock() - started
+
+    print("Decoded %d readings (%d edges) in %.3fs CPU: %.0f readings/s, %.2f us/edge" % (args.readings, edges, cpu, args.readings / cpu, 1000000 * cpu / edges))
+    print("%d good, %d bad checksums" % (outcomes[DHT22.OK], outcomes[DHT22.BAD_CHECKSUM]))
+
+    return {
+        'readings' : args.readings,
+        'edges' : edges,
+        'readings_per_second' : args.readings / cpu,
+        'us_per_edge' : 1000000 * cpu / edges,
+        'good' : outcomes[DHT22.OK],
+        'bad_checksum' : outcomes[DHT22.BAD_CHECKSUM]
+    }
+
+def benchSuite(args):
+    """The motion, schedule, storage and DHT22 benchmarks together, for comparing commits"""
+    results = {}
+
+    for resolution in args.resolutions:
+        (width, height) = [int(v) for v in resolution.split('x')]
+
+        print("== motion %s" % resolution)
+        results['motion_%s' % resolution] = benchMotion(argparse.Namespace(**dict(vars(args), width = width, height = height)))
+
+    for (name, bench) in (('schedule', benchSchedule), ('storage', benchStorage), ('dht22', benchDHT22)):
+        print("== %s" % name)
+        results[name] = bench(args)
+
+    return results
+
+def environment():
+    """What the results were measured on, so runs can be compared"""
+    import numpy
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = os.path.dirname(os.path.abspath(__file__)), stderr = subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'commit' : commit,
+        'python' : platform.python_version(),
+        'platform' : platform.platform(),
+        'machine' : platform.machine(),
+        'numpy' : numpy.__version__,
+        'opencv' : cv2.__version__,
+        'sqlite' : sqlite3.sqlite_version,
+        'timestamp' : datetime.datetime.now().isoformat()
+    }
+
+BENCHMARKS = {
+    'pipeline' : benchPipeline,
+    'schedule' : benchSchedule,
+    'outlets' : benchOutlets,
+    'storage' : benchStorage,
+    'rollup' : benchRollup,
+    'query' : benchQuery,
+    'motion' : benchMotion,
+    'processes' : benchProcesses,
+    'frame' : benchFrame,
+    'daemon' : benchDaemon,
+    'sites' : benchSites,
+    'restart' : benchRestart,
+    'startup' : benchStartup,
+    'log' : benchLog,
+    'stream' : benchStream,
+    'dht22' : benchDHT22,
+    'suite' : benchSuite
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Birdhouse benchmarks")
+    parser.add_argument('benchmark', choices = sorted(BENCHMARKS.keys()))
+    parser.add_argument('--video', help = "replay this clip instead of synthetic frames")
+    parser.add_argument('--width', type = int, default = 640)
+    parser.add_argument('--height', type = int, default = 480)
+    parser.add_argument('--format', choices = [FrameSource.BGR, FrameSource.YUV], default = FrameSource.BGR, help = "frame layout the source delivers")
+    parser.add_argument('--fps', type = int, default = 0, help = "pace the source, 0 for as fast as possible")
+    parser.add_argument('--frames', type = int, default = 500)
+    parser.add_argument('--analysis-width', type = int, default = 500)
+    parser.add_argument('--every', type = int, default = 1, help = "analyse every Nth frame")
+    parser.add_argument('--background', default = 'average', help = "background model for the motion benchmark")
+    parser.add_argument('--max-every', type = int, default = 1, help = "most frames per analysed frame while the scene is static")
+    parser.add_argument('--roi', action = 'append', default = [], help = "x,y,w,h region as fractions of the frame, may be repeated")
+    parser.add_argument('--ring-size', type = int, default = 4)
+    parser.add_argument('--delay', type = float, default = 0, help = "extra per-frame analysis time in seconds")
+    parser.add_argument('--seconds', type = float, default = 10, help = "how long to run the daemon for")
+    parser.add_argument('--sensor-interval', type = float, default = 5)
+    parser.add_argument('--days', type = int, default = 60, help = "days of history to pre-fill the database with")
+    parser.add_argument('--readings', type = int, default = 200)
+    parser.add_argument('--batch-size', type = int, default = 50)
+    parser.add_argument('--fps-target', type = int, default = 16, help = "frame rate the per-frame schedule path ran at")
+    parser.add_argument('--clip-mb', type = float, default = 0, help = "record motion clips in the daemon benchmark, capped at this many MB")
+    parser.add_argument('--clients', type = int, default = 8, help = "most stream viewers to measure")
+    parser.add_argument('--gpio-latency', type = float, default = 0.0002, help = "seconds a pigpio call takes, to put the outlet benchmark's call counts in time")
+    parser.add_argument('--outlets', type = int, nargs = '+', default = [1, 10, 100], help = "outlet counts for the schedule and outlets benchmarks")
+    parser.add_argument('--sites', type = int, nargs = '+', default = [1, 2, 4], help = "site counts for the sites benchmark")
+    parser.add_argument('--workers', type = int, default = 0, help = "analysis workers for the sites benchmark, 0 for one per site up to the cores")
+    parser.add_argument('--restarts', type = int, default = 4, help = "worker failures for the restart benchmark, alternately crashes and hangs")
+    parser.add_argument('--stall-timeout', type = float, default = 3, help = "seconds without a heartbeat before the restart benchmark's supervisor restarts a worker")
+    parser.add_argument('--backoff', type = float, default = 0.5, help = "first restart delay for the restart benchmark")
+    parser.add_argument('--write-delay', type = float, default = 0, help = "seconds each log write takes in the log benchmark, to mimic slow storage")
+    parser.add_argument('--log-window', type = float, default = 10, help = "the log benchmark's aggregation window in seconds")
+    parser.add_argument('--points', type = int, default = 500, help = "points the query benchmark asks for")
+    parser.add_argument('--resolutions', nargs = '+', default = ['320x240', '640x480', '1280x720'], help = "frame sizes for the suite's motion benchmark")
+    parser.add_argument('--processes', type = int, nargs = '+', default = [1, 2, 3, 4], help = "worker process counts for the processes benchmark")
+    parser.add_argument('--split', choices = ['frames', 'stripes'], default = 'frames', help = "how the processes benchmark shares frames between workers")
+    parser.add_argument('--json', help = "also write the results to this file as JSON")
+    parser.add_argument('--client-delay', type = float, default = 0, help = "seconds each stream viewer pauses between reads")
+
+    args = parser.parse_args()
+
+    results = BENCHMARKS[args.benchmark](args)
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump({
+                'benchmark' : args.benchmark,
+                'args' : vars(args),
+                'environment' : environment(),
+                'results' : results
+            }, output, indent = 2, sort_keys = True)
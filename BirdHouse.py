@@ -1,214 +1,412 @@
-from picamera import PiCamera
-from picamera.array import PiRGBArray
-from w1thermsensor import W1ThermSensor
+from MotionDetector import MotionDetector
+from Pipeline import Feed
+from MotionProcesses import MotionProcesses
+from Scheduler import OutletScheduler
+from Telemetry import TelemetryWriter
+from MotionEvents import MotionEventTracker
+from Sampler import ThermSampler, DHT22Sampler
+from Stream import StreamServer
+from Outlets import OutletCache, OutletController
 
-import pigpio
-import DHT22
+import Hardware
+import Pipeline
+import FrameSource
+import Config
+import Clips
+import LogPipeline
+import Migrations
+import Startup
 import time
 import imutils
 import cv2
 import datetime
 import sqlite3
-import cronex
 import logging
+import threading
+
+def annotate(frame, format, rects, timestamp, rotate):
+    """
+    The frame as displayed and streamed, with the motion rectangles,
+    rotated and timestamped. Always a new array, as the stream keeps it
+    while the frame itself goes back to the ring.
+    """
+    image = FrameSource.toBGR(frame, format)
+    
+    for (x, y, w, h) in rects:
+        cv2.rectangle(image, (x, y), (x + w, y + h), (0, 255, 0), 1)
+    
+    angle = rotate % 360
+    
+    if angle == 180:
+        image = cv2.rotate(image, cv2.ROTATE_180)
+    elif angle:
+        image = imutils.rotate(image, angle = angle)
+    elif image is frame:
+        image = image.copy()
+    
+    ts = timestamp.strftime("%A %d %B %Y %I:%M:%S%p")
+    cv2.putText(image, ts, (10, image.shape[0] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.35, (0, 0, 255), 1)
+    
+    return image
+
+def openDatabase(config):
+    """Open a site's database, migrated to the latest schema"""
+    sqlite = sqlite3.connect(config['sqlite_db'], 
+                             detect_types = sqlite3.PARSE_DECLTYPES,
+                             isolation_level = None,
+                             check_same_thread = False)
+    
+    logging.debug("Migrating birdhouse database schema to the latest version")
+    
+    Migrations.migrate(sqlite, config)
+    
+    sqlite.execute('PRAGMA journal_mode=WAL')
+    
+    return sqlite
 
 class BirdHouse:
+    """
+    One site: a camera, its sensors and outlets and the database they are
+    recorded in. Sites are run by Sites, which shares the analysis workers,
+    the telemetry writer and the metrics endpoint between them.
+    """
     
-    def __init__(self, config):
+    def __init__(self, config, name = 'birdhouse'):
         self.config = config
-        self.camera = PiCamera()
-        self.camera.resolution = tuple(config['camera']['resolution'])
-        self.camera.framerate = config['camera']['fps']
-        self.pi = pigpio.pi()
-        self.dht22 = DHT22.sensor(self.pi, config['dht22']['gpio'], None, power=config['dht22']['power'])
-        self.ds18b20 = W1ThermSensor(W1ThermSensor.THERM_SENSOR_DS18B20, config['ds18b20']['id'])
-	self.sqlite = sqlite3.connect(config['sqlite_db'], 
-                                      detect_types = sqlite3.PARSE_DECLTYPES,
-                                      isolation_level = None)
+        self.name = name
+        self.settings = Config.compileSettings(config)
+        self.pendingConfig = None
+        self.annotated = 0
+        self.detecting = False
+        self.startup = Startup.Phases()
         
-        logging_level = getattr(logging, self.config['loglevel'].upper(), None)
+        LogPipeline.configure(self.config)
         
-        if not isinstance(logging_level, int):
-            raise ValueError('Invalid Log Level: %s' % self.config['loglevel'])
+        logging.info("Initializing Birdhouse %s", name)
         
-        logging.basicConfig(level = logging_level, 
-                            filename = self.config['logfile'],
-                            format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        # The camera and sensors spend seconds coming up, the schema is migrated meanwhile
+        (self.hardware, self.sqlite) = Startup.parallel([
+            lambda: self.startup.timed('hardware', Hardware.create, config),
+            lambda: self.startup.timed('database', openDatabase, config)
+        ])
         
-        logging.info("Initializing Birdhouse")
+        self.source = self.hardware.source
+        self.motion = MotionDetector(config)
+        self.pi = self.hardware.pi
+        self.dht22 = self.hardware.dht22
+        self.ds18b20 = self.hardware.ds18b20
         
-        c = self.sqlite.cursor()
+        # Motion is handled on the analysis thread, sensors and schedules on
+        # the housekeeping thread, so the connection is shared under a lock
+        self.dbLock = threading.RLock()
         
-        logging.debug("Creating Tables to store birdhouse data if they don't previously exist")
+        self.outlets = OutletCache(self.sqlite, self.dbLock)
+        self.controller = OutletController(self.pi, config.get('outlets'))
+        # Lamps switching on schedule shouldn't look like motion
+        self.scheduler = OutletScheduler(self.outlets, self.controller, config.get('schedule'), self.motion.lightingChanged)
+        self.telemetry = TelemetryWriter(self.sqlite, self.dbLock, config)
+        self.clips = Clips.create(self.sqlite, self.dbLock, config, self.source)
+        self.motionEvents = MotionEventTracker(self.sqlite, self.dbLock, self.outlets, self.controller, config, self.clips)
         
-        c.execute('''CREATE TABLE IF NOT EXISTS outlets (outlet_id INT, name TEXT, schedule TEXT, override_until timestamp, last_ran timestamp, initial_state INT, schedule_active INT)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS weather (recorded_at timestamp, humidity REAL, temperature REAL)''')
-     
-	c.execute('''CREATE TABLE IF NOT EXISTS water_temp(recorded_at timestamp, temperature REAL)''')
-
-	c.execute('PRAGMA journal_mode=WAL')
-       
-      
-    def processWeather(self, humidity, temperature):
-        c = self.sqlite.cursor()
-        previousHistoryCut = datetime.datetime.now() - datetime.timedelta(days = self.config['dht22']['history_days'])
+        # 1-wire reads take most of a second, each probe gets its own thread
+        self.thermSamplers = [ThermSampler('water', self.ds18b20, config['ds18b20'].get('interval', 5), Hardware.DEGREES_F, self.processWaterTemp)]
         
-        logging.debug("Deleting historic weather data older than %s" % previousHistoryCut)
+        for w1 in config.get('w1_sensors', []):
+            self.thermSamplers.append(ThermSampler(w1['name'], self.hardware.w1_sensors[w1['name']], w1.get('interval', 5), Hardware.DEGREES_F))
         
-        c.execute("DELETE FROM weather WHERE recorded_at <= :history_cutoff", { 'history_cutoff' : previousHistoryCut })
-        c.execute("INSERT INTO weather VALUES(?, ?, ?)", (datetime.datetime.now(), humidity, temperature))
-
-    def processWaterTemp(self, temperature):
-	c = self.sqlite.cursor()
-	previousHistoryCut = datetime.datetime.now() - datetime.timedelta(days = self.config['ds18b20']['history_days'])
-
-	logging.debug("Deleting historic water data older than %s" % previousHistoryCut)
+        # The DHT22 is triggered and waited on from its own thread too
+        self.weatherSampler = DHT22Sampler(self.dht22, config['dht22'], self.processReading)
+        
+        # Remote viewing of the annotated feed, without needing a display
+        self.stream = StreamServer(config) if config.get('stream', {}).get('enabled') else None
+        
+        pipeline = config.get('pipeline', {})
+        
+        # Motion detection on worker processes, which the ring's frames are shared with
+        self.processes = MotionProcesses(config, self.motion) if pipeline.get('processes') else None
+        
+        self.feed = Feed(name, self.source, self.processFrame, ring_size = pipeline.get('ring_size', 4),
+                         listeners = [self.clips.add] if self.clips is not None else [],
+                         allocate = self.processes.allocate if self.processes is not None else Pipeline.allocate)
+    
+    def processWeather(self, humidity, temperature):
+        self.telemetry.record('weather', (datetime.datetime.now(), humidity, temperature))
 
-	c.execute("DELETE FROM water_temp WHERE recorded_at <= :history_cutoff", { 'history_cutoff' : previousHistoryCut})
-	c.execute("INSERT INTO water_temp VALUES(?, ?)", (datetime.datetime.now(), temperature))
+    def processWaterTemp(self, temperature, recorded_at = None):
+        self.telemetry.record('water_temp', (recorded_at or datetime.datetime.now(), temperature))
 
-    def processMotion(self):
-        override_until = datetime.datetime.now() + datetime.timedelta(minutes = self.config['motion_timeout'])
+    def processReading(self, reading):
+        if reading.valid:
+            self.processWeather(reading.humidity, reading.temperatureF())
+        else:
+            logging.warning("Failed to capture weather data! (%s)", reading.describe())
+    
+    def requestReload(self, config):
+        """
+        Switch to a new, already checked, config. It is applied by the
+        analysis worker before the next frame.
+        """
+        self.pendingConfig = config
+    
+    def applyConfig(self, config):
+        logging.info("Reloading configuration of %s", self.name)
+        
+        restart = Config.restartRequired(self.config, config)
         
-        c = self.sqlite.cursor()
-        c.execute('UPDATE outlets set override_until = :override_until', {'override_until' : override_until})
-        results = c.execute('SELECT * FROM outlets')
+        if restart:
+            logging.warning("Restart the daemon to apply changes to %s of %s", ', '.join(restart), self.name)
         
-        logging.debug("Motion Detected, overriding outlets to ON state until %s" % override_until)
+        self.config = config
+        self.settings = Config.compileSettings(config)
         
-        for outlet in results:
-            self.pi.write(outlet[0], 1)
+        logging.getLogger().setLevel(self.settings.loglevel)
+        
+        self.motion.configure(config)
+        
+        if self.processes is not None:
+            self.processes.configure(config)
+        
+        self.motionEvents.configure(config)
+        self.scheduler.configure(config.get('schedule'))
+        self.controller.configure(config.get('outlets'))
     
-    def processSchedule(self):
-        c = self.sqlite.cursor()
-        results = c.execute('SELECT * FROM outlets')
+    def processFrame(self, frame, timestamp):
+        if self.pendingConfig is not None:
+            (config, self.pendingConfig) = (self.pendingConfig, None)
+            self.applyConfig(config)
         
-        if c.rowcount ==  0:
-            logging.warning("No outlets defined in database. Please define outlets!")
-            
-        for outlet in results:
-            
-            if not outlet[6]:
-                logging.debug("Ignoring outlet %d becuse schedule is disabled" % outlet[0])
-                continue
-            
-            # Scheduling hints: https://github.com/ericpruitt/cronex
-            job = cronex.CronExpression(outlet[2].encode('ascii', 'ignore'))
-            
-            logging.debug("Applying schedule '%s' to outlet %d (now: %s)" % (outlet[2], outlet[0], datetime.datetime.now()))
-            
-            if job.check_trigger(time.localtime(time.time())[:5]):
-            
-                logging.debug("Cron job for outlet %d triggered" % outlet[0])
-                    
-                c2 = self.sqlite.cursor()
-                c2.execute("SELECT * FROM outlets WHERE outlet_id = :outlet_id LIMIT 1", {'outlet_id' : outlet[0]})
-                    
-                currentOutlet = c2.fetchone()
-
-                if currentOutlet[3] is not None:
-                    if currentOutlet[3] > datetime.datetime.now():
-                        logging.debug("Override for outlet %d enabled" % outlet[0])
-                        continue
-                
-                if currentOutlet[4] is None:
-                    logging.debug("Last ran not provided for outlet %d" % outlet[0])
-                    secondsSinceExecution = 61
-                else:
-                    secondsSinceExecution = (datetime.datetime.now() - currentOutlet[4]).total_seconds()
-                    logging.debug("Outlet %d was last ran %s" % (outlet[0], secondsSinceExecution))
-                
-                if secondsSinceExecution > 60:
-                    
-                    logging.debug("Updating outlet %d last run time to %s" % (outlet[0], datetime.datetime.now()))
-                    
-                    c2.execute("UPDATE outlets SET last_ran = ? WHERE outlet_id = ?", (datetime.datetime.now(), outlet[0]))
-                    
-                    if self.pi.read(outlet[0]):
-                        logging.info("Outlet %i between switched to OFF per schedule %s" % (outlet[0], outlet[2].encode('ascii', 'ignore')))
-                        self.pi.write(outlet[0], 0)
-                    else:
-                        logging.info("Outlet %i between switched to ON per schedule %s" % (outlet[0], outlet[2].encode('ascii', 'ignore')))
-                        self.pi.write(outlet[0], 1)
-                        
-    
-    def run(self):
-        rawCapture = PiRGBArray(self.camera, size=tuple(self.config['camera']["resolution"]))
-        next_dht_reading = int(time.time())
-        avg = None
-        
-        logging.info("Setting initial schedule state")
-        
-        c = self.sqlite.cursor()
-        
-        outlets = c.execute("SELECT * FROM outlets")
-        
-        for outlet in outlets:
-            if outlet[6]:
-                logging.debug("Initializing Outlet %d to %d" % (outlet[0], outlet[5]))
-                self.pi.write(outlet[0], outlet[5])
-            else:
-                logging.debug("Skipping Initialization of Outlet %d - inactive schedule" % outlet[0])
-                self.pi.write(outlet[0], outlet[5])
+        if not self.detecting:
+            self.startup.mark('first_frame')
         
-        logging.info("Initializing Motion Capture")
+        if self.processes is None:
+            return self.handleMotion(frame, timestamp, self.motion.detect(frame))
         
-        for f in self.camera.capture_continuous(rawCapture, format="bgr", use_video_port = True):
-            frame = f.array
-            timestamp = datetime.datetime.now()
-            
-            if int(time.time()) > next_dht_reading:
-                self.dht22.trigger()
-                next_dht_reading += 5
-                
-                if (self.dht22.humidity() > 0) and (self.dht22.temperature() > 0) and not self.dht22.bad_checksum():
-                    self.processWeather(self.dht22.humidity(), self.dht22.temperatureF())
-                else:
-                    logging.warning("Failed to capture weather data!")
-		
-		self.processWaterTemp(self.ds18b20.get_temperature(W1ThermSensor.DEGREES_F))
-                    
-            frame = imutils.resize(frame, width = 500)
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            gray = cv2.GaussianBlur(gray, (21, 21), 0)
-            
-            if avg is None:
-                avg = gray.copy().astype("float")
-                rawCapture.truncate(0)
-                logging.info("No average background data available, creating from scratch based on current background")
-                continue
-            
-            cv2.accumulateWeighted(gray, avg, 0.5)
-            
-            frameDelta = cv2.absdiff(gray, cv2.convertScaleAbs(avg))
-            
-            threshold = cv2.threshold(frameDelta, self.config['camera']['threshold'], 255, cv2.THRESH_BINARY)[1]
-            threshold = cv2.dilate(threshold, None, iterations = 2)
-            (_, cnts, _) = cv2.findContours(threshold.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            
-            for c in cnts:
-                if cv2.contourArea(c) < self.config['camera']['min_area']:
-                    continue
-                
-                (x, y, w, h) = cv2.boundingRect(c)
-                cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 1)
-                logging.info("Motion detected")
-                self.processMotion()
-                
+        # The frame stays in the ring's slot until its motion is handled
+        self.feed.ring.keep()
+        
+        return self.handleAnswered(self.processes.submit(frame, timestamp))
+    
+    def handleAnswered(self, answered):
+        """Handle the motion of the frames the motion processes have answered, in order"""
+        result = None
+        
+        for (frame, timestamp, rects) in answered:
+            if result is not False:
+                result = self.handleMotion(frame, timestamp, rects)
             
-            frame = imutils.rotate(frame, angle = self.config['camera']['rotate'])
+            self.feed.ring.release(frame)
+        
+        return result
+    
+    def handleMotion(self, frame, timestamp, rects):
+        settings = self.settings
+        
+        if rects is None:
+            logging.info("No average background data available, creating from scratch based on current background")
+            return
+        
+        if not self.detecting:
+            self.detecting = True
+            self.startup.mark('detecting')
+            logging.info("%s is detecting motion, started in: %s", self.name, self.startup.describe())
+        
+        self.motionEvents.update(rects, timestamp)
+        
+        # Only draw the frame when someone is going to look at it
+        if not settings.show_video and (self.stream is None or not self.stream.clients):
+            return
+        
+        frame = self.annotate(frame, rects, timestamp)
+        
+        if self.stream is not None:
+            self.stream.publish(frame, timestamp)
+        
+        if settings.show_video:
+            cv2.imshow("Birdhouse Feed", frame)
+            key = cv2.waitKey(1) & 0xFF
             
-            ts = timestamp.strftime("%A %d %B %Y %I:%M:%S%p")
-            cv2.putText(frame, ts, (10, frame.shape[0] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.35, (0, 0, 255), 1)
+            if key == ord('q'):
+                return False
+    
+    def annotate(self, frame, rects, timestamp):
+        self.annotated += 1
+        
+        return annotate(frame, self.source.format, rects, timestamp, self.settings.rotate)
+    
+    def registerMetrics(self, registry):
+        stage = 'birdhouse_stage_seconds'
+        help = "Time spent in each stage of the daemon"
+        site = self.name
+        
+        registry.histogram(stage, help, self.feed.capture_latency, stage = 'capture', site = site)
+        registry.histogram(stage, help, self.feed.queue_latency, stage = 'queue', site = site)
+        registry.histogram(stage, help, self.feed.analysis_latency, stage = 'analysis', site = site)
+        registry.histogram(stage, help, self.motion.blur_latency, stage = 'blur', site = site)
+        registry.histogram(stage, help, self.motion.contour_latency, stage = 'contour', site = site)
+        registry.histogram(stage, help, self.scheduler.latency, stage = 'schedule', site = site)
+        registry.histogram(stage, help, self.telemetry.flush_latency, stage = 'db_write', site = site)
+        registry.histogram('birdhouse_sqlite_commit_seconds', "SQLite commit latency of telemetry batches", self.telemetry.commit_latency, site = site)
+        registry.histogram('birdhouse_dht22_read_seconds', "Time from DHT22 trigger to a good reading", self.weatherSampler.histogram, site = site)
+        
+        for sampler in self.thermSamplers:
+            registry.histogram('birdhouse_ds18b20_read_seconds', "DS18B20 read latency", sampler.histogram, sensor = sampler.name, site = site)
+        
+        registry.collector(self.collectMetrics)
+    
+    def collectMetrics(self):
+        """Counters and gauges for the metrics endpoint, read when it is scraped"""
+        feed = self.feed.stats()
+        motion = self.motionEvents.stats()
+        weather = self.weatherSampler.stats()
+        site = self.name
+        
+        samples = [
+            ('birdhouse_frames_total', 'counter', "Frames by what happened to them", {'result' : 'captured', 'site' : site}, feed['capture']['processed']),
+            ('birdhouse_frames_total', 'counter', "Frames by what happened to them", {'result' : 'analysed', 'site' : site}, feed['analysis']['processed']),
+            ('birdhouse_frames_total', 'counter', "Frames by what happened to them", {'result' : 'dropped', 'site' : site}, feed['capture']['dropped']),
+            ('birdhouse_frames_total', 'counter', "Frames by what happened to them", {'result' : 'skipped', 'site' : site}, self.motion.skipped),
+            ('birdhouse_frames_total', 'counter', "Frames by what happened to them", {'result' : 'suppressed', 'site' : site}, self.motion.suppressed),
+            ('birdhouse_frames_total', 'counter', "Frames by what happened to them", {'result' : 'annotated', 'site' : site}, self.annotated),
+            ('birdhouse_lighting_changes_total', 'counter', "Lighting changes ignored by the motion detector", {'site' : site}, self.motion.lighting_changes),
+            ('birdhouse_analyze_every', 'gauge', "Frames per analysed frame, raised while the scene is static", {'site' : site}, self.motion.stride),
+            ('birdhouse_ring_depth', 'gauge', "Frames waiting to be analysed", {'site' : site}, feed['capture']['depth']),
+            ('birdhouse_motion_events_total', 'counter', "Motion events started", {'site' : site}, motion['events']),
+            ('birdhouse_motion_detections_total', 'counter', "Motion rectangles detected", {'site' : site}, motion['detections']),
+            ('birdhouse_override_writes_total', 'counter', "Outlet override updates written", {'site' : site}, motion['override_writes']),
+            ('birdhouse_schedule_fired_total', 'counter', "Outlet schedules fired", {'site' : site}, self.scheduler.fired),
+            ('birdhouse_telemetry_written_total', 'counter', "Readings written to the database", {'site' : site}, self.telemetry.written),
+            ('birdhouse_telemetry_archived_total', 'counter', "Expired readings moved to the archive", {'site' : site}, self.telemetry.archived),
+            ('birdhouse_telemetry_buffered', 'gauge', "Readings waiting to be written", {'site' : site}, self.telemetry.buffered),
+            ('birdhouse_telemetry_dropped_total', 'counter', "Readings dropped while the database couldn't be written", {'site' : site}, self.telemetry.dropped),
+            ('birdhouse_dht22_staleness_seconds', 'gauge', "Seconds since the last good DHT22 reading", {'site' : site}, weather['staleness'])
+        ]
+        
+        for (status, count) in weather['errors'].items():
+            samples.append(('birdhouse_dht22_reads_failed_total', 'counter', "Failed DHT22 reads by cause", {'status' : status, 'site' : site}, count))
+        
+        for counter in ('bad_checksum', 'short_message', 'missing_message', 'sensor_resets'):
+            samples.append(('birdhouse_dht22_driver_errors_total', 'counter', "The DHT22 driver's own error counters", {'type' : counter, 'site' : site}, weather[counter]))
+        
+        for sampler in self.thermSamplers:
+            stats = sampler.stats()
+            samples.append(('birdhouse_ds18b20_errors_total', 'counter', "Failed DS18B20 reads", {'sensor' : sampler.name, 'site' : site}, stats['errors']))
+            samples.append(('birdhouse_ds18b20_staleness_seconds', 'gauge', "Seconds since the last good DS18B20 reading", {'sensor' : sampler.name, 'site' : site}, stats['staleness']))
+        
+        if self.stream is not None:
+            samples.append(('birdhouse_stream_clients', 'gauge', "Connected stream viewers", {'site' : site}, self.stream.clients))
+        
+        if self.clips is not None:
+            samples.append(('birdhouse_clips_total', 'counter', "Motion clips saved", {'site' : site}, self.clips.clips))
+        
+        samples.extend(self.controller.collectMetrics(site = site))
+        samples.extend(self.startup.samples(site = site))
+        
+        if self.processes is not None:
+            samples.extend(self.processes.collectMetrics(site = site))
+        
+        return samples
+    
+    def logStats(self):
+        logging.debug("%s frame stats: %s", self.name, self.feed.stats())
+        logging.debug("%s motion stats: %s", self.name, self.motionEvents.stats())
+        logging.debug("%s motion detector stats: %s", self.name, self.motion.stats())
+        
+        if self.processes is not None:
+            logging.debug("%s motion process stats: %s", self.name, self.processes.stats())
+        
+        logging.debug("%s outlet stats: %s", self.name, self.controller.stats())
+        
+        logging.debug("%s DHT22 stats: %s", self.name, self.weatherSampler.stats())
+        
+        if self.stream is not None:
+            logging.debug("%s stream stats: %s", self.name, self.stream.stats())
+        
+        if self.clips is not None:
+            logging.debug("%s clip stats: %s", self.name, self.clips.stats())
+        
+        for sampler in self.thermSamplers:
+            logging.debug("%s temperature sensor %s stats: %s", self.name, sampler.name, sampler.stats())
+    
+    def startProcesses(self):
+        """
+        Fork the motion workers, if there are any. Sites.run does this for
+        every site before it starts any thread, the workers inheriting no
+        lock a thread held at the fork. Does nothing the second time.
+        """
+        if self.processes is not None:
+            self.processes.start()
+    
+    def start(self):
+        """
+        Fork the motion workers, set the outlets to the state they were last
+        left in (their initial state if they never were) and start the
+        site's background threads
+        """
+        self.startProcesses()
+        self.startup.start()
+        
+        logging.info("Setting initial schedule state of %s", self.name)
+        
+        self.outlets.reload()
+        self.motionEvents.recover()
+        
+        now = datetime.datetime.now()
+        levels = {}
+        
+        for outlet in self.outlets.all():
+            if outlet.override_until is not None and outlet.override_until > now:
+                logging.debug("Outlet %d is overridden by motion until %s, switching it on", outlet.outlet_id, outlet.override_until)
+                level = 1
+            elif outlet.state is not None:
+                logging.debug("Restoring Outlet %d to %d", outlet.outlet_id, outlet.state)
+                level = outlet.state
+            else:
+                logging.debug("Initializing Outlet %d to %d", outlet.outlet_id, outlet.initial_state)
+                level = outlet.initial_state
             
-            if self.config['show_video']:
-                cv2.imshow("Birdhouse Feed", frame)
-                key = cv2.waitKey(1) & 0xFF
-                
-                if key == ord('q'):
-                    break
+            if level != outlet.state:
+                self.outlets.update([outlet.outlet_id], state = level)
             
-            self.processSchedule()
+            levels[outlet.outlet_id] = level
+        
+        self.controller.restore(levels)
+        
+        self.scheduler.start()
+        self.weatherSampler.start()
+        
+        if self.stream is not None:
+            self.stream.start()
+        
+        if self.clips is not None:
+            self.clips.start()
+        
+        for sampler in self.thermSamplers:
+            sampler.start()
+    
+    def stop(self):
+        """Stop the site's threads, what telemetry it has buffered is left to the writer"""
+        if self.stream is not None:
+            self.stream.stop()
+        
+        self.weatherSampler.stop()
+        
+        for sampler in self.thermSamplers:
+            sampler.stop()
+        
+        if self.processes is not None:
+            try:
+                self.handleAnswered(self.processes.drain())
+            except Exception:
+                logging.exception("Lost the motion of the frames still with the motion processes")
             
-            rawCapture.truncate(0)
-             
+            self.processes.stop()
+        
+        self.motionEvents.finish()
+        
+        if self.clips is not None:
+            self.clips.stop()
+        
+        self.scheduler.stop()
+        
+        # Analysis has stopped, this is the background it ended with
+        self.motion.save(final = True)
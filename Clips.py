@@ -0,0 +1,425 @@
+"""
+Motion triggered video clips.
+
+While clips are enabled the last `preroll` seconds of video are kept in
+memory. When a motion event starts, a clip is written from that pre-roll
+onwards until `postroll` seconds after the event ends. Another event
+starting during the post-roll continues the same clip. Each finished clip
+is recorded in the clips table, and once the clips add up to more than
+max_mb the oldest are deleted.
+
+On the Pi the camera's H.264 encoder does the work: PiCameraClipRecorder
+records into a PiCameraCircularIO on a second splitter port and splits the
+recording out to disk when an event starts. With any other frame source,
+FrameClipRecorder keeps the pre-roll as frames taken from the capture
+thread and encodes them with cv2.VideoWriter on its own thread.
+
+Either way the motion analysis thread only ever queues a command.
+"""
+
+import threading
+import logging
+import datetime
+import Queue
+import os
+
+import FrameSource
+
+def createTable(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS clips (clip_id INTEGER PRIMARY KEY, event_id INT, path TEXT, started_at timestamp, ended_at timestamp, frames INT, bytes INT)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS clips_started_at ON clips (started_at)''')
+
+class Clip:
+    def __init__(self, event_id, path, started_at):
+        self.event_id = event_id
+        self.path = path
+        self.started_at = started_at
+        self.ended_at = None
+        self.until = None
+        self.frames = 0
+
+class ClipRecorder:
+    """
+    Base class for the recorders. The motion event tracker calls
+    eventStarted() and eventFinished(), both of which must return quickly.
+    """
+
+    def __init__(self, sqlite, lock, config):
+        clips = config.get('clips', {})
+
+        self.sqlite = sqlite
+        self.lock = lock
+        self.directory = clips.get('directory', 'clips')
+        self.preroll = clips.get('preroll', 5)
+        self.postroll = datetime.timedelta(seconds = clips.get('postroll', 5))
+        self.max_bytes = clips.get('max_mb', 2048) * 1024 * 1024
+
+        self.clips = 0
+        self.evicted = 0
+        self.failed = 0
+
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def stats(self):
+        return {
+            'clips' : self.clips,
+            'evicted' : self.evicted,
+            'failed' : self.failed
+        }
+
+    def clipPath(self, started_at, extension):
+        directory = os.path.join(self.directory, started_at.strftime('%Y-%m'))
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        return os.path.join(directory, started_at.strftime('clip-%Y%m%d-%H%M%S') + extension)
+
+    def eventStarted(self, event_id, timestamp):
+        raise NotImplementedError()
+
+    def eventFinished(self, event_id, timestamp):
+        raise NotImplementedError()
+
+    def add(self, frame, timestamp):
+        """Called on the capture thread with every frame captured"""
+        pass
+
+    def store(self, clip):
+        """Record a finished clip, then evict the oldest clips over the size cap"""
+        size = os.path.getsize(clip.path)
+
+        with self.lock:
+            self.sqlite.execute("INSERT INTO clips (event_id, path, started_at, ended_at, frames, bytes) VALUES(?, ?, ?, ?, ?, ?)",
+                                (clip.event_id, clip.path, clip.started_at, clip.ended_at, clip.frames, size))
+
+        self.clips += 1
+
+        logging.info("Saved %d byte clip %s", size, clip.path)
+
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            c = self.sqlite.cursor()
+            (count, total) = c.execute("SELECT COUNT(*), SUM(bytes) FROM clips").fetchone()
+
+            # Never evict the most recent clip, however big it is
+            oldest = c.execute("SELECT clip_id, path, bytes FROM clips ORDER BY started_at LIMIT ?", (count - 1,)).fetchall() if total > self.max_bytes else []
+
+        for (clip_id, path, size) in oldest:
+            if total <= self.max_bytes:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                logging.warning("Could not delete clip %s", path)
+
+            with self.lock:
+                self.sqlite.execute("DELETE FROM clips WHERE clip_id = ?", (clip_id,))
+
+            total -= size or 0
+            self.evicted += 1
+
+            logging.debug("Evicted clip %s", path)
+
+    def start(self):
+        self.thread = threading.Thread(target = self.loop, name = 'clip-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+
+        if self.thread is not None:
+            self.thread.join(10)
+
+class FrameClipRecorder(ClipRecorder):
+    """
+    Records clips from the frames captured by the pipeline. The pre-roll is
+    a ring of frame copies (preallocated buffers are recycled once written).
+    Frames are handed to a writer thread, and if it falls more than
+    max_queue frames behind, new frames are dropped from the clip rather
+    than holding up capture. YUV frames are buffered as they are, at half
+    the size of BGR, and only converted by the writer thread.
+    """
+
+    FALLBACK_FOURCC = ('mp4v', 'MJPG')
+
+    EXTENSIONS = {
+        'avc1' : '.mp4',
+        'H264' : '.mp4',
+        'X264' : '.mp4',
+        'mp4v' : '.mp4',
+        'MJPG' : '.avi',
+        'XVID' : '.avi'
+    }
+
+    def __init__(self, sqlite, lock, config):
+        ClipRecorder.__init__(self, sqlite, lock, config)
+
+        clips = config.get('clips', {})
+
+        self.fps = config['camera']['fps']
+        self.format = config['camera'].get('format', FrameSource.BGR)
+        self.bgr = None
+        self.fourcc = clips.get('fourcc', 'avc1')
+        self.max_queue = clips.get('max_queue', int(self.fps * self.preroll * 2) or 150)
+        self.window = datetime.timedelta(seconds = self.preroll)
+
+        self.buffer = []
+        self.free = []
+        self.clip = None
+        self.stateLock = threading.Lock()
+        self.bufferLock = threading.Lock()
+        self.queue = Queue.Queue()
+
+        self.dropped = 0
+
+    def stats(self):
+        stats = ClipRecorder.stats(self)
+        stats['dropped'] = self.dropped
+        stats['queued'] = self.queue.qsize()
+
+        return stats
+
+    def slot(self, frame):
+        import numpy
+
+        with self.bufferLock:
+            slot = self.free.pop() if self.free else None
+
+        if slot is None or slot.shape != frame.shape:
+            slot = numpy.empty_like(frame)
+
+        numpy.copyto(slot, frame)
+
+        return slot
+
+    def release(self, slot):
+        with self.bufferLock:
+            self.free.append(slot)
+
+    def add(self, frame, timestamp):
+        with self.stateLock:
+            clip = self.clip
+
+            if clip is None:
+                # Keep the pre-roll window, recycling the buffers that fall out of it
+                while self.buffer and self.buffer[0][0] < timestamp - self.window:
+                    self.release(self.buffer.pop(0)[1])
+
+                self.buffer.append((timestamp, self.slot(frame)))
+                return
+
+            if clip.until is not None and timestamp > clip.until:
+                self.clip = None
+                self.queue.put(('close', clip))
+                return
+
+        if self.queue.qsize() >= self.max_queue:
+            self.dropped += 1
+            return
+
+        self.queue.put(('frame', timestamp, self.slot(frame)))
+
+    def eventStarted(self, event_id, timestamp):
+        with self.stateLock:
+            if self.clip is not None:
+                self.clip.until = None
+                return
+
+            (preroll, self.buffer) = (self.buffer, [])
+
+            clip = Clip(event_id, None, preroll[0][0] if preroll else timestamp)
+            self.queue.put(('open', clip))
+
+            for (ts, slot) in preroll:
+                self.queue.put(('frame', ts, slot))
+
+            self.clip = clip
+
+    def eventFinished(self, event_id, timestamp):
+        with self.stateLock:
+            if self.clip is not None:
+                self.clip.until = timestamp + self.postroll
+
+    def open(self, clip, shape):
+        import cv2
+
+        (height, width) = shape[:2]
+
+        for fourcc in (self.fourcc,) + self.FALLBACK_FOURCC:
+            path = self.clipPath(clip.started_at, self.EXTENSIONS.get(fourcc, '.avi'))
+            writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc), self.fps, (width, height))
+
+            if writer.isOpened():
+                if fourcc != self.fourcc:
+                    logging.debug("No %s encoder available, recording clips as %s", self.fourcc, fourcc)
+                    self.fourcc = fourcc
+
+                clip.path = path
+                return writer
+
+        raise IOError("No video encoder available for clips")
+
+    def loop(self):
+        (clip, writer) = (None, None)
+
+        while not (self.stopping.is_set() and self.queue.empty()):
+            try:
+                item = self.queue.get(timeout = 1)
+            except Queue.Empty:
+                if self.stopping.is_set() and clip is not None:
+                    # Shutting down mid clip, finish what was captured
+                    item = ('close', clip)
+                else:
+                    continue
+
+            try:
+                if item[0] == 'open':
+                    (clip, writer) = (item[1], None)
+                elif item[0] == 'frame':
+                    (_, timestamp, slot) = item
+
+                    if clip is not None:
+                        self.bgr = FrameSource.toBGR(slot, self.format, self.bgr)
+
+                        if writer is None:
+                            writer = self.open(clip, self.bgr.shape)
+
+                        writer.write(self.bgr)
+                        clip.frames += 1
+                        clip.ended_at = timestamp
+
+                    self.release(slot)
+                elif item[0] == 'close':
+                    if writer is not None:
+                        writer.release()
+                        self.store(clip)
+
+                    (clip, writer) = (None, None)
+            except Exception:
+                logging.exception("Failed to record clip")
+                self.failed += 1
+                (clip, writer) = (None, None)
+
+        if writer is not None:
+            writer.release()
+
+class PiCameraClipRecorder(ClipRecorder):
+    """
+    Records clips with the camera's hardware H.264 encoder. The camera
+    records continuously into a PiCameraCircularIO holding the pre-roll; on
+    an event the recording is split out to a file, and on the end of the
+    post-roll split back into the ring with the pre-roll prepended to the
+    file. Clips are raw H.264 streams (wrap them with MP4Box or ffmpeg for
+    players that need a container). Splits wait for the next key frame, so
+    they happen on the recorder thread.
+    """
+
+    SPLITTER_PORT = 2
+
+    def __init__(self, sqlite, lock, config, camera):
+        ClipRecorder.__init__(self, sqlite, lock, config)
+
+        clips = config.get('clips', {})
+
+        self.camera = camera
+        self.bitrate = clips.get('bitrate', 4000000)
+        self.commands = Queue.Queue()
+        self.ring = None
+
+    def eventStarted(self, event_id, timestamp):
+        self.commands.put(('start', event_id, timestamp))
+
+    def eventFinished(self, event_id, timestamp):
+        self.commands.put(('finish', event_id, timestamp))
+
+    def begin(self, event_id, timestamp):
+        clip = Clip(event_id, self.clipPath(timestamp, '.h264'), timestamp - datetime.timedelta(seconds = self.preroll))
+
+        self.camera.split_recording(clip.path + '.part', splitter_port = self.SPLITTER_PORT)
+        self.ring.copy_to(clip.path, seconds = self.preroll)
+        self.ring.clear()
+
+        return clip
+
+    def end(self, clip):
+        self.camera.split_recording(self.ring, splitter_port = self.SPLITTER_PORT)
+
+        # The pre-roll was written first, the rest of the clip follows it
+        with open(clip.path, 'ab') as output:
+            with open(clip.path + '.part', 'rb') as part:
+                while True:
+                    chunk = part.read(1024 * 1024)
+
+                    if not chunk:
+                        break
+
+                    output.write(chunk)
+
+        os.remove(clip.path + '.part')
+
+        clip.ended_at = datetime.datetime.now()
+        self.store(clip)
+
+    def loop(self):
+        import picamera
+
+        self.ring = picamera.PiCameraCircularIO(self.camera, seconds = self.preroll, bitrate = self.bitrate, splitter_port = self.SPLITTER_PORT)
+        self.camera.start_recording(self.ring, format = 'h264', bitrate = self.bitrate, splitter_port = self.SPLITTER_PORT)
+
+        clip = None
+
+        try:
+            while not self.stopping.is_set():
+                timeout = 1
+
+                if clip is not None and clip.until is not None:
+                    timeout = min(max((clip.until - datetime.datetime.now()).total_seconds(), 0), 1)
+
+                try:
+                    (command, event_id, timestamp) = self.commands.get(timeout = timeout)
+                except Queue.Empty:
+                    if clip is not None and clip.until is not None and datetime.datetime.now() >= clip.until:
+                        self.end(clip)
+                        clip = None
+
+                    continue
+
+                try:
+                    if command == 'start':
+                        if clip is None:
+                            clip = self.begin(event_id, timestamp)
+                        else:
+                            clip.until = None
+                    elif command == 'finish' and clip is not None:
+                        clip.until = timestamp + self.postroll
+                except Exception:
+                    logging.exception("Failed to record clip")
+                    self.failed += 1
+                    clip = None
+
+            if clip is not None:
+                self.end(clip)
+        finally:
+            try:
+                self.camera.stop_recording(splitter_port = self.SPLITTER_PORT)
+            except Exception:
+                # The pipeline may already have closed the camera
+                logging.debug("Clip recording already stopped")
+
+def create(sqlite, lock, config, source):
+    """The recorder suiting the frame source, or None if clips aren't enabled"""
+    if not config.get('clips', {}).get('enabled', False):
+        return None
+
+    camera = getattr(source, 'camera', None)
+
+    if camera is not None:
+        return PiCameraClipRecorder(sqlite, lock, config, camera)
+
+    return FrameClipRecorder(sqlite, lock, config)
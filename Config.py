@@ -0,0 +1,166 @@
+"""
+Loading and compiling birdhouse.json.
+
+The daemon is configured from a plain dict, which every component reads
+once when it is built or reconfigured. What the per-frame path needs is
+compiled into a Settings tuple, so the hot loop reads a few attributes of
+an immutable object instead of walking the dict on every frame, and a
+reload can swap the whole thing in one assignment.
+"""
+
+import collections
+import logging
+import Archive
+import json
+import os
+
+CONFIG_LOCATIONS = (os.curdir, os.path.expanduser('~'), '/etc/birdhouse/', os.environ.get('BIRDHOUSE_CONF'))
+
+# Settings a reload (SIGHUP) applies, changes to anything else only take
+# effect when the daemon is restarted
+RELOADABLE = (
+    'camera.rotate',
+    'camera.threshold',
+    'camera.min_area',
+    'camera.min_changed',
+    'camera.analysis_width',
+    'camera.analyze_every',
+    'camera.rois',
+    'camera.background',
+    'camera.lighting',
+    'camera.adaptive',
+    'show_video',
+    'loglevel',
+    'motion_timeout',
+    'motion',
+    'schedule',
+    'outlets'
+)
+
+Settings = collections.namedtuple('Settings', [
+    'rotate',           # Degrees the annotated frame is rotated by
+    'show_video',       # Show the annotated frame with cv2.imshow
+    'loglevel'          # A logging module level
+])
+
+def locate():
+    """Return the path of the first birdhouse.json in the usual locations, or None"""
+    for cloc in CONFIG_LOCATIONS:
+        if cloc is not None:
+            path = os.path.join(cloc, "birdhouse.json")
+
+            if os.path.isfile(path):
+                return path
+
+    return None
+
+def load(path):
+    with open(path) as source:
+        return json.load(source)
+
+def logLevel(config):
+    """The logging module level of the config's loglevel, raising ValueError if it is invalid"""
+    level = getattr(logging, str(config['loglevel']).upper(), None)
+
+    if not isinstance(level, int):
+        raise ValueError('Invalid Log Level: %s' % config['loglevel'])
+
+    return level
+
+def compileSettings(config):
+    """Build the Settings for a config dict, raising ValueError if they are invalid"""
+    return Settings(
+        rotate = int(config['camera']['rotate']),
+        show_video = bool(config['show_video']),
+        loglevel = logLevel(config)
+    )
+
+def merge(base, overrides):
+    """base with overrides laid over it, nested dicts being merged key by key"""
+    merged = dict(base)
+
+    for (key, value) in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = value
+
+    return merged
+
+def sites(config):
+    """
+    The config of each site as a list of (name, config). Every entry of the
+    sites list is laid over the rest of the config, without one the whole
+    config is a single site.
+
+    A site not naming its own sqlite_db gets one named after it next to the
+    shared one, and likewise its own archive.directory and clips.directory.
+    A site not naming its own stream.port streams on the shared one plus its
+    place in the list. Raises ValueError if two sites have the same name, or
+    would share an archive directory, clips directory or stream port.
+    """
+    base = dict((key, value) for (key, value) in config.items() if key != 'sites')
+
+    if not config.get('sites'):
+        return [(str(base.get('name', 'birdhouse')), base)]
+
+    result = []
+
+    for (i, overrides) in enumerate(config['sites']):
+        name = str(overrides.get('name', 'site%d' % (i + 1)))
+
+        site = merge(base, overrides)
+        site['name'] = name
+
+        if 'sqlite_db' not in overrides:
+            (root, ext) = os.path.splitext(base['sqlite_db'])
+            site['sqlite_db'] = '%s-%s%s' % (root, name, ext)
+
+        # Without a directory of its own the archive is named after the site's database already
+        if site.get('archive', {}).get('directory') and 'directory' not in overrides.get('archive', {}):
+            site['archive'] = dict(site['archive'], directory = siteDirectory(site['archive']['directory'], name))
+
+        if 'clips' in site and 'directory' not in overrides.get('clips', {}):
+            site['clips'] = dict(site['clips'], directory = siteDirectory(site['clips'].get('directory', 'clips'), name))
+
+        # Port 0 picks a free port for each site anyway
+        if 'stream' in site and site['stream'].get('port', 8080) and 'port' not in overrides.get('stream', {}):
+            site['stream'] = dict(site['stream'], port = site['stream'].get('port', 8080) + i)
+
+        result.append((name, site))
+
+    unique('Site names', [name for (name, site) in result])
+    unique('Site archive directories', [Archive.directory(site) for (name, site) in result if site.get('archive', {}).get('enabled')])
+    unique('Site clips directories', [site['clips'].get('directory', 'clips') for (name, site) in result if site.get('clips', {}).get('enabled')])
+    unique('Site stream ports', [str(site['stream'].get('port', 8080)) for (name, site) in result if site.get('stream', {}).get('enabled') and site['stream'].get('port', 8080)])
+
+    return result
+
+def siteDirectory(directory, name):
+    """A site's own directory next to the shared one, e.g. clips-oak"""
+    return '%s-%s' % (directory.rstrip(os.sep), name)
+
+def unique(what, values):
+    """Raise ValueError if any of the values is repeated"""
+    if len(set(values)) != len(values):
+        raise ValueError('%s must be unique: %s' % (what, ', '.join(values)))
+
+def flatten(config, prefix = ''):
+    """Map every leaf setting to its dotted key, e.g. {'camera.rotate' : 180}"""
+    flat = {}
+
+    for (key, value) in config.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+
+    return flat
+
+def restartRequired(old, new):
+    """The settings differing between two configs that a reload can't apply"""
+    (old, new) = (flatten(old), flatten(new))
+
+    changed = [key for key in set(old) | set(new) if old.get(key) != new.get(key)]
+
+    return sorted(key for key in changed if not any(key == r or key.startswith(r + '.') for r in RELOADABLE))
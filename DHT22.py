@@ -1,7 +1,17 @@
 import time
 import atexit
 
-import pigpio
+try:
+   import pigpio
+except ImportError:
+   # Off the Pi, the simulated pigpio provides the same constants and tickDiff
+   import Simulator as pigpio
+
+# Reading outcomes passed to the reading callback.
+OK = 0
+BAD_CHECKSUM = 1
+SHORT_MESSAGE = 2
+MISSING_MESSAGE = 3
 
 class sensor:
    """
@@ -73,6 +83,11 @@ class sensor:
 
       self.tov = None
 
+      # Called as reading(status, humidity, temperature) when a triggered
+      # reading completes, status being one of OK, BAD_CHECKSUM,
+      # SHORT_MESSAGE or MISSING_MESSAGE. Runs on the pigpio callback thread.
+      self.reading = None
+
       self.high_tick = 0
       self.bit = 40
 
@@ -133,10 +148,14 @@ class sensor:
                   if self.LED is not None:
                      self.pi.write(self.LED, 0)
 
+                  self._done(OK)
+
                else:
 
                   self.bad_CS += 1
 
+                  self._done(BAD_CHECKSUM)
+
          elif self.bit >=24: # in temp low byte
             self.tL = (self.tL<<1) + val
 
@@ -168,6 +187,7 @@ class sensor:
          self.pi.set_watchdog(self.gpio, 0)
          if self.bit < 8:       # Too few data bits received.
             self.bad_MM += 1    # Bump missing message count.
+            self._done(MISSING_MESSAGE)
             self.no_response += 1
             if self.no_response > self.MAX_NO_RESPONSE:
                self.no_response = 0
@@ -181,11 +201,17 @@ class sensor:
                   self.powered = True
          elif self.bit < 39:    # Short message receieved.
             self.bad_SM += 1    # Bump short message count.
+            self._done(SHORT_MESSAGE)
             self.no_response = 0
 
          else:                  # Full message received.
             self.no_response = 0
 
+   def _done(self, status):
+      """Report a completed reading to the reading callback, if any."""
+      if self.reading is not None:
+         self.reading(status, self.rhum, self.temp)
+
    def temperatureF(self):
        """Return current temperature in F"""
        return ((self.temp * 9) / 5) + 32
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
  
 import sys, os, time, atexit
-from signal import SIGTERM
+from signal import SIGTERM, SIGHUP
  
 class Daemon:
         """
@@ -122,6 +122,24 @@ class Daemon:
                 self.stop()
                 self.start()
  
+        def reload(self):
+                """
+                Ask the running daemon to reload its configuration
+                """
+                try:
+                        pf = file(self.pidfile,'r')
+                        pid = int(pf.read().strip())
+                        pf.close()
+                except IOError:
+                        pid = None
+ 
+                if not pid:
+                        message = "pidfile %s does not exist. Daemon not running?\n"
+                        sys.stderr.write(message % self.pidfile)
+                        sys.exit(1)
+ 
+                os.kill(pid, SIGHUP)
+ 
         def run(self):
                 """
                 You should override this method when you subclass Daemon. It will be called after the process has been
@@ -0,0 +1,294 @@
+import time
+import logging
+
+# Frame layouts, chosen with camera.format. YUV frames are planar I420 of
+# shape (height * 3 / 2, width): the full resolution Y plane followed by
+# the quarter resolution U and V planes.
+BGR = 'bgr'
+YUV = 'yuv'
+
+def size(shape, format):
+    """The (height, width) of the image a frame of this shape and format holds"""
+    if format == YUV:
+        return (shape[0] * 2 // 3, shape[1])
+
+    return shape[:2]
+
+def padded(resolution):
+    """The (width, height) picamera delivers YUV frames of this resolution in, padded to 32x16"""
+    (width, height) = resolution
+
+    return ((width + 31) // 32 * 32, (height + 15) // 16 * 16)
+
+def frameBytes(resolution, format):
+    """The most bytes a frame of this resolution and format takes, padding included"""
+    if format == YUV:
+        (width, height) = padded(resolution)
+
+        return height * 3 // 2 * width
+
+    (width, height) = resolution
+
+    return height * width * 3
+
+def luma(frame):
+    """The Y plane of a YUV frame (a view, nothing is copied), usable as grayscale"""
+    return frame[:frame.shape[0] * 2 // 3]
+
+def toBGR(frame, format, dst = None):
+    """A frame as BGR, converted into dst if given. BGR frames are returned as they are."""
+    if format != YUV:
+        return frame
+
+    import cv2
+
+    return cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_I420, dst)
+
+class FrameSource:
+    """
+    Base class for anything that can feed frames into the capture pipeline.
+
+    Subclasses implement frames(), a generator yielding numpy arrays in the
+    layout named by `format`: BGR, or with camera.format set to "yuv" I420
+    (see YUV). The yielded array may be reused by the source for the next
+    frame, so consumers that keep a frame around must copy it.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.resolution = tuple(config['camera']['resolution'])
+        self.fps = config['camera']['fps']
+        self.format = config['camera'].get('format', BGR)
+        self.converted = None
+
+        if self.format not in (BGR, YUV):
+            raise ValueError('Invalid frame format: %s' % self.format)
+
+    def convert(self, frame):
+        """Deliver a BGR frame in the configured format, converting into a reused buffer"""
+        if self.format != YUV:
+            return frame
+
+        import cv2
+
+        self.converted = cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420, self.converted)
+
+        return self.converted
+
+    def frames(self):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+class YUVOutput:
+    """
+    A picamera output collecting raw YUV captures straight into one
+    preallocated array. The camera pads the width to a multiple of 32 and
+    the height to a multiple of 16, so do the frames.
+    """
+
+    def __init__(self, resolution):
+        import numpy
+
+        (width, height) = padded(resolution)
+
+        self.array = numpy.empty((height * 3 // 2, width), dtype = numpy.uint8)
+        self.flat = self.array.reshape(-1)
+        self.offset = 0
+
+    def write(self, data):
+        import numpy
+
+        end = min(self.offset + len(data), len(self.flat))
+        self.flat[self.offset:end] = numpy.frombuffer(data, dtype = numpy.uint8, count = end - self.offset)
+        self.offset = end
+
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def rewind(self):
+        self.offset = 0
+
+class PiCameraSource(FrameSource):
+    """
+    Frames from the Raspberry Pi camera module through the video port. In
+    YUV format the camera's own output is used as it is, so the capture
+    thread does no colour conversion at all.
+    """
+
+    def __init__(self, config):
+        FrameSource.__init__(self, config)
+
+        from picamera import PiCamera
+
+        self.camera = PiCamera()
+        self.camera.resolution = self.resolution
+        self.camera.framerate = self.fps
+
+    def frames(self):
+        from picamera.array import PiRGBArray
+
+        if self.format == YUV:
+            output = YUVOutput(self.resolution)
+
+            for f in self.camera.capture_continuous(output, format = "yuv", use_video_port = True):
+                yield output.array
+                output.rewind()
+
+            return
+
+        rawCapture = PiRGBArray(self.camera, size = self.resolution)
+
+        for f in self.camera.capture_continuous(rawCapture, format = "bgr", use_video_port = True):
+            yield f.array
+            rawCapture.truncate(0)
+
+    def close(self):
+        self.camera.close()
+
+class VideoFileSource(FrameSource):
+    """
+    Frames replayed from a recorded clip. When realtime is enabled frames are
+    paced at the configured fps, otherwise they are delivered as fast as they
+    can be decoded (useful for benchmarking).
+    """
+
+    def __init__(self, config):
+        FrameSource.__init__(self, config)
+        self.path = config['camera']['video_file']
+        self.loop = config['camera'].get('loop', False)
+        self.realtime = config['camera'].get('realtime', True)
+
+    def frames(self):
+        import cv2
+
+        while True:
+            capture = cv2.VideoCapture(self.path)
+
+            if not capture.isOpened():
+                raise IOError("Could not open video file %s" % self.path)
+
+            pacer = Pacer(self.fps if self.realtime else None)
+
+            while True:
+                (grabbed, frame) = capture.read()
+
+                if not grabbed:
+                    break
+
+                pacer.wait()
+                yield self.convert(frame)
+
+            capture.release()
+
+            if not self.loop:
+                return
+
+            logging.debug("Reached end of %s, looping", self.path)
+
+class SyntheticSource(FrameSource):
+    """
+    Generated frames: a noisy static background that a square periodically
+    moves across. Needs nothing but numpy, so the pipeline can be exercised
+    anywhere.
+    """
+
+    def __init__(self, config):
+        FrameSource.__init__(self, config)
+        self.count = config['camera'].get('frames', None)
+        self.visit = config['camera'].get('visit_frames', 50)
+        self.realtime = config['camera'].get('realtime', True)
+
+    def frames(self):
+        import numpy
+
+        (width, height) = self.resolution
+        background = numpy.random.RandomState(0).randint(0, 32, (height, width, 3)).astype(numpy.uint8)
+        frame = numpy.empty_like(background)
+        size = max(height // 6, 1)
+        pacer = Pacer(self.fps if self.realtime else None)
+        n = 0
+
+        while self.count is None or n < self.count:
+            numpy.copyto(frame, background)
+
+            # Visits of `visit` frames separated by twice as long of empty scene
+            if n % (self.visit * 3) < self.visit:
+                x = (n % (self.visit * 3)) * max(width - size, 1) // self.visit
+                y = (height - size) // 2
+                frame[y:y + size, x:x + size] = 255
+
+            pacer.wait()
+            yield self.convert(frame)
+            n += 1
+
+class ArraySource(FrameSource):
+    """
+    Frames from a numpy array of shape (frames, height, width, 3), either
+    handed over directly as `frames` or memory-mapped from the .npy file
+    named by camera.array_file.
+    """
+
+    def __init__(self, config, frames = None):
+        FrameSource.__init__(self, config)
+        self.array = frames
+        self.loop = config['camera'].get('loop', False)
+        self.realtime = config['camera'].get('realtime', True)
+
+    def frames(self):
+        import numpy
+
+        if self.array is None:
+            self.array = numpy.load(self.config['camera']['array_file'], mmap_mode = 'r')
+
+        pacer = Pacer(self.fps if self.realtime else None)
+
+        while True:
+            for frame in self.array:
+                pacer.wait()
+                yield self.convert(frame)
+
+            if not self.loop:
+                return
+
+class Pacer:
+    """Sleeps between frames to hold a source to a target frame rate"""
+
+    def __init__(self, fps):
+        self.interval = (1.0 / fps) if fps else None
+        self.next = None
+
+    def wait(self):
+        if self.interval is None:
+            return
+
+        now = time.time()
+
+        if self.next is None:
+            self.next = now
+        elif self.next > now:
+            time.sleep(self.next - now)
+        else:
+            # Fell behind, don't try to catch up with a burst of frames
+            self.next = now
+
+        self.next += self.interval
+
+SOURCES = {
+    'picamera' : PiCameraSource,
+    'video' : VideoFileSource,
+    'synthetic' : SyntheticSource,
+    'array' : ArraySource
+}
+
+def create(config):
+    """Build the frame source named by camera.source (defaults to the Pi camera)"""
+    name = config['camera'].get('source', 'picamera')
+
+    if name not in SOURCES:
+        raise ValueError('Invalid frame source: %s' % name)
+
+    return SOURCES[name](config)
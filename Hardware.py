@@ -0,0 +1,76 @@
+"""
+Hardware backends for the birdhouse.
+
+The backend named by the top level `hardware` config key provides the gpio
+interface (pi), the frame source, the DHT22 and the DS18B20. The "pi"
+backend talks to the real devices, "simulated" uses the stand-ins from
+Simulator together with whichever video, array or synthetic frame source
+the camera section asks for.
+
+Once the gpio interface is up the devices are opened together (see
+Startup.parallel), the DHT22 alone waits 2s after being powered.
+"""
+
+import FrameSource
+import Startup
+import DHT22
+
+# Units accepted by get_temperature(), the same values W1ThermSensor uses
+DEGREES_C = 0x01
+DEGREES_F = 0x02
+
+class Backend:
+    """
+    ds18b20 is the water temperature probe, w1_sensors maps the names of any
+    further 1-wire probes listed under the w1_sensors config key to their
+    sensor objects.
+    """
+
+    def __init__(self, pi, source, dht22, ds18b20, w1_sensors):
+        self.pi = pi
+        self.source = source
+        self.dht22 = dht22
+        self.ds18b20 = ds18b20
+        self.w1_sensors = w1_sensors
+
+def piBackend(config):
+    from w1thermsensor import W1ThermSensor
+    import pigpio
+
+    pi = pigpio.pi()
+
+    (source, dht22, ds18b20, w1_sensors) = Startup.parallel([
+        lambda: FrameSource.create(config),
+        lambda: DHT22.sensor(pi, config['dht22']['gpio'], None, power = config['dht22']['power']),
+        lambda: W1ThermSensor(W1ThermSensor.THERM_SENSOR_DS18B20, config['ds18b20']['id']),
+        lambda: dict((s['name'], W1ThermSensor(W1ThermSensor.THERM_SENSOR_DS18B20, s['id'])) for s in config.get('w1_sensors', []))
+    ])
+
+    return Backend(pi, source, dht22, ds18b20, w1_sensors)
+
+def simulatedBackend(config):
+    import Simulator
+
+    pi = Simulator.pi(config)
+
+    (source, dht22, ds18b20, w1_sensors) = Startup.parallel([
+        lambda: FrameSource.create(config),
+        lambda: DHT22.sensor(pi, config['dht22']['gpio'], None, power = config['dht22']['power']),
+        lambda: Simulator.ThermSensor(config, config['ds18b20']['id']),
+        lambda: dict((s['name'], Simulator.ThermSensor(config, s['id'])) for s in config.get('w1_sensors', []))
+    ])
+
+    return Backend(pi, source, dht22, ds18b20, w1_sensors)
+
+BACKENDS = {
+    'pi' : piBackend,
+    'simulated' : simulatedBackend
+}
+
+def create(config):
+    name = config.get('hardware', 'pi')
+
+    if name not in BACKENDS:
+        raise ValueError('Invalid hardware backend: %s' % name)
+
+    return BACKENDS[name](config)
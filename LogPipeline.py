@@ -0,0 +1,288 @@
+"""
+Getting log records off the frame path.
+
+With logging.basicConfig every record is formatted, written and flushed by
+the thread that logs it, so a debug line costs a frame a file write and a
+slow SD card stalls analysis. configure() instead hangs a QueueHandler off
+the root logger, which only appends the record, unformatted, to a bounded
+queue. A listener thread drains the queue every flush_interval and formats
+and writes the records, rotating the log file by size.
+
+Repeats are aggregated by the listener: past `burst` records from one call
+site (logger, level and message template) within `window` seconds the rest
+are counted instead of written, and once the window closes one record says
+how many there were:
+
+    Motion detected x143 in 10s
+
+The level and file are still the loglevel and logfile keys (no logfile logs
+to stderr), the "log" section tunes the rest:
+
+    max_mb         - size the log file is rotated at, 0 to let it grow
+    backups        - rotated files kept (birdhouse.log.1, ...)
+    window, burst  - the aggregation above, a burst of 0 turns it off
+    queue_size     - records waiting for the listener beyond which new ones
+                     are dropped (and counted)
+    flush_interval - seconds between the listener's passes
+
+Records are formatted after the fact, so log with arguments rather than
+formatting the message yourself (that is what makes a disabled debug line
+cheap), and don't change an argument after logging it.
+"""
+
+import logging.handlers
+import collections
+import threading
+import logging
+import time
+import os
+
+import Config
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+class RateLimiter:
+    """
+    Lets `burst` records per call site through each `window` seconds and
+    counts the rest, whose summaries are returned once the window closes.
+    """
+
+    def __init__(self, window, burst):
+        self.window = window
+        self.burst = burst
+        self.sites = {}
+        self.suppressed = 0
+
+    def summary(self, site, now):
+        (started, count, record) = site
+
+        summary = logging.makeLogRecord(record.__dict__)
+        summary.msg = '%s x%d in %ds'
+        summary.args = (record.getMessage(), count, self.window)
+        summary.exc_info = None
+        summary.exc_text = None
+        summary.created = now
+        summary.msecs = (now - int(now)) * 1000
+
+        return summary
+
+    def filter(self, record):
+        """The records to write for this one: itself, nothing, or a closed window's summary first"""
+        if not self.burst:
+            return [record]
+
+        key = (record.name, record.levelno, record.pathname, record.lineno, record.msg)
+        site = self.sites.get(key)
+        records = []
+
+        if site is not None and record.created - site[0] >= self.window:
+            if site[1] > self.burst:
+                records.append(self.summary(site, record.created))
+
+            site = None
+
+        if site is None:
+            self.sites[key] = [record.created, 1, record]
+            records.append(record)
+            return records
+
+        site[1] += 1
+
+        if site[1] <= self.burst:
+            records.append(record)
+        else:
+            self.suppressed += 1
+
+        return records
+
+    def expired(self, now, all = False):
+        """Summaries of the windows that have closed (or all of them), which are forgotten"""
+        summaries = []
+
+        for (key, site) in self.sites.items():
+            if all or now - site[0] >= self.window:
+                del self.sites[key]
+
+                if site[1] > self.burst:
+                    summaries.append(self.summary(site, now))
+
+        return summaries
+
+class QueueListener:
+    """Writes the queued records from its own thread"""
+
+    def __init__(self, config):
+        log = config.get('log', {})
+
+        self.logfile = config.get('logfile')
+        self.max_bytes = int(log.get('max_mb', 10) * 1024 * 1024)
+        self.backups = log.get('backups', 3)
+        self.size = log.get('queue_size', 10000)
+        self.interval = log.get('flush_interval', 0.2)
+        self.limiter = RateLimiter(log.get('window', 10), log.get('burst', 5))
+
+        self.records = collections.deque()
+        self.handler = None
+        self.thread = None
+        self.stopping = None
+        self.pid = None
+        self.starting = threading.Lock()
+
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self.reported = 0
+
+    def createHandler(self):
+        if self.logfile is None:
+            handler = logging.StreamHandler()
+        else:
+            handler = logging.handlers.RotatingFileHandler(self.logfile, maxBytes = self.max_bytes, backupCount = self.backups)
+
+        handler.setFormatter(logging.Formatter(FORMAT))
+
+        return handler
+
+    def stats(self):
+        return {
+            'queued' : self.queued,
+            'written' : self.written,
+            'suppressed' : self.limiter.suppressed,
+            'dropped' : self.dropped,
+            'waiting' : len(self.records)
+        }
+
+    def enqueue(self, record):
+        if self.pid != os.getpid():
+            with self.starting:
+                if self.pid != os.getpid():
+                    self.start()
+
+        if len(self.records) >= self.size:
+            self.dropped += 1
+            return
+
+        self.queued += 1
+        self.records.append(record)
+
+    def write(self, record):
+        try:
+            self.handler.handle(record)
+            self.written += 1
+        except Exception:
+            self.handler.handleError(record)
+
+    def drain(self, now, final = False):
+        while self.records:
+            record = self.records.popleft()
+
+            try:
+                records = self.limiter.filter(record)
+            except Exception:
+                records = [record]
+
+            for record in records:
+                self.write(record)
+
+        for record in self.limiter.expired(now, final):
+            self.write(record)
+
+        if self.dropped != self.reported:
+            self.write(logging.makeLogRecord({
+                'name' : __name__,
+                'levelno' : logging.WARNING,
+                'levelname' : 'WARNING',
+                'msg' : "Dropped %d log record(s), the log listener fell behind",
+                'args' : (self.dropped - self.reported,)
+            }))
+
+            self.reported = self.dropped
+
+    def run(self, stopping):
+        while not stopping.wait(self.interval):
+            self.drain(time.time())
+
+    def start(self):
+        """
+        Start the listener, or after a fork start the child's own: the
+        parent's thread didn't come across and its records are the parent's
+        to write.
+        """
+        if self.pid is not None:
+            self.records.clear()
+
+        self.pid = os.getpid()
+        self.handler = self.createHandler()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target = self.run, args = (self.stopping,), name = 'log')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the thread and write out whatever is left, including pending summaries"""
+        if self.pid != os.getpid():
+            return
+
+        self.stopping.set()
+        self.thread.join(5)
+        self.drain(time.time(), final = True)
+        self.handler.close()
+        self.pid = None
+
+class QueueHandler(logging.Handler):
+    """Hands records to a QueueListener as they are, without formatting them"""
+
+    def __init__(self, listener):
+        logging.Handler.__init__(self)
+        self.listener = listener
+
+    def handle(self, record):
+        # Appending to the deque is atomic, there is no need for the handler's lock
+        if not self.filter(record):
+            return False
+
+        self.listener.enqueue(record)
+        return True
+
+    def emit(self, record):
+        self.listener.enqueue(record)
+
+    def close(self):
+        self.listener.stop()
+        logging.Handler.close(self)
+
+def installed():
+    """The QueueHandler configure() put on the root logger, or None"""
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, QueueHandler):
+            return handler
+
+    return None
+
+def configure(config):
+    """
+    Log through the pipeline at the config's loglevel, in place of
+    logging.basicConfig. Like it, does nothing if already configured (a
+    reload sets the level itself), returns the QueueHandler.
+    """
+    handler = installed()
+
+    if handler is None:
+        root = logging.getLogger()
+        root.setLevel(Config.logLevel(config))
+
+        handler = QueueHandler(QueueListener(config))
+        root.addHandler(handler)
+
+    return handler
+
+def collectMetrics():
+    handler = installed()
+
+    if handler is None:
+        return []
+
+    stats = handler.listener.stats()
+
+    return [('birdhouse_log_records_total', 'counter', "Log records by what became of them", {'result' : result}, stats[result])
+            for result in ('written', 'suppressed', 'dropped')]
@@ -0,0 +1,225 @@
+import BaseHTTPServer
+import collections
+import threading
+import logging
+import bisect
+
+class LatencyWindow:
+    """Keeps the last `size` latency samples (seconds) for percentile reporting"""
+
+    def __init__(self, size = 256):
+        self.size = size
+        self.samples = []
+        self.index = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            if len(self.samples) < self.size:
+                self.samples.append(seconds)
+            else:
+                self.samples[self.index] = seconds
+
+            self.index = (self.index + 1) % self.size
+            self.count += 1
+
+    def percentiles(self, points = (50, 90, 99)):
+        """Return {point : seconds} over the window, empty if nothing was recorded"""
+        with self.lock:
+            ordered = sorted(self.samples)
+
+        if not ordered:
+            return {}
+
+        return dict((p, ordered[min(int(len(ordered) * p / 100.0), len(ordered) - 1)]) for p in points)
+
+    def snapshot(self):
+        """Percentiles and max in milliseconds, for logging"""
+        result = dict(('p%d' % p, round(v * 1000, 1)) for (p, v) in self.percentiles().items())
+
+        with self.lock:
+            if self.samples:
+                result['max'] = round(max(self.samples) * 1000, 1)
+
+            result['count'] = self.count
+
+        return result
+
+class Histogram:
+    """
+    Cumulative latency histogram (seconds) in the Prometheus style. observe()
+    is a bisect and three adds under a lock, so the metrics server thread
+    reading a snapshot() never sees a count that disagrees with the buckets.
+    """
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, buckets = BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        i = bisect.bisect_left(self.buckets, seconds)
+
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def snapshot(self):
+        """(counts, sum, count) as of one moment"""
+        with self.lock:
+            return (list(self.counts), self.sum, self.count)
+
+    def restore(self, counts, total, count):
+        """Replace the observations with a snapshot() (or several added up)"""
+        with self.lock:
+            (self.counts, self.sum, self.count) = (list(counts), total, count)
+
+    def cumulative(self, counts = None):
+        """[(upper bound, observations at or below it)], ending with +Inf"""
+        if counts is None:
+            counts = self.snapshot()[0]
+
+        total = 0
+        result = []
+
+        for (bound, n) in zip(self.buckets + (float('inf'),), counts):
+            total += n
+            result.append((bound, total))
+
+        return result
+
+def formatLabels(labels):
+    if not labels:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for (k, v) in sorted(labels.items()))
+
+def formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    if isinstance(value, (int, long)):
+        return str(value)
+
+    return repr(float(value))
+
+class Registry:
+    """
+    The metrics exported on the metrics endpoint.
+
+    Histograms are registered once and observed directly by their owners.
+    Everything else is read when the endpoint is scraped, from collectors:
+    functions returning [(name, type, help, labels, value)] built from the
+    counters the components keep anyway, so none of it costs anything on
+    the frame path.
+    """
+
+    def __init__(self):
+        self.histograms = []
+        self.collectors = []
+
+    def histogram(self, name, help, histogram = None, **labels):
+        """Register (or create and register) a histogram, returns it"""
+        if histogram is None:
+            histogram = Histogram()
+
+        self.histograms.append((name, help, labels, histogram))
+
+        return histogram
+
+    def collector(self, collect):
+        self.collectors.append(collect)
+
+    def render(self):
+        families = collections.OrderedDict()
+
+        for collect in self.collectors:
+            try:
+                samples = collect()
+            except Exception:
+                logging.exception("Metrics collector failed")
+                continue
+
+            for (name, kind, help, labels, value) in samples:
+                if value is None:
+                    continue
+
+                family = families.setdefault(name, (kind, help, []))
+                family[2].append('%s%s %s' % (name, formatLabels(labels), formatValue(value)))
+
+        for (name, help, labels, histogram) in self.histograms:
+            family = families.setdefault(name, ('histogram', help, []))
+
+            (counts, total, count) = histogram.snapshot()
+
+            for (bound, n) in histogram.cumulative(counts):
+                bucketLabels = dict(labels, le = formatValue(bound))
+                family[2].append('%s_bucket%s %d' % (name, formatLabels(bucketLabels), n))
+
+            family[2].append('%s_sum%s %s' % (name, formatLabels(labels), formatValue(total)))
+            family[2].append('%s_count%s %d' % (name, formatLabels(labels), count))
+
+        lines = []
+
+        for (name, (kind, help, samples)) in families.items():
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.extend(samples)
+
+        return '\n'.join(lines) + '\n'
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.server.registry.render()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class MetricsServer:
+    """
+    Serves the registry as text on /metrics, configured by the metrics
+    section: bind (localhost by default) and port.
+    """
+
+    def __init__(self, registry, config):
+        metrics = config.get('metrics', {})
+
+        self.registry = registry
+        self.bind = metrics.get('bind', '127.0.0.1')
+        self.port = metrics.get('port', 9110)
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        self.server = BaseHTTPServer.HTTPServer((self.bind, self.port), MetricsHandler)
+        self.server.registry = self.registry
+
+        logging.info("Serving metrics on http://%s:%d/metrics", *self.server.server_address)
+
+        self.thread = threading.Thread(target = self.server.serve_forever, name = 'metrics')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+        if self.thread is not None:
+            self.thread.join(5)
@@ -0,0 +1,123 @@
+"""
+Versioned schema migrations for the birdhouse SQLite database.
+
+The schema version is kept in PRAGMA user_version. Every migration with a
+higher version than the database's runs in its own transaction together
+with the version bump, so a database is never left half migrated. Databases
+created before versioning report version 0 and are upgraded in place.
+"""
+
+import logging
+import Rollups
+import MotionEvents
+import Clips
+
+def baseline(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS outlets (outlet_id INT, name TEXT, schedule TEXT, override_until timestamp, last_ran timestamp, initial_state INT, schedule_active INT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS weather (recorded_at timestamp, humidity REAL, temperature REAL)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS water_temp(recorded_at timestamp, temperature REAL)''')
+
+def recordedAtIndexes(c):
+    c.execute('''CREATE INDEX IF NOT EXISTS weather_recorded_at ON weather (recorded_at)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS water_temp_recorded_at ON water_temp (recorded_at)''')
+
+def outletPrimaryKey(c):
+    # SQLite can't add a primary key to an existing table, so rebuild it. If
+    # an outlet_id was defined twice the most recently inserted row wins.
+    c.execute('''CREATE TABLE outlets_new (outlet_id INTEGER PRIMARY KEY, name TEXT, schedule TEXT, override_until timestamp, last_ran timestamp, initial_state INT, schedule_active INT)''')
+    c.execute('''INSERT OR REPLACE INTO outlets_new SELECT * FROM outlets WHERE outlet_id IS NOT NULL ORDER BY rowid''')
+    c.execute('''DROP TABLE outlets''')
+    c.execute('''ALTER TABLE outlets_new RENAME TO outlets''')
+
+def outletState(c):
+    c.execute('''ALTER TABLE outlets ADD COLUMN state INT''')
+
+MIGRATIONS = [
+    (1, "Create outlets, weather and water_temp tables", baseline),
+    (2, "Index weather and water_temp by recorded_at", recordedAtIndexes),
+    (3, "Make outlet_id the outlets primary key", outletPrimaryKey),
+    (4, "Create and fill the weather and water_temp rollups", Rollups.migrate),
+    (5, "Create the motion_events table", MotionEvents.createTable),
+    (6, "Create the clips table", Clips.createTable),
+    (7, "Record the level each outlet was last switched to", outletState)
+]
+
+TIME_SERIES = {
+    'weather' : "recorded_at timestamp, humidity REAL, temperature REAL",
+    'water_temp' : "recorded_at timestamp, temperature REAL"
+}
+
+def version(sqlite):
+    return sqlite.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate(sqlite, config = None):
+    """
+    Bring the database up to the latest schema version, then apply any
+    optional storage conversions enabled under the config's storage key.
+    The connection must be in autocommit mode (isolation_level = None).
+    Returns the resulting schema version.
+    """
+    current = version(sqlite)
+
+    for (target, description, migration) in MIGRATIONS:
+        if target <= current:
+            continue
+
+        logging.info("Migrating database to version %d: %s", target, description)
+
+        c = sqlite.cursor()
+        c.execute("BEGIN")
+
+        try:
+            migration(c)
+            c.execute("PRAGMA user_version = %d" % target)
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+
+        c.execute("COMMIT")
+
+        current = target
+
+    storage = (config or {}).get('storage', {})
+
+    if storage.get('without_rowid', False):
+        for table in TIME_SERIES:
+            convertWithoutRowid(sqlite, table)
+
+    return current
+
+def isWithoutRowid(sqlite, table):
+    row = sqlite.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+
+    return row is not None and 'WITHOUT ROWID' in row[0].upper()
+
+def convertWithoutRowid(sqlite, table):
+    """
+    Rebuild a time series table clustered on recorded_at (WITHOUT ROWID), so
+    range scans read rows in time order straight from the primary key b-tree
+    and the separate recorded_at index is no longer needed. Readings sharing
+    an identical timestamp are collapsed to one.
+
+    Timestamps keep their text form, the web UI compares them as strings.
+    """
+    if isWithoutRowid(sqlite, table):
+        return False
+
+    logging.info("Converting %s to a WITHOUT ROWID table", table)
+
+    c = sqlite.cursor()
+    c.execute("BEGIN")
+
+    try:
+        c.execute("CREATE TABLE %s_new (%s, PRIMARY KEY (recorded_at)) WITHOUT ROWID" % (table, TIME_SERIES[table]))
+        c.execute("INSERT OR IGNORE INTO %s_new SELECT * FROM %s WHERE recorded_at IS NOT NULL" % (table, table))
+        c.execute("DROP TABLE %s" % table)
+        c.execute("ALTER TABLE %s_new RENAME TO %s" % (table, table))
+    except Exception:
+        c.execute("ROLLBACK")
+        raise
+
+    c.execute("COMMIT")
+
+    return True
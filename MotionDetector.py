@@ -0,0 +1,522 @@
+import logging
+import numpy
+import math
+import cv2
+import time
+import os
+
+from Metrics import Histogram
+
+import FrameSource
+
+# Resolution the thresholds in the config were tuned at
+REFERENCE_WIDTH = 500.0
+
+class RunningAverage:
+    """
+    The original model: pixels further than `threshold` from a running
+    average of the scene, which follows the scene at `learning_rate`.
+    """
+
+    def __init__(self, camera, background):
+        self.threshold = background.get('threshold', camera['threshold'])
+        self.learning_rate = background.get('learning_rate', 0.5)
+        self.avg = None
+
+    def relearn(self, roi):
+        """Forget the scene and start again from this (blurred gray) region"""
+        if self.avg is not None and self.avg.shape == roi.shape:
+            self.avg[:] = roi
+            return
+
+        self.avg = roi.astype("float")
+        self.scaled = numpy.empty_like(roi)
+        self.delta = numpy.empty_like(roi)
+        self.mask = numpy.empty_like(roi)
+
+    def apply(self, roi):
+        """
+        Update the model with a region, returns its foreground mask (0 or
+        255). The mask is the model's own buffer, overwritten next time.
+        """
+        cv2.accumulateWeighted(roi, self.avg, self.learning_rate)
+
+        cv2.convertScaleAbs(self.avg, self.scaled)
+        cv2.absdiff(roi, self.scaled, self.delta)
+        cv2.threshold(self.delta, self.threshold, 255, cv2.THRESH_BINARY, self.mask)
+
+        return self.mask
+
+    def background(self):
+        """A copy of what the model takes the scene to be, for restore()"""
+        return self.avg.copy()
+
+    def restore(self, background):
+        self.relearn(background.astype(numpy.uint8))
+        self.avg[:] = background
+
+class MOG2:
+    """
+    OpenCV's Gaussian mixture model, better at swaying leaves and flickering
+    light than the running average at the cost of more CPU. threshold is its
+    variance threshold, learning_rate -1 lets it pick one from history.
+    """
+
+    # Frames a new model needs before its masks mean anything, and one
+    # restored from a saved background
+    WARMUP = 1
+    RESTORED_WARMUP = 0
+
+    def __init__(self, camera, background):
+        self.history = background.get('history', 500)
+        self.threshold = background.get('threshold', 16)
+        self.learning_rate = background.get('learning_rate', -1)
+        self.model = None
+        self.mask = None
+        self.warming = 0
+
+    def create(self):
+        return cv2.createBackgroundSubtractorMOG2(self.history, self.threshold, False)
+
+    def relearn(self, roi):
+        self.model = self.create()
+        self.mask = numpy.empty_like(roi)
+        self.model.apply(roi, self.mask, -1)
+        self.warming = self.WARMUP
+
+    def apply(self, roi):
+        self.model.apply(roi, self.mask, self.learning_rate)
+
+        if self.warming:
+            self.warming -= 1
+            self.mask[:] = 0
+
+        return self.mask
+
+    def background(self):
+        return self.model.getBackgroundImage()
+
+    def restore(self, background):
+        self.relearn(background)
+        self.warming = self.RESTORED_WARMUP
+
+class KNN(MOG2):
+    """OpenCV's k-nearest neighbours model, threshold is its squared distance threshold"""
+
+    # Every sample starts out as the one image, everything is foreground until it has seen a few frames
+    WARMUP = 4
+    RESTORED_WARMUP = 4
+
+    def __init__(self, camera, background):
+        MOG2.__init__(self, camera, background)
+        self.threshold = background.get('threshold', 400.0)
+
+    def create(self):
+        return cv2.createBackgroundSubtractorKNN(self.history, self.threshold, False)
+
+MODELS = {
+    'average' : RunningAverage,
+    'mog2' : MOG2,
+    'knn' : KNN
+}
+
+def changedBound(min_area):
+    """
+    The fewest changed pixels that can make a contour enclosing min_area. A
+    closed contour around that area is at least 2 * sqrt(pi * min_area)
+    long (a circle's). It runs along the border of the dilated mask, and two
+    3x3 dilations make each changed pixel a 5x5 square whose 16 border
+    pixels, each passed at most twice in steps of up to sqrt(2), account
+    for at most 32 * sqrt(2) of that length.
+    """
+    return 2 * math.sqrt(math.pi * min_area) / (32 * math.sqrt(2))
+
+class MotionDetector:
+    """
+    Background subtraction motion detector.
+
+    Frames are fed in one at a time through detect(), which returns the
+    bounding rectangles (in the coordinates of the frame passed in) of every
+    contour larger than the configured minimum area. Every intermediate
+    image lives in a buffer allocated when the frame size is first seen and
+    passed to OpenCV as the destination, so nothing the size of a frame is
+    allocated per frame.
+
+    The work can be cut down with these camera settings:
+
+    analysis_width - width frames are downscaled to before analysis. min_area
+                     and the blur size are scaled from the 500 pixel width
+                     they were originally tuned at.
+    rois           - list of [x, y, w, h] regions, as fractions of the frame,
+                     to restrict analysis to (e.g. the nest box entrance)
+    analyze_every  - only analyse every Nth frame
+    format         - "yuv" when the source delivers I420 frames, whose Y
+                     plane is used as the gray image without any conversion
+    min_changed    - skip the dilate and contour search when fewer pixels than
+                     this (in analysis pixels) differ from the background. The
+                     default, changedBound(min_area), is the fewest that can
+                     make a contour of min_area, so nothing is missed; only
+                     an all but still region is skipped. A larger value skips
+                     more often but can miss thin or hollow outlines, which
+                     enclose far more area than they change.
+
+    and these sections of it:
+
+    background - model: one of MODELS ("average" by default), with its
+                 threshold, learning_rate and (mog2 and knn) history. With
+                 persist the background is saved every persist_interval
+                 seconds and when the daemon stops, to path (by default
+                 named after the database), and a restarted daemon starts
+                 from it instead of from its first frame, unless it is
+                 older than max_age seconds or the frame size, regions or
+                 model have changed.
+    lighting   - a change in mean brightness of more than `jump` gray levels
+                 between analysed frames, or more than `max_changed` of the
+                 analysed pixels differing from the background at once, is
+                 taken for the light changing (a cloud, the lamps switching)
+                 rather than a bird. No motion is reported and the background
+                 is relearnt for `settle` seconds. lightingChanged() does the
+                 same when an outlet is known to have switched.
+
+                 The brightness is measured over the whole frame, the
+                 changed pixels only over the rois covering at least
+                 `min_roi` of it: a bird can fill a small roi (a nest
+                 entrance) as completely as a lighting change would. So in
+                 a small roi only a jump in the frame's brightness, or a
+                 hint, suppresses motion, and a change in the light there
+                 that doesn't show as one may be reported as motion. A
+                 min_roi of 0 applies max_changed to every roi again.
+    adaptive   - after `idle_frames` analysed frames without motion the gap
+                 between analysed frames doubles, up to every `max_every`th
+                 frame, and drops straight back to analyze_every on motion.
+                 A max_every no larger than analyze_every turns this off.
+    """
+
+    def __init__(self, config):
+        self.regions = None
+        self.shape = None
+        self.models = None
+        self.frames = 0
+        self.wait = 0
+        self.idle = 0
+        self.brightness = None
+        self.settle_until = 0
+        self.hinted = False
+
+        self.analysed = 0
+        self.skipped = 0
+        self.early_exits = 0
+        self.lighting_changes = 0
+        self.suppressed = 0
+        self.restores = 0
+
+        # The background as of the last persist_interval, taken on the
+        # analysis thread and written to disk by save() from another
+        self.snapshot = None
+        self.snapshotted = 0
+        self.saved = None
+        self.restored = None
+
+        # Per analysed frame, summed over the regions
+        self.blur_latency = Histogram()
+        self.contour_latency = Histogram()
+
+        self.configure(config)
+
+        if self.persist:
+            self.restored = self.load()
+
+    def configure(self, config):
+        """
+        Apply the camera settings. Also used on a reload, in which case the
+        regions (and the background model) are rebuilt on the next frame.
+        """
+        camera = config['camera']
+        background = camera.get('background', {})
+        lighting = camera.get('lighting', {})
+        adaptive = camera.get('adaptive', {})
+
+        self.width = camera.get('analysis_width', 500)
+        self.yuv = camera.get('format', FrameSource.BGR) == FrameSource.YUV
+        self.every = max(camera.get('analyze_every', 1), 1)
+        self.rois = camera.get('rois') or [[0, 0, 1, 1]]
+
+        scale = self.width / REFERENCE_WIDTH
+
+        self.min_area = camera['min_area'] * scale * scale
+        self.min_changed = camera.get('min_changed', changedBound(self.min_area))
+        self.blur = max(int(21 * scale) | 1, 3)
+
+        model = background.get('model', 'average')
+
+        if model not in MODELS:
+            raise ValueError('Invalid background model: %s' % model)
+
+        self.model = MODELS[model]
+        self.camera = camera
+        self.background = background
+
+        self.path = background.get('path') or (os.path.splitext(config['sqlite_db'])[0] + '-background.npz' if 'sqlite_db' in config else None)
+        self.persist = background.get('persist', False) and self.path is not None
+        self.persist_interval = background.get('persist_interval', 60)
+        self.max_age = background.get('max_age', 3600)
+
+        self.jump = lighting.get('jump', 20)
+        self.max_changed = lighting.get('max_changed', 0.6)
+        self.min_roi = lighting.get('min_roi', 0.25)
+        self.settle = lighting.get('settle', 1.0)
+
+        self.max_every = max(adaptive.get('max_every', 4), self.every)
+        self.idle_frames = adaptive.get('idle_frames', 50)
+        self.stride = self.every
+
+        self.regions = None
+
+    def reset(self):
+        """Discard the background model, it will be rebuilt from the next frame"""
+        self.models = None
+
+    def lightingChanged(self, *args):
+        """
+        The lighting is about to change (an outlet switched), ignore motion
+        until the background has settled. Safe to call from any thread.
+        """
+        self.hinted = True
+
+    def stats(self):
+        return {
+            'analysed' : self.analysed,
+            'skipped' : self.skipped,
+            'early_exits' : self.early_exits,
+            'lighting_changes' : self.lighting_changes,
+            'suppressed' : self.suppressed,
+            'restores' : self.restores,
+            'every' : self.stride
+        }
+
+    def setup(self, shape):
+        """Work out the analysis size, ROI pixel bounds and buffers for a frame shape"""
+        (height, width) = FrameSource.size(shape, FrameSource.YUV if self.yuv else FrameSource.BGR)
+
+        self.scale = self.width / float(width)
+        self.size = (self.width, max(int(height * self.scale), 1))
+        self.shape = shape
+        self.regions = []
+
+        for (x, y, w, h) in self.rois:
+            x0 = int(x * self.size[0])
+            y0 = int(y * self.size[1])
+            x1 = min(int((x + w) * self.size[0]), self.size[0])
+            y1 = min(int((y + h) * self.size[1]), self.size[1])
+
+            if x1 > x0 and y1 > y0:
+                self.regions.append((x0, y0, x1, y1))
+
+        # The regions large enough for max_changed to tell lighting from a bird
+        area = self.min_roi * self.size[0] * self.size[1]
+        self.lit = [i for (i, (x0, y0, x1, y1)) in enumerate(self.regions) if (x1 - x0) * (y1 - y0) >= area]
+        self.pixels = sum((x1 - x0) * (y1 - y0) for (x0, y0, x1, y1) in (self.regions[i] for i in self.lit))
+        self.models = None
+
+        self.small = numpy.empty((self.size[1], self.size[0], 3), dtype = numpy.uint8)
+        self.gray = numpy.empty((self.size[1], self.size[0]), dtype = numpy.uint8)
+        self.blurred = [numpy.empty((y1 - y0, x1 - x0), dtype = numpy.uint8) for (x0, y0, x1, y1) in self.regions]
+        self.dilated = [numpy.empty((y1 - y0, x1 - x0), dtype = numpy.uint8) for (x0, y0, x1, y1) in self.regions]
+
+    def relearn(self, rois):
+        for (model, roi) in zip(self.models, rois):
+            model.relearn(roi)
+
+    def capture(self, now):
+        return {
+            'saved_at' : now,
+            'model' : self.model.__name__,
+            'shape' : self.shape,
+            'regions' : list(self.regions),
+            'backgrounds' : [model.background() for model in self.models]
+        }
+
+    def save(self, final = False):
+        """
+        Write the latest snapshot of the background to path, if it hasn't
+        been already. Once analysis has stopped (final) the models are
+        captured as they are instead.
+        """
+        if not self.persist:
+            return
+
+        if final and self.models is not None:
+            self.snapshot = self.capture(time.time())
+
+        snapshot = self.snapshot
+
+        if snapshot is None or snapshot is self.saved:
+            return
+
+        arrays = dict(('region%d' % i, background) for (i, background) in enumerate(snapshot['backgrounds']))
+
+        # Written aside and renamed, a crash mid write leaves the last one
+        with open(self.path + '.tmp', 'wb') as output:
+            numpy.savez(output, saved_at = snapshot['saved_at'], model = snapshot['model'],
+                        shape = numpy.array(snapshot['shape']), regions = numpy.array(snapshot['regions']), **arrays)
+
+        os.rename(self.path + '.tmp', self.path)
+        self.saved = snapshot
+
+    def load(self):
+        """The snapshot saved at path, None if there isn't a readable one"""
+        if not os.path.exists(self.path):
+            return None
+
+        try:
+            saved = numpy.load(self.path)
+            regions = [tuple(region) for region in saved['regions'].tolist()]
+
+            return {
+                'saved_at' : float(saved['saved_at']),
+                'model' : str(saved['model']),
+                'shape' : tuple(saved['shape'].tolist()),
+                'regions' : regions,
+                'backgrounds' : [saved['region%d' % i] for i in range(len(regions))]
+            }
+        except Exception:
+            logging.warning("Ignoring the unreadable background model %s", self.path)
+            return None
+
+    def restore(self):
+        """Start the new models from the saved background if it fits, returns whether it did"""
+        (restored, self.restored) = (self.restored, None)
+
+        if restored is None:
+            return False
+
+        if restored['model'] != self.model.__name__ or restored['shape'] != self.shape or restored['regions'] != self.regions:
+            logging.info("Not restoring the background model, the camera settings have changed")
+            return False
+
+        age = time.time() - restored['saved_at']
+
+        if age > self.max_age:
+            logging.info("Not restoring the background model, it is %ds old", age)
+            return False
+
+        for (model, background) in zip(self.models, restored['backgrounds']):
+            model.restore(background)
+
+        self.restores += 1
+        logging.info("Restored the background model saved %ds ago", age)
+
+        return True
+
+    def pace(self, moving):
+        """Adapt the gap between analysed frames to whether anything is happening"""
+        if moving:
+            self.idle = 0
+            self.stride = self.every
+            return
+
+        self.idle += 1
+
+        if self.idle >= self.idle_frames and self.stride < self.max_every:
+            self.idle = 0
+            self.stride = min(self.stride * 2, self.max_every)
+
+    def detect(self, frame):
+        """
+        Returns a list of (x, y, w, h) motion rectangles, or None while the
+        background model is still being built. Skipped frames, and frames
+        while the lighting settles, report no motion.
+        """
+        self.frames += 1
+
+        if self.wait > 0:
+            self.wait -= 1
+            self.skipped += 1
+            return []
+
+        self.wait = self.stride - 1
+
+        if self.regions is None or frame.shape != self.shape:
+            self.setup(frame.shape)
+
+        self.analysed += 1
+
+        gray = self.gray
+
+        if self.yuv:
+            cv2.resize(FrameSource.luma(frame), self.size, gray, interpolation = cv2.INTER_AREA)
+        else:
+            cv2.resize(frame, self.size, self.small, interpolation = cv2.INTER_AREA)
+            cv2.cvtColor(self.small, cv2.COLOR_BGR2GRAY, gray)
+
+        started = time.time()
+        rois = [cv2.GaussianBlur(gray[y0:y1, x0:x1], (self.blur, self.blur), 0, self.blurred[i]) for (i, (x0, y0, x1, y1)) in enumerate(self.regions)]
+        blurred = time.time()
+
+        (brightness, self.brightness) = (self.brightness, cv2.mean(gray)[0])
+
+        if self.models is None:
+            self.models = [self.model(self.camera, self.background) for region in self.regions]
+
+            if not self.restore():
+                self.relearn(rois)
+                return None
+
+        now = time.time()
+
+        if self.hinted or (brightness is not None and abs(self.brightness - brightness) > self.jump):
+            self.hinted = False
+            self.lightingChange(now)
+
+        if now < self.settle_until:
+            self.relearn(rois)
+            self.suppressed += 1
+            return []
+
+        masks = [model.apply(roi) for (model, roi) in zip(self.models, rois)]
+        changed = [cv2.countNonZero(mask) for mask in masks]
+
+        if self.persist and now - self.snapshotted >= self.persist_interval:
+            self.snapshotted = now
+            self.snapshot = self.capture(now)
+
+        if self.lit and sum(changed[i] for i in self.lit) > self.max_changed * self.pixels:
+            self.lightingChange(now)
+            self.relearn(rois)
+            self.suppressed += 1
+            return []
+
+        rects = []
+
+        for (i, (x0, y0, x1, y1)) in enumerate(self.regions):
+            if changed[i] < self.min_changed:
+                self.early_exits += 1
+                continue
+
+            # findContours scribbles on its input, which is only a scratch buffer here
+            threshold = cv2.dilate(masks[i], None, self.dilated[i], iterations = 2)
+            cnts = cv2.findContours(threshold, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+
+            for c in cnts:
+                if cv2.contourArea(c) < self.min_area:
+                    continue
+
+                (x, y, w, h) = cv2.boundingRect(c)
+
+                rects.append((int((x + x0) / self.scale), int((y + y0) / self.scale), int(w / self.scale), int(h / self.scale)))
+
+        self.blur_latency.observe(blurred - started)
+        self.contour_latency.observe(time.time() - blurred)
+
+        self.pace(len(rects) > 0)
+
+        return rects
+
+    def lightingChange(self, now):
+        if now >= self.settle_until:
+            self.lighting_changes += 1
+            logging.debug("Lighting changed, ignoring motion for %.1fs", self.settle)
+
+        self.settle_until = now + self.settle
+        self.stride = self.every
+        self.idle = 0
@@ -0,0 +1,173 @@
+import logging
+import datetime
+
+def createTable(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS motion_events (event_id INTEGER PRIMARY KEY, started_at timestamp, ended_at timestamp, frames INT, peak_area INT, x INT, y INT, width INT, height INT)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS motion_events_started_at ON motion_events (started_at)''')
+
+class MotionEvent:
+    """A run of motion detections with no gap longer than the tracker's event_gap"""
+
+    def __init__(self, timestamp):
+        self.event_id = None
+        self.started_at = timestamp
+        self.last_seen = timestamp
+        self.ended_at = None
+        self.frames = 0
+        self.peak_area = 0
+        self.bounds = None
+
+    def add(self, rects, timestamp):
+        self.last_seen = timestamp
+        self.frames += 1
+
+        for (x, y, w, h) in rects:
+            self.peak_area = max(self.peak_area, w * h)
+
+            if self.bounds is None:
+                self.bounds = [x, y, x + w, y + h]
+            else:
+                self.bounds = [min(self.bounds[0], x), min(self.bounds[1], y), max(self.bounds[2], x + w), max(self.bounds[3], y + h)]
+
+    def box(self):
+        """Bounding box of every detection in the event as (x, y, w, h)"""
+        (x0, y0, x1, y1) = self.bounds
+
+        return (x0, y0, x1 - x0, y1 - y0)
+
+class MotionEventTracker:
+    """
+    Merges per-frame motion detections into discrete events and drives the
+    outlet override from them.
+
+    Rather than rewriting override_until and every outlet's GPIO on each
+    contour of each frame, the override is only pushed out when doing so
+    would move it by at least override_resolution seconds. Events are stored
+    in motion_events, created when they start and completed when no motion
+    has been seen for event_gap seconds. A clip recorder, if given, is told
+    when each event starts and finishes. The outlets are switched on through
+    an OutletController, which leaves alone those that already are.
+    """
+
+    def __init__(self, sqlite, lock, outlets, controller, config, recorder = None):
+        self.sqlite = sqlite
+        self.lock = lock
+        self.outlets = outlets
+        self.controller = controller
+        self.recorder = recorder
+
+        self.configure(config)
+
+        self.event = None
+        self.override_until = None
+
+        self.detections = 0
+        self.events = 0
+        self.override_writes = 0
+        self.suppressed_writes = 0
+        self.suppressed_gpio = 0
+
+    def configure(self, config):
+        """Apply the motion settings, also used on a reload"""
+        motion = config.get('motion', {})
+
+        self.timeout = datetime.timedelta(minutes = config['motion_timeout'])
+        self.gap = datetime.timedelta(seconds = motion.get('event_gap', 5))
+        self.resolution = datetime.timedelta(seconds = motion.get('override_resolution', 60))
+
+    def stats(self):
+        return {
+            'detections' : self.detections,
+            'events' : self.events,
+            'override_writes' : self.override_writes,
+            'suppressed_writes' : self.suppressed_writes,
+            'suppressed_gpio' : self.suppressed_gpio
+        }
+
+    def update(self, rects, timestamp):
+        """Feed the motion rectangles found in the frame captured at timestamp"""
+        if not rects:
+            if self.event is not None and timestamp - self.event.last_seen > self.gap:
+                self.finish()
+
+            return
+
+        self.detections += len(rects)
+
+        if self.event is None:
+            self.start(timestamp)
+
+        self.event.add(rects, timestamp)
+        self.override(timestamp, len(rects))
+
+    def start(self, timestamp):
+        logging.info("Motion detected")
+
+        self.event = MotionEvent(timestamp)
+        self.events += 1
+
+        with self.lock:
+            c = self.sqlite.cursor()
+            c.execute("INSERT INTO motion_events (started_at, frames, peak_area) VALUES(?, 0, 0)", (timestamp,))
+            self.event.event_id = c.lastrowid
+
+        if self.recorder is not None:
+            self.recorder.eventStarted(self.event.event_id, timestamp)
+
+    def finish(self):
+        """Complete and store the active event, if any"""
+        event = self.event
+
+        if event is None:
+            return
+
+        self.event = None
+        event.ended_at = event.last_seen
+
+        logging.info("Motion event ended after %s (%d frames)", event.ended_at - event.started_at, event.frames)
+
+        (x, y, w, h) = event.box()
+
+        with self.lock:
+            self.sqlite.execute("UPDATE motion_events SET ended_at = ?, frames = ?, peak_area = ?, x = ?, y = ?, width = ?, height = ? WHERE event_id = ?",
+                                (event.ended_at, event.frames, event.peak_area, x, y, w, h, event.event_id))
+
+        if self.recorder is not None:
+            self.recorder.eventFinished(event.event_id, event.ended_at)
+
+    def recover(self):
+        """
+        Close the events left open by a daemon that died mid event, as
+        ending when they started as nothing more is known of them. Returns
+        how many there were.
+        """
+        with self.lock:
+            count = self.sqlite.execute("UPDATE motion_events SET ended_at = started_at WHERE ended_at IS NULL").rowcount
+
+        if count:
+            logging.warning("Closed %d motion event(s) left open by the last run", count)
+
+        return count
+
+    def override(self, timestamp, contours):
+        """
+        Push the override out from a frame with the given number of motion
+        contours, each of which used to rewrite the outlets on its own.
+        """
+        override_until = timestamp + self.timeout
+
+        if self.override_until is not None and override_until - self.override_until < self.resolution:
+            self.suppressed_writes += contours
+            self.suppressed_gpio += contours * len(self.outlets.ids)
+            return
+
+        self.outlets.update(None, override_until = override_until, state = 1)
+
+        self.override_until = override_until
+        self.override_writes += 1
+        self.suppressed_writes += contours - 1
+        self.suppressed_gpio += (contours - 1) * len(self.outlets.ids)
+
+        logging.debug("Motion Detected, overriding outlets to ON state until %s", override_until)
+
+        self.controller.set(self.outlets.ids, 1)
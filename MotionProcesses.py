@@ -0,0 +1,491 @@
+"""
+Motion analysis on every core.
+
+A site's frames are analysed one at a time, so however many cores the Pi
+has, one site's motion detection gets one of them. With pipeline.processes
+the detection moves to that many worker processes instead, forked by the
+site's start() before any of the daemon's threads are running (a thread
+holding a lock at the fork would leave it held in the workers for good):
+
+    processes - worker processes, 0 (the default) analyses on the analysis
+                thread as before
+    split     - "frames": the workers take turns, each analysing every Nth
+                frame against a background model of its own (which so
+                follows the scene N times slower per frame). "stripes":
+                each worker analyses its horizontal stripe of every frame
+                (the rois cut at the stripe boundaries) and the rectangles
+                meeting at a boundary are joined up again. Frames is the
+                better choice, in stripes a bird straddling a boundary is
+                found as two halves that each have to make min_area.
+
+Frames aren't pickled through a pipe to reach a worker. The feed's ring
+allocates its slots from an Arena of shared memory created before forking,
+sized for frames of camera.resolution and format, so the capture thread
+copies each frame straight into memory the workers see and only the slot's
+index is sent. Frames that don't fit (a video file of another size) are
+analysed on the analysis thread instead. The analysis thread keep()s the slot
+until the frame's answer has come back and its motion has been handled,
+annotation included, then releases it to the ring.
+
+Answers are put back in frame order before they are handed on, so motion
+events see frames in the order they were captured whichever worker finished
+first. Up to two frames per worker are in flight, past that the analysis
+thread waits for the workers and the ring drops frames as it always has.
+
+The workers report their detectors' counters and latencies back with their
+answers, which are summed into the site's MotionDetector, so its stats and
+metrics read as they do without processes. In frames mode the first worker
+persists the background, stripes don't persist.
+"""
+
+import multiprocessing
+import collections
+import logging
+import select
+import signal
+import errno
+import copy
+import time
+import os
+
+import numpy
+
+import FrameSource
+
+FRAMES = 'frames'
+STRIPES = 'stripes'
+
+# Seconds between a worker's reports of its detector's counters and latencies
+REPORT_INTERVAL = 1.0
+
+class Arena:
+    """
+    Frame slots of `nbytes` each in one block of shared memory, seen by the
+    processes forked after it was created
+    """
+
+    def __init__(self, slots, nbytes):
+        self.slots = slots
+        self.nbytes = nbytes
+        self.memory = multiprocessing.RawArray('B', slots * nbytes)
+        self.base = numpy.frombuffer(self.memory, dtype = numpy.uint8)
+        self.address = self.base.__array_interface__['data'][0]
+        self.used = 0
+
+    def view(self, index, shape):
+        """Slot `index` as a frame of this shape"""
+        start = index * self.nbytes
+
+        return self.base[start:start + int(numpy.prod(shape))].reshape(shape)
+
+    def index(self, frame):
+        """The slot a frame is a view of, None if it isn't one"""
+        offset = frame.__array_interface__['data'][0] - self.address
+
+        if frame.dtype != numpy.uint8 or offset < 0 or offset >= len(self.base) or offset % self.nbytes:
+            return None
+
+        return offset // self.nbytes
+
+    def allocate(self, frame, slot = None):
+        """A slot for frames like this one, slot's own if it is one, None if none is left or it doesn't fit"""
+        if frame.dtype != numpy.uint8 or frame.nbytes > self.nbytes:
+            return None
+
+        index = self.index(slot) if slot is not None else None
+
+        if index is None:
+            if self.used == self.slots:
+                return None
+
+            index = self.used
+            self.used += 1
+
+        return self.view(index, frame.shape)
+
+def stripe(config, i, count):
+    """The config of the worker analysing stripe i of count"""
+    config = copy.deepcopy(config)
+    camera = config['camera']
+
+    (top, bottom) = (float(i) / count, float(i + 1) / count)
+    rois = []
+
+    for (x, y, w, h) in camera.get('rois') or [[0, 0, 1, 1]]:
+        (y0, y1) = (max(y, top), min(y + h, bottom))
+
+        if y1 > y0:
+            rois.append([x, y0, w, y1 - y0])
+
+    camera['rois'] = rois
+    camera['background'] = dict(camera.get('background', {}), persist = False)
+
+    # min_roi is a fraction of the frame, a stripe is only 1/count of it
+    lighting = camera.get('lighting', {})
+    camera['lighting'] = dict(lighting, min_roi = lighting.get('min_roi', 0.25) / count)
+
+    return config
+
+def join(stripes, boundaries, tolerance):
+    """
+    The rectangles found in each stripe, with those meeting across a
+    boundary (frame row) joined into one
+    """
+    rects = list(stripes[0])
+
+    for (boundary, below) in zip(boundaries, stripes[1:]):
+        for (x, y, w, h) in below:
+            if abs(y - boundary) <= tolerance:
+                for rect in [r for r in rects if abs(r[1] + r[3] - boundary) <= tolerance and r[0] < x + w and x < r[0] + r[2]]:
+                    rects.remove(rect)
+
+                    (x0, y0) = (min(x, rect[0]), min(y, rect[1]))
+                    (x1, y1) = (max(x + w, rect[0] + rect[2]), max(y + h, rect[1] + rect[3]))
+                    (x, y, w, h) = (x0, y0, x1 - x0, y1 - y0)
+
+            rects.append((x, y, w, h))
+
+    return rects
+
+def report(detector):
+    return (detector.stats(), [h.snapshot() for h in (detector.blur_latency, detector.contour_latency)])
+
+def serve(conn, arena, detector, config, persist):
+    """
+    A worker process: detect motion in the slots it is sent, answering
+    (seq, rects, report or None), until it is sent None or its parent goes
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    parent = os.getppid()
+    reported = 0
+
+    if config is not None:
+        # A stripe's regions aren't those of any saved whole frame background
+        detector.configure(config)
+        detector.restored = None
+
+    try:
+        while True:
+            if not conn.poll(1):
+                if os.getppid() != parent:
+                    break
+
+                continue
+
+            message = conn.recv()
+
+            if message is None:
+                break
+
+            if message[0] == 'frame':
+                (_, seq, index, shape) = message
+
+                rects = detector.detect(arena.view(index, shape))
+                now = time.time()
+
+                if now - reported >= REPORT_INTERVAL:
+                    reported = now
+                    conn.send((seq, rects, report(detector)))
+                else:
+                    conn.send((seq, rects, None))
+
+                if persist:
+                    detector.save()
+            elif message[0] == 'configure':
+                detector.configure(message[1])
+            elif message[0] == 'lighting':
+                detector.lightingChanged()
+
+        if persist:
+            detector.save(final = True)
+    except Exception:
+        logging.exception("Motion worker %d failed", os.getpid())
+    finally:
+        logging.shutdown()
+
+class MotionProcesses:
+    """
+    A site's motion detection on worker processes. detector is the site's
+    MotionDetector: the workers start out as copies of it, its lighting
+    hints are passed on to them and their counters are reported back to it.
+    """
+
+    def __init__(self, config, detector):
+        pipeline = config.get('pipeline', {})
+
+        self.count = max(pipeline.get('processes', 0), 1)
+        self.split = pipeline.get('split', FRAMES)
+        self.config = config
+        self.detector = detector
+
+        if self.split not in (FRAMES, STRIPES):
+            raise ValueError("Unknown pipeline.split %s" % self.split)
+
+        self.depth = 2 * self.count
+        # The ring's own slots (two at least, one being analysed and one
+        # filling) and the frames kept while in flight
+        self.slots = max(pipeline.get('ring_size', 4), 2) + self.depth
+
+        self.arena = None
+        # Shapes of frames the arena had no slot for, warned about once each
+        self.unsent = set()
+        self.processes = []
+        self.conns = []
+        self.working = []
+        self.reports = {}
+
+        self.seq = 0
+        self.next = 1
+        self.inflight = {}
+
+        self.submitted = 0
+        self.local = 0
+        self.waits = 0
+        self.waited = 0.0
+
+    def stats(self):
+        return {
+            'processes' : self.count,
+            'split' : self.split,
+            'submitted' : self.submitted,
+            'local' : self.local,
+            'inflight' : len(self.inflight),
+            'waits' : self.waits,
+            'waited' : self.waited
+        }
+
+    def collectMetrics(self, **labels):
+        return [
+            ('birdhouse_motion_processes', 'gauge', "Worker processes analysing motion", labels, len(self.processes)),
+            ('birdhouse_motion_inflight', 'gauge', "Frames with the motion workers", labels, len(self.inflight)),
+            ('birdhouse_motion_wait_seconds_total', 'counter', "Time spent waiting for busy motion workers", labels, self.waited)
+        ]
+
+    def configs(self, config):
+        """What each worker is configured with, None for the detector as it is"""
+        if self.split == STRIPES:
+            return [stripe(config, i, self.count) for i in range(self.count)]
+
+        return [None] * self.count
+
+    def start(self, nbytes = None):
+        """
+        Create the arena, for frames of nbytes (by default the configured
+        resolution and format), and fork the workers. Does nothing if they
+        are already running.
+        """
+        if self.arena is not None:
+            return
+
+        camera = self.config['camera']
+        self.arena = Arena(self.slots, nbytes or FrameSource.frameBytes(camera['resolution'], camera.get('format', FrameSource.BGR)))
+        configs = self.configs(self.config)
+
+        for i in range(self.count):
+            (conn, child) = multiprocessing.Pipe()
+
+            process = multiprocessing.Process(target = serve, name = 'motion-%d' % i,
+                                              args = (child, self.arena, self.detector, configs[i], self.split == FRAMES and i == 0))
+            process.daemon = True
+            process.start()
+            child.close()
+
+            self.processes.append(process)
+            self.conns.append(conn)
+
+        self.working = self.workers(configs)
+
+        logging.info("Analysing motion on %d processes (%s), pids %s", self.count, self.split, ', '.join(str(p.pid) for p in self.processes))
+
+    def workers(self, configs):
+        """The workers each frame goes to in stripes mode, those with regions to analyse"""
+        return [i for (i, config) in enumerate(configs) if config is None or config['camera']['rois']]
+
+    def allocate(self, frame, slot = None):
+        """The feed ring's allocate: slots in the arena, plain arrays for frames the workers can't be sent"""
+        view = self.arena.allocate(frame, slot) if self.arena is not None else None
+
+        if view is None:
+            if frame.shape not in self.unsent:
+                self.unsent.add(frame.shape)
+                logging.warning("Frames of shape %s can't be handed to the motion workers, analysing them on the analysis thread", frame.shape)
+
+            return numpy.empty_like(frame)
+
+        return view
+
+    def configure(self, config):
+        """Reconfigure the workers, from the analysis thread"""
+        self.config = config
+
+        configs = self.configs(config)
+
+        for (conn, worker) in zip(self.conns, configs):
+            conn.send(('configure', worker or config))
+
+        if self.split == STRIPES:
+            self.working = self.workers(configs)
+
+    def boundaries(self, shape):
+        """The frame rows the stripes meet at, as the workers' detectors round them"""
+        (height, width) = FrameSource.size(shape, FrameSource.YUV if self.detector.yuv else FrameSource.BGR)
+        scale = self.detector.width / float(width)
+        rows = max(int(height * scale), 1)
+
+        return [int(int(float(i) / self.count * rows) / scale) for i in range(1, self.count)]
+
+    def submit(self, frame, timestamp):
+        """
+        Hand over a frame kept from the ring, returns [(frame, timestamp,
+        rects)] of the frames answered since, in the order they were
+        submitted. rects is None while a background is being built.
+        """
+        self.seq += 1
+        self.submitted += 1
+
+        if self.detector.hinted:
+            self.detector.hinted = False
+
+            for conn in self.conns:
+                conn.send(('lighting',))
+
+        index = self.arena.index(frame) if self.arena is not None else None
+
+        if index is None:
+            # Not in the arena, analysed here once the frames before it are
+            answered = self.drain()
+            answered.append((frame, timestamp, self.detector.detect(frame)))
+
+            self.next = self.seq + 1
+            self.local += 1
+
+            return answered
+
+        workers = self.working if self.split == STRIPES else [(self.seq - 1) % self.count]
+
+        for i in workers:
+            self.conns[i].send(('frame', self.seq, index, frame.shape))
+
+        self.inflight[self.seq] = [frame, timestamp, set(workers), dict((i, []) for i in workers)]
+
+        self.receive(0)
+        answered = self.answered()
+
+        if len(self.inflight) >= self.depth:
+            started = time.time()
+
+            while len(self.inflight) >= self.depth:
+                self.receive(None)
+                answered.extend(self.answered())
+
+            self.waits += 1
+            self.waited += time.time() - started
+
+        return answered
+
+    def drain(self):
+        """Wait for every frame in flight, returns them as submit() does"""
+        answered = self.answered()
+
+        while self.inflight:
+            self.receive(None)
+            answered.extend(self.answered())
+
+        return answered
+
+    def receive(self, timeout):
+        """Take in the answers that have arrived, waiting up to timeout (None to wait for one)"""
+        while True:
+            try:
+                (ready, _, _) = select.select(self.conns, [], [], timeout)
+                break
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+        for conn in ready:
+            i = self.conns.index(conn)
+
+            while conn.poll():
+                try:
+                    (seq, rects, report) = conn.recv()
+                except EOFError:
+                    raise RuntimeError("Motion worker %d has exited" % self.processes[i].pid)
+
+                entry = self.inflight[seq]
+                entry[2].discard(i)
+
+                if rects is None or entry[3] is None:
+                    entry[3] = None
+                else:
+                    entry[3][i] = rects
+
+                if report is not None:
+                    self.reports[i] = report
+
+        if ready:
+            self.mirror()
+
+    def answered(self):
+        answered = []
+
+        while self.next in self.inflight and not self.inflight[self.next][2]:
+            (frame, timestamp, _, found) = self.inflight.pop(self.next)
+            self.next += 1
+
+            if found is None:
+                rects = None
+            elif self.split == STRIPES:
+                rects = join([found.get(i, []) for i in range(self.count)], self.boundaries(frame.shape), 2 / (self.detector.width / float(frame.shape[1])) + 1)
+            else:
+                rects = found.values()[0]
+
+            answered.append((frame, timestamp, rects))
+
+        return answered
+
+    def mirror(self):
+        """
+        The workers' latest reports into the site's detector: summed over
+        frames workers, for stripes (which all see every frame) the frame
+        counts are the busiest stripe's
+        """
+        reports = self.reports.values()
+
+        if not reports:
+            return
+
+        combine = sum if self.split == FRAMES else max
+
+        for key in ('analysed', 'skipped', 'suppressed', 'lighting_changes', 'restores'):
+            setattr(self.detector, key, combine(stats[key] for (stats, _) in reports))
+
+        self.detector.early_exits = sum(stats['early_exits'] for (stats, _) in reports)
+        self.detector.stride = max(stats['every'] for (stats, _) in reports)
+
+        for (i, histogram) in enumerate((self.detector.blur_latency, self.detector.contour_latency)):
+            latencies = [latency[i] for (_, latency) in reports]
+
+            histogram.restore([sum(counts) for counts in zip(*[counts for (counts, _, _) in latencies])],
+                              sum(total for (_, total, _) in latencies),
+                              sum(count for (_, _, count) in latencies))
+
+    def stop(self):
+        """Stop the workers, the first saving the background if it persists it"""
+        for conn in self.conns:
+            try:
+                conn.send(None)
+            except (IOError, OSError):
+                pass
+
+        for process in self.processes:
+            process.join(5)
+
+            if process.is_alive():
+                logging.warning("Motion worker %d didn't stop, terminating it", process.pid)
+                process.terminate()
+
+        self.processes = []
@@ -0,0 +1,232 @@
+"""
+In-memory view of the outlets table.
+
+The web UI edits outlets through its own connection, so rather than
+re-reading the table whenever an outlet is needed, OutletCache keeps the
+rows in memory and only re-reads them when PRAGMA data_version says another
+connection has committed a change. Changes made through the daemon's own
+connection don't bump data_version, so they are written through the cache
+with update().
+
+The gpio levels are kept the same way by OutletController, which is what
+switches the outlets.
+"""
+
+import collections
+import threading
+import logging
+
+# state is the level the daemon last switched the outlet to, so it can be
+# restored when the daemon restarts
+Outlet = collections.namedtuple('Outlet', ['outlet_id', 'name', 'schedule', 'override_until', 'last_ran', 'initial_state', 'schedule_active', 'state'])
+
+class OutletCache:
+    def __init__(self, sqlite, lock):
+        self.sqlite = sqlite
+        self.lock = lock
+
+        self.outlets = {}
+        self.ids = ()
+        self.data_version = None
+
+        self.reloads = 0
+
+    def reload(self):
+        with self.lock:
+            self.data_version = self.sqlite.execute('PRAGMA data_version').fetchone()[0]
+            rows = self.sqlite.execute('SELECT outlet_id, name, schedule, override_until, last_ran, initial_state, schedule_active, state FROM outlets').fetchall()
+
+        self.outlets = dict((row[0], Outlet(*row)) for row in rows)
+        self.ids = tuple(sorted(self.outlets))
+        self.reloads += 1
+
+        logging.debug("Loaded %d outlets", len(self.outlets))
+
+    def refresh(self):
+        """Reload if another connection changed the database, returns whether it did"""
+        with self.lock:
+            changed = self.sqlite.execute('PRAGMA data_version').fetchone()[0] != self.data_version
+
+        if changed:
+            self.reload()
+
+        return changed
+
+    def get(self, outlet_id):
+        return self.outlets.get(outlet_id)
+
+    def all(self):
+        return [self.outlets[outlet_id] for outlet_id in self.ids]
+
+    def update(self, outlet_ids, **fields):
+        """Write fields of the given outlets (None for every outlet) to the database and the cache"""
+        assignments = ', '.join('%s = ?' % name for name in fields)
+        values = tuple(fields.values())
+
+        with self.lock:
+            if outlet_ids is None:
+                self.sqlite.execute('UPDATE outlets SET %s' % assignments, values)
+            else:
+                for outlet_id in outlet_ids:
+                    self.sqlite.execute('UPDATE outlets SET %s WHERE outlet_id = ?' % assignments, values + (outlet_id,))
+
+        if outlet_ids is None:
+            outlet_ids = self.ids
+
+        # A new dict rather than updating in place, readers may be iterating
+        outlets = dict(self.outlets)
+
+        for outlet_id in outlet_ids:
+            if outlet_id in outlets:
+                outlets[outlet_id] = outlets[outlet_id]._replace(**fields)
+
+        self.outlets = outlets
+
+class OutletController:
+    """
+    Switches the outlet gpios (an outlet's id is its gpio), keeping the
+    level of each in memory so that no pigpio call, each a round trip to
+    pigpiod, is spent reading a level or writing one an outlet already has.
+
+    set() switches any number of outlets with at most one set_bank_1 for
+    those going on and one clear_bank_1 for those going off. A gpio is
+    claimed by restore() or its first set() with a plain write, which is
+    what puts it in output mode, and from then on is only written through
+    the bank. The shadow is authoritative, reconcile() (run every
+    reconcile_interval seconds from the outlets config section) reads the
+    bank back and rewrites any outlet that has drifted from it, e.g. after
+    pigpiod was restarted or someone ran pigs by hand.
+
+    requested counts the reads and writes the callers would have made one
+    outlet at a time, calls what was actually sent to pigpio.
+    """
+
+    # Gpios set_bank_1 and clear_bank_1 reach
+    BANK_1 = 32
+
+    def __init__(self, pi, config = None):
+        self.pi = pi
+        self.levels = {}
+        self.lock = threading.Lock()
+
+        self.requested = collections.defaultdict(int)
+        self.calls = collections.defaultdict(int)
+        self.switched = 0
+        self.reconciles = 0
+        self.drifted = 0
+
+        self.configure(config)
+
+    def configure(self, config):
+        """Apply the outlets config section, also used on a reload"""
+        config = config or {}
+
+        self.reconcile_interval = config.get('reconcile_interval', 60)
+
+    def stats(self):
+        return {
+            'requested' : dict(self.requested),
+            'calls' : dict(self.calls),
+            'avoided' : self.avoided(),
+            'switched' : self.switched,
+            'reconciles' : self.reconciles,
+            'drifted' : self.drifted
+        }
+
+    def avoided(self):
+        return sum(self.requested.values()) - sum(count for (call, count) in self.calls.items() if call != 'read_bank_1')
+
+    def write(self, gpio, level):
+        """A plain write, which also makes the gpio an output"""
+        self.pi.write(gpio, level)
+        self.calls['write'] += 1
+        self.levels[gpio] = level
+
+    def apply(self, levels):
+        """Write {gpio : level}, banked where the gpio is already claimed. Call with the lock held."""
+        on = 0
+        off = 0
+
+        for (gpio, level) in levels.items():
+            if gpio not in self.levels or gpio >= self.BANK_1:
+                self.write(gpio, level)
+            elif level:
+                on |= 1 << gpio
+            else:
+                off |= 1 << gpio
+
+        if on:
+            self.pi.set_bank_1(on)
+            self.calls['set_bank_1'] += 1
+
+        if off:
+            self.pi.clear_bank_1(off)
+            self.calls['clear_bank_1'] += 1
+
+        self.levels.update(levels)
+
+    def level(self, gpio):
+        """The outlet's level, only read from the gpio if it hasn't been claimed yet"""
+        self.requested['read'] += 1
+
+        with self.lock:
+            if gpio not in self.levels:
+                self.calls['read'] += 1
+                return self.pi.read(gpio)
+
+            return self.levels[gpio]
+
+    def set(self, gpios, level):
+        """Switch the outlets to level, returns the ids of those that weren't at it already"""
+        level = 1 if level else 0
+        self.requested['write'] += len(gpios)
+
+        with self.lock:
+            changes = dict((gpio, level) for gpio in gpios if self.levels.get(gpio) != level)
+
+            if changes:
+                self.apply(changes)
+                self.switched += len(changes)
+
+        return sorted(changes)
+
+    def restore(self, levels):
+        """Claim the outlets with the levels they should have on start ({gpio : level}), written whatever the shadow says"""
+        self.requested['write'] += len(levels)
+
+        with self.lock:
+            for (gpio, level) in levels.items():
+                self.write(gpio, 1 if level else 0)
+
+    def reconcile(self):
+        """Rewrite the outlets whose gpio doesn't hold the level the shadow has, returns their ids"""
+        with self.lock:
+            bank = self.pi.read_bank_1()
+            self.calls['read_bank_1'] += 1
+            self.reconciles += 1
+
+            drifted = sorted(gpio for (gpio, level) in self.levels.items() if gpio < self.BANK_1 and (bank >> gpio) & 1 != level)
+
+            # pigpiod may have been restarted, so written as plain writes to make them outputs again
+            for gpio in drifted:
+                self.write(gpio, self.levels[gpio])
+
+        if drifted:
+            self.drifted += len(drifted)
+            logging.warning("Outlet(s) %s weren't at the level last set, switched them back", ', '.join(str(gpio) for gpio in drifted))
+
+        return drifted
+
+    def collectMetrics(self, **labels):
+        stats = self.stats()
+
+        samples = [('birdhouse_gpio_calls_total', 'counter', "pigpio calls made to read and switch the outlets", dict(labels, call = call), count)
+                   for (call, count) in sorted(stats['calls'].items())]
+
+        samples.extend([
+            ('birdhouse_gpio_calls_avoided_total', 'counter', "Outlet gpio reads and writes answered from the shadow or merged into bank writes", labels, stats['avoided']),
+            ('birdhouse_outlets_switched_total', 'counter', "Outlets switched to a different level", labels, stats['switched']),
+            ('birdhouse_outlet_drift_total', 'counter', "Outlets found at a level other than the one last set and switched back", labels, stats['drifted'])
+        ])
+
+        return samples
@@ -0,0 +1,350 @@
+import threading
+import logging
+import time
+import datetime
+import collections
+
+import numpy
+
+from Metrics import Histogram
+
+class StageStats:
+    """Counters kept for each stage of the pipeline"""
+
+    def __init__(self, name):
+        self.name = name
+        self.processed = 0
+        self.dropped = 0
+        self.depth = 0
+        self.max_depth = 0
+        self.busy = 0.0
+
+    def snapshot(self):
+        return {
+            'processed' : self.processed,
+            'dropped' : self.dropped,
+            'depth' : self.depth,
+            'max_depth' : self.max_depth,
+            'busy' : self.busy
+        }
+
+def allocate(frame, slot = None):
+    """A buffer for frames like this one, slot is the buffer it replaces if any"""
+    return numpy.empty_like(frame)
+
+class FrameRing:
+    """
+    A bounded ring of preallocated frame buffers between the capture thread
+    and the analysis worker.
+
+    The producer copies each frame into a free slot with put(). If the
+    consumer has fallen behind and every slot is waiting to be analysed, the
+    oldest waiting frame is dropped and its slot reused, so capture never
+    blocks and the consumer always works on the most recent frames.
+
+    Slots come from allocate(frame, slot) (by default plain arrays). A
+    consumer that finishes with a frame later than the next get() keep()s
+    it and release()s it when it is done.
+    """
+
+    def __init__(self, size, stats, allocate = allocate):
+        self.size = size
+        self.stats = stats
+        self.allocate = allocate
+        self.cond = threading.Condition()
+        self.pending = collections.deque()
+        self.free = []
+        self.held = None
+        self.closed = False
+        self.seq = 0
+
+    def put(self, frame, timestamp):
+        with self.cond:
+            if self.free:
+                slot = self.free.pop()
+            elif not self.pending or len(self.pending) + (self.held is not None) < self.size:
+                slot = self.allocate(frame)
+            else:
+                (_, _, slot) = self.pending.popleft()
+                self.stats.dropped += 1
+
+            if slot.shape != frame.shape:
+                slot = self.allocate(frame, slot)
+
+            numpy.copyto(slot, frame)
+            self.seq += 1
+            self.pending.append((self.seq, timestamp, slot))
+
+            self.stats.depth = len(self.pending)
+            self.stats.max_depth = max(self.stats.max_depth, self.stats.depth)
+            self.cond.notify()
+
+    def get(self, timeout = None):
+        """
+        Return the next (seq, timestamp, frame) waiting to be analysed, or None
+        once the ring is closed and drained. The frame stays valid until the
+        next call to get().
+        """
+        with self.cond:
+            if self.held is not None:
+                self.free.append(self.held)
+                self.held = None
+
+            while not self.pending:
+                if self.closed:
+                    return None
+
+                self.cond.wait(timeout)
+
+                if timeout is not None and not self.pending:
+                    return None
+
+            item = self.pending.popleft()
+            self.held = item[2]
+            self.stats.depth = len(self.pending)
+
+            return item
+
+    def keep(self):
+        """Take the frame get() last returned, it stays valid until it is release()d"""
+        with self.cond:
+            (frame, self.held) = (self.held, None)
+
+            return frame
+
+    def release(self, frame):
+        with self.cond:
+            self.free.append(frame)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+class Feed:
+    """
+    One frame source and what to do with its frames.
+
+    name      - identifies the feed in logs, thread names and stats
+    source    - a FrameSource feeding the feed's capture thread
+    analyze   - called as analyze(frame, timestamp) for each frame taken off
+                the ring; returning False stops the pipeline
+    listeners - callables run as listener(frame, timestamp) on the capture
+                thread for every frame captured, analysed or not; they must
+                copy anything they keep and must not block
+    allocate  - where the ring's frame buffers come from (see FrameRing)
+    """
+
+    def __init__(self, name, source, analyze, ring_size = 4, listeners = (), allocate = allocate):
+        self.name = name
+        self.source = source
+        self.analyze = analyze
+        self.listeners = listeners
+
+        self.capture_stats = StageStats('capture')
+        self.analysis_stats = StageStats('analysis')
+
+        self.ring = FrameRing(ring_size, self.capture_stats, allocate)
+
+        # Time spent handing each frame over, how long it then waited in the
+        # ring, and how long it took to analyse
+        self.capture_latency = Histogram()
+        self.queue_latency = Histogram()
+        self.analysis_latency = Histogram()
+
+        # Set while the feed is queued for or being analysed by a worker
+        self.scheduled = False
+
+    def stats(self):
+        return dict((s.name, s.snapshot()) for s in (self.capture_stats, self.analysis_stats))
+
+class Pipeline:
+    """
+    Runs capture, motion analysis and housekeeping on separate threads.
+
+    feeds   - the Feeds to analyse, each captured on its own thread
+    tasks   - list of (interval, callable) run periodically on the
+              sensor/scheduler thread
+    workers - how many threads analyse frames, shared by all the feeds
+
+    A feed with frames waiting joins the back of a ready queue and the next
+    free worker analyses its oldest frame. A feed is only ever with one
+    worker at a time, so its frames are analysed in order and its analyze
+    needn't be thread safe, while feeds take turns so a busy camera can't
+    starve the others. OpenCV releases the GIL while it works, so workers
+    analysing different feeds do run on separate cores.
+
+    The thread calling run() is one of the workers, so with a single worker
+    anything needing the main thread (cv2.imshow) keeps working.
+    """
+
+    def __init__(self, feeds, tasks, workers = 1):
+        self.feeds = feeds
+        self.tasks = tasks
+        self.workers = max(workers, 1)
+        self.stopping = threading.Event()
+
+        self.task_stats = StageStats('tasks')
+
+        self.cond = threading.Condition()
+        self.ready = collections.deque()
+        self.capturing = len(feeds)
+        self.busy = 0
+
+    def stats(self):
+        return {
+            'tasks' : self.task_stats.snapshot(),
+            'feeds' : dict((feed.name, feed.stats()) for feed in self.feeds)
+        }
+
+    def stop(self):
+        self.stopping.set()
+
+        for feed in self.feeds:
+            feed.ring.close()
+
+        with self.cond:
+            self.cond.notify_all()
+
+    def schedule(self, feed):
+        """Queue a feed that has frames waiting, unless it already is"""
+        with self.cond:
+            if not feed.scheduled:
+                feed.scheduled = True
+                self.ready.append(feed)
+                self.cond.notify()
+
+    def capture(self, feed):
+        try:
+            for frame in feed.source.frames():
+                if self.stopping.is_set():
+                    break
+
+                started = time.time()
+                timestamp = datetime.datetime.now()
+
+                for listener in feed.listeners:
+                    listener(frame, timestamp)
+
+                feed.ring.put(frame, timestamp)
+                self.schedule(feed)
+
+                feed.capture_stats.processed += 1
+                feed.capture_latency.observe(time.time() - started)
+        except Exception:
+            logging.exception("Frame capture failed for %s", feed.name)
+        finally:
+            logging.info("Frame capture stopped for %s", feed.name)
+            feed.ring.close()
+
+            with self.cond:
+                self.capturing -= 1
+                self.cond.notify_all()
+
+    def housekeeping(self):
+        due = [time.time()] * len(self.tasks)
+
+        while not self.stopping.is_set():
+            now = time.time()
+
+            for (i, (interval, task)) in enumerate(self.tasks):
+                if now < due[i]:
+                    continue
+
+                due[i] = now + interval
+
+                started = time.time()
+
+                try:
+                    task()
+                except Exception:
+                    logging.exception("Periodic task %s failed", getattr(task, '__name__', task))
+
+                elapsed = time.time() - started
+                self.task_stats.processed += 1
+                self.task_stats.busy += elapsed
+
+                if elapsed > interval:
+                    self.task_stats.dropped += 1
+
+            if due:
+                self.stopping.wait(max(min(due) - time.time(), 0.01))
+            else:
+                self.stopping.wait()
+
+    def work(self):
+        while not self.stopping.is_set():
+            with self.cond:
+                if not self.ready:
+                    if not self.capturing and not self.busy:
+                        # Every source has ended and its frames are analysed
+                        break
+
+                    # Wake up periodically so signal handlers get a chance to run
+                    self.cond.wait(1)
+                    continue
+
+                feed = self.ready.popleft()
+                self.busy += 1
+
+            item = feed.ring.get(0)
+            result = None
+
+            if item is not None:
+                (seq, timestamp, frame) = item
+
+                feed.queue_latency.observe((datetime.datetime.now() - timestamp).total_seconds())
+
+                started = time.time()
+                result = feed.analyze(frame, timestamp)
+                elapsed = time.time() - started
+
+                feed.analysis_stats.busy += elapsed
+                feed.analysis_stats.processed += 1
+                feed.analysis_latency.observe(elapsed)
+
+            with self.cond:
+                # A frame put since we took this one found the feed still
+                # scheduled, so it's ours to queue again
+                if feed.ring.pending and not self.stopping.is_set():
+                    self.ready.append(feed)
+                    self.cond.notify()
+                else:
+                    feed.scheduled = False
+
+                self.busy -= 1
+
+                if not self.busy:
+                    self.cond.notify_all()
+
+            if result is False:
+                self.stop()
+
+    def worker(self):
+        try:
+            self.work()
+        except Exception:
+            logging.exception("Frame analysis failed")
+            self.stop()
+
+    def run(self):
+        threads = [threading.Thread(target = self.capture, args = (feed,), name = 'capture-%s' % feed.name) for feed in self.feeds]
+        threads.append(threading.Thread(target = self.housekeeping, name = 'housekeeping'))
+        threads.extend(threading.Thread(target = self.worker, name = 'analysis-%d' % i) for i in range(1, self.workers))
+
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        try:
+            self.work()
+        finally:
+            self.stop()
+
+            for t in threads:
+                t.join(5)
+
+            for feed in self.feeds:
+                feed.source.close()
+
+            logging.info("Pipeline stopped: %s", self.stats())
@@ -0,0 +1,569 @@
+"""
+Read-only HTTP API over the sensor readings, for the dashboard.
+
+Instead of the dashboard pulling every raw row of a day, week or month out
+of the database and encoding all of it on each request, this serves a
+range already downsampled to about the number of points a chart can show:
+
+    /                   the sites and tables available, as JSON
+    /<table>            readings of weather or water_temp from start up to
+                        end, taking these parameters:
+
+        site     - which site (the first by default)
+        start    - start of the range, e.g. 2016-05-01 or 2016-05-01 12:00
+                   (end minus a day by default)
+        end      - end of the range, exclusive (now by default)
+        points   - about how many points to return (500, at most max_points)
+        method   - avg: the average of each of `points` equal buckets,
+                   worked out in SQLite from the coarsest rollup fine
+                   enough (or from the raw rows for short ranges)
+                   lttb: Largest-Triangle-Three-Buckets, which keeps the
+                   raw readings that best preserve the shape of the first
+                   metric asked for, peaks included. It runs over the finest
+                   of the raw rows, minute or hour rollups no larger than
+                   max_input rows.
+                   raw: every raw row, streamed
+        metrics  - comma separated metrics to return (all by default)
+        format   - json (default) or csv
+
+    /<table>/latest     the most recent reading
+
+Responses are written as rows are read rather than built up in memory.
+A range that ended more than `settle` seconds ago won't change any more, so
+its response is kept (up to cache_mb of them) and served with an ETag, and
+a dashboard asking again with If-None-Match gets a 304. A response
+estimated to be larger than the whole cache is streamed instead.
+
+Configured by the query section: enabled, bind (localhost by default),
+port, max_points, max_input, settle and cache_mb. Each site's database is
+opened with PRAGMA query_only, and being in WAL mode, reading it never holds
+up the daemon's writes.
+"""
+
+from Metrics import LatencyWindow
+
+import BaseHTTPServer
+import SocketServer
+import collections
+import threading
+import contextlib
+import datetime
+import hashlib
+import logging
+import urlparse
+import sqlite3
+import socket
+import Queue
+import numpy
+import json
+import time
+
+import Rollups
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Seconds in each rollup resolution, finest first
+RESOLUTION_SECONDS = [('minute', 60), ('hour', 3600), ('day', 86400)]
+
+METHODS = ('avg', 'lttb', 'raw')
+
+FORMATS = {
+    'json' : 'application/json',
+    'csv' : 'text/csv'
+}
+
+# Rows written to the client at a time
+CHUNK = 512
+
+# Most bytes a row takes in either format: the time and each value
+ROW_BYTES = 28
+VALUE_BYTES = 14
+
+def parseTime(value):
+    """A time given as a query parameter, raises ValueError if it isn't one"""
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M', '%Y-%m-%d', '%Y-%m'):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+
+    raise ValueError('Invalid time: %s' % value)
+
+def seconds(delta):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+def fromEpoch(value):
+    """Back from the seconds SQLite's julianday arithmetic gives (local time, like recorded_at)"""
+    return EPOCH + datetime.timedelta(seconds = round(value, 3))
+
+def lttb(x, y, points):
+    """
+    Indices of the `points` samples Largest-Triangle-Three-Buckets keeps of
+    the series (x, y): the first and last, and from each bucket between them
+    the one forming the largest triangle with the last kept sample and the
+    average of the next bucket.
+    """
+    n = len(x)
+
+    if points >= n or points < 3:
+        return numpy.arange(n)
+
+    edges = numpy.linspace(1, n - 1, points - 1).astype(int)
+    kept = numpy.empty(points, dtype = int)
+    kept[0] = 0
+    kept[-1] = n - 1
+    a = 0
+
+    for i in range(points - 2):
+        (lo, hi) = (edges[i], edges[i + 1])
+
+        if i == points - 3:
+            (nextX, nextY) = (x[n - 1], y[n - 1])
+        else:
+            following = slice(edges[i + 1], edges[i + 2])
+            (nextX, nextY) = (x[following].mean(), y[following].mean())
+
+        area = numpy.abs((x[a] - nextX) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (nextY - y[a]))
+        a = lo + int(area.argmax())
+        kept[i + 1] = a
+
+    return kept
+
+class Database:
+    """A pool of read-only connections to one site's database"""
+
+    def __init__(self, path):
+        self.path = path
+        self.pool = Queue.Queue()
+
+    def connect(self):
+        sqlite = sqlite3.connect(self.path, detect_types = sqlite3.PARSE_DECLTYPES, check_same_thread = False)
+        sqlite.execute('PRAGMA query_only = 1')
+
+        return sqlite
+
+    @contextlib.contextmanager
+    def connection(self):
+        try:
+            sqlite = self.pool.get_nowait()
+        except Queue.Empty:
+            sqlite = self.connect()
+
+        try:
+            yield sqlite
+        finally:
+            self.pool.put(sqlite)
+
+class Series:
+    """
+    One range of readings as asked for, see the module docstring for the
+    parameters. rows() yields (recorded_at, values...) and `source` says
+    what they were worked out from.
+    """
+
+    def __init__(self, table, params, max_points = 5000, max_input = 100000):
+        if table not in Rollups.METRICS:
+            raise KeyError(table)
+
+        self.table = table
+        self.end = parseTime(params['end']) if params.get('end') else datetime.datetime.now()
+        self.start = parseTime(params['start']) if params.get('start') else self.end - datetime.timedelta(days = 1)
+        self.points = min(int(params.get('points', 500)), max_points)
+        self.method = params.get('method', 'avg')
+        self.max_input = max_input
+        self.source = None
+
+        metrics = params.get('metrics')
+        self.metrics = tuple(metrics.split(',')) if metrics else Rollups.METRICS[table]
+
+        if self.start >= self.end:
+            raise ValueError('The range must start before it ends')
+
+        if self.points < 1:
+            raise ValueError('points must be at least 1')
+
+        if self.method not in METHODS:
+            raise ValueError('Invalid method: %s, expected one of %s' % (self.method, ', '.join(METHODS)))
+
+        unknown = [m for m in self.metrics if m not in Rollups.METRICS[table]]
+
+        if unknown:
+            raise ValueError('Unknown metrics: %s' % ', '.join(unknown))
+
+    @property
+    def columns(self):
+        return ('recorded_at',) + self.metrics
+
+    def key(self):
+        return (self.table, self.start, self.end, self.points, self.method, self.metrics)
+
+    def width(self):
+        return seconds(self.end - self.start) / self.points
+
+    def minutesCover(self, sqlite):
+        """
+        Whether the minute rollups reach back to the start of the range.
+        They are pruned with the raw rows, the hours and days are kept.
+        """
+        (minute, hour) = [sqlite.execute("SELECT min(bucket_start) FROM %s_rollup WHERE resolution = ?" % self.table, (resolution,)).fetchone()[0]
+                          for resolution in ('minute', 'hour')]
+
+        if minute is None:
+            return False
+
+        if hour is not None and minute[:13] <= hour[:13]:
+            return True
+
+        return minute <= self.start.strftime('%Y-%m-%d %H:%M:%S')
+
+    def rawCount(self, sqlite):
+        """Raw rows in the range, estimated from the hourly rollups"""
+        return sqlite.execute("SELECT total(count) FROM %s_rollup WHERE resolution = 'hour' AND bucket_start >= ? AND bucket_start < ?" % self.table,
+                              (self.start.strftime('%Y-%m-%d %H:00:00'), self.end)).fetchone()[0]
+
+    def estimatedBytes(self, sqlite):
+        """About the most a response for the range can take"""
+        rows = self.rawCount(sqlite) if self.method == 'raw' else self.points
+
+        return int(rows * (ROW_BYTES + VALUE_BYTES * len(self.metrics))) + 256
+
+    def select(self, sqlite, resolution, grouped):
+        """
+        Query the raw rows (resolution None) or a rollup for the range, as
+        (seconds, values...) ordered by time. grouped averages them over
+        `points` equal buckets, seconds then being the bucket number.
+        """
+        if resolution is None:
+            (source, time, where, params) = (self.table, 'recorded_at', '', ())
+            values = ['%s' % m for m in self.metrics]
+            averages = ['avg(%s)' % m for m in self.metrics]
+        else:
+            (source, time, where, params) = (self.table + '_rollup', 'bucket_start', 'resolution = ? AND ', (resolution,))
+            values = ['%s_sum / count' % m for m in self.metrics]
+            averages = ['total(%s_sum) / total(count)' % m for m in self.metrics]
+
+        where += '%s >= ? AND %s < ?' % (time, time)
+        params += (self.start, self.end)
+
+        if grouped:
+            # Rounded to the millisecond first, julianday's doubles put a row on a bucket edge just short of it
+            return sqlite.execute("SELECT CAST(round((julianday(%s) - julianday(?)) * 86400.0, 3) / ? AS INTEGER) AS bucket, %s FROM %s WHERE %s GROUP BY bucket ORDER BY bucket"
+                                  % (time, ', '.join(averages), source, where), (self.start, self.width()) + params)
+
+        return sqlite.execute("SELECT (julianday(%s) - 2440587.5) * 86400.0, %s FROM %s WHERE %s ORDER BY %s"
+                              % (time, ', '.join(values), source, where, time), params)
+
+    def averages(self, sqlite):
+        width = self.width()
+        resolution = None
+
+        for (name, size) in RESOLUTION_SECONDS:
+            if size <= width and (name != 'minute' or self.minutesCover(sqlite)):
+                resolution = name
+
+        self.source = resolution or 'raw'
+
+        for row in self.select(sqlite, resolution, True):
+            yield (self.start + datetime.timedelta(seconds = row[0] * width),) + tuple(row[1:])
+
+    def largestTriangles(self, sqlite):
+        span = seconds(self.end - self.start)
+        resolution = None
+
+        if self.rawCount(sqlite) > self.max_input or not self.minutesCover(sqlite):
+            for (name, size) in RESOLUTION_SECONDS:
+                resolution = name
+
+                if span / size <= self.max_input and (name != 'minute' or self.minutesCover(sqlite)):
+                    break
+
+        self.source = resolution or 'raw'
+
+        rows = [row for row in self.select(sqlite, resolution, False) if row[1] is not None]
+
+        if not rows:
+            return
+
+        series = numpy.array(rows, dtype = float)
+
+        for i in lttb(series[:, 0], series[:, 1], self.points):
+            yield (fromEpoch(series[i, 0]),) + tuple(rows[i][1:])
+
+    def raw(self, sqlite):
+        self.source = 'raw'
+
+        for row in sqlite.execute("SELECT recorded_at, %s FROM %s WHERE recorded_at >= ? AND recorded_at < ? ORDER BY recorded_at"
+                                  % (', '.join(self.metrics), self.table), (self.start, self.end)):
+            yield row
+
+    def rows(self, sqlite):
+        return getattr(self, {'avg' : 'averages', 'lttb' : 'largestTriangles', 'raw' : 'raw'}[self.method])(sqlite)
+
+def formatValue(value):
+    return 'null' if value is None else '%.6g' % value
+
+def writeJSON(out, site, series, rows):
+    out.write('{"site": %s, "table": %s, "method": %s, "columns": %s, "rows": [' % (
+              json.dumps(site), json.dumps(series.table), json.dumps(series.method), json.dumps(series.columns)))
+
+    chunk = []
+    written = False
+
+    for row in rows:
+        chunk.append('["%s", %s]' % (row[0].strftime('%Y-%m-%d %H:%M:%S'), ', '.join(formatValue(v) for v in row[1:])))
+
+        if len(chunk) == CHUNK:
+            out.write((', ' if written else '') + ', '.join(chunk))
+            (chunk, written) = ([], True)
+
+    if chunk:
+        out.write((', ' if written else '') + ', '.join(chunk))
+
+    out.write('], "source": %s}' % json.dumps(series.source))
+
+def writeCSV(out, site, series, rows):
+    out.write(','.join(series.columns) + '\r\n')
+
+    chunk = []
+
+    for row in rows:
+        chunk.append('%s,%s\r\n' % (row[0].strftime('%Y-%m-%d %H:%M:%S'), ','.join('' if v is None else '%.6g' % v for v in row[1:])))
+
+        if len(chunk) == CHUNK:
+            out.write(''.join(chunk))
+            chunk = []
+
+    out.write(''.join(chunk))
+
+WRITERS = {
+    'json' : writeJSON,
+    'csv' : writeCSV
+}
+
+class Buffer:
+    """Collects a response to be cached"""
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(data)
+
+    def getvalue(self):
+        return ''.join(self.parts)
+
+class QueryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        service = self.server.service
+        started = time.time()
+
+        try:
+            (code, result) = service.handle(self)
+        except (socket.error, IOError):
+            (code, result) = (None, 'disconnected')
+        except sqlite3.Error:
+            logging.exception("Query %s failed", self.path)
+            (code, result) = (500, 'error')
+
+            try:
+                self.send_error(500)
+            except (socket.error, IOError):
+                pass
+
+        service.results[result] += 1
+        service.latency.add(time.time() - started)
+
+    def log_message(self, format, *args):
+        logging.debug("Query client %s: " + format, self.client_address[0], *args)
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class QueryServer:
+
+    def __init__(self, sites, config):
+        """sites is a list of (name, config) as from Config.sites"""
+        query = config.get('query', {})
+
+        self.bind = query.get('bind', '127.0.0.1')
+        self.port = query.get('port', 8090)
+        self.max_points = query.get('max_points', 5000)
+        self.max_input = query.get('max_input', 100000)
+        self.settle = datetime.timedelta(seconds = query.get('settle', 120))
+        self.cache_bytes = int(query.get('cache_mb', 8) * 1024 * 1024)
+
+        self.names = [name for (name, site) in sites]
+        self.databases = dict((name, Database(site['sqlite_db'])) for (name, site) in sites)
+
+        self.lock = threading.Lock()
+        self.cache = collections.OrderedDict()
+        self.cached_bytes = 0
+
+        self.results = collections.defaultdict(int)
+        self.latency = LatencyWindow()
+
+        self.server = None
+        self.thread = None
+
+    def stats(self):
+        return {
+            'requests' : dict(self.results),
+            'cached' : len(self.cache),
+            'cached_bytes' : self.cached_bytes,
+            'latency_ms' : self.latency.snapshot()
+        }
+
+    def collectMetrics(self):
+        return [('birdhouse_query_requests_total', 'counter', "Dashboard queries by how they were answered", {'result' : result}, count)
+                for (result, count) in sorted(self.results.items())] + [
+            ('birdhouse_query_cache_bytes', 'gauge', "Size of the cached query responses", {}, self.cached_bytes)
+        ]
+
+    def cached(self, key):
+        with self.lock:
+            entry = self.cache.pop(key, None)
+
+            if entry is not None:
+                self.cache[key] = entry
+
+            return entry
+
+    def store(self, key, entry):
+        with self.lock:
+            if key in self.cache:
+                return
+
+            self.cache[key] = entry
+            self.cached_bytes += len(entry[1])
+
+            while self.cached_bytes > self.cache_bytes and self.cache:
+                (_, (etag, body)) = self.cache.popitem(last = False)
+                self.cached_bytes -= len(body)
+
+    def handle(self, request):
+        """Answer a request, returns (status, how it was answered)"""
+        url = urlparse.urlparse(request.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        path = url.path.strip('/').split('/')
+
+        if path == ['']:
+            return self.send(request, 200, 'application/json', json.dumps({ 'sites' : self.names, 'tables' : sorted(Rollups.METRICS) }))
+
+        site = params.get('site', self.names[0])
+
+        if site not in self.databases or path[0] not in Rollups.METRICS or len(path) > 2 or path[1:] not in ([], ['latest']):
+            request.send_error(404)
+            return (404, 'not_found')
+
+        if path[1:] == ['latest']:
+            return self.latest(request, site, path[0])
+
+        fmt = params.get('format', 'json')
+
+        try:
+            series = Series(path[0], params, self.max_points, self.max_input)
+
+            if fmt not in WRITERS:
+                raise ValueError('Invalid format: %s' % fmt)
+        except ValueError as e:
+            request.send_error(400, str(e))
+            return (400, 'bad_request')
+
+        database = self.databases[site]
+
+        if series.end > datetime.datetime.now() - self.settle:
+            # Still filling up, send it as it's read
+            return self.stream(request, database, site, fmt, series, 'no-cache')
+
+        key = (site, fmt) + series.key()
+        entry = self.cached(key)
+        result = 'hit'
+
+        if entry is None:
+            with database.connection() as sqlite:
+                estimate = series.estimatedBytes(sqlite)
+
+            if estimate > self.cache_bytes:
+                # Too big to keep, so not worth holding in memory either
+                return self.stream(request, database, site, fmt, series, 'public, max-age=86400')
+
+            body = Buffer()
+
+            with database.connection() as sqlite:
+                WRITERS[fmt](body, site, series, series.rows(sqlite))
+
+            body = body.getvalue()
+            entry = ('"%s"' % hashlib.sha1(body).hexdigest()[:20], body)
+            result = 'miss'
+
+            self.store(key, entry)
+
+        (etag, body) = entry
+
+        if request.headers.get('If-None-Match') == etag:
+            request.send_response(304)
+            request.send_header('ETag', etag)
+            request.end_headers()
+            return (304, 'not_modified')
+
+        self.send(request, 200, FORMATS[fmt], body, etag)
+
+        return (200, result)
+
+    def stream(self, request, database, site, fmt, series, cacheControl):
+        """Send the series as it's read, without an ETag"""
+        request.send_response(200)
+        request.send_header('Content-Type', FORMATS[fmt])
+        request.send_header('Cache-Control', cacheControl)
+        request.end_headers()
+
+        with database.connection() as sqlite:
+            WRITERS[fmt](request.wfile, site, series, series.rows(sqlite))
+
+        return (200, 'streamed')
+
+    def latest(self, request, site, table):
+        with self.databases[site].connection() as sqlite:
+            row = sqlite.execute("SELECT * FROM %s WHERE recorded_at IS NOT NULL ORDER BY recorded_at DESC LIMIT 1" % table).fetchone()
+
+        if row is None:
+            return self.send(request, 200, 'application/json', 'null')
+
+        reading = dict(zip(('recorded_at',) + Rollups.METRICS[table], (row[0].strftime('%Y-%m-%d %H:%M:%S'),) + tuple(row[1:])))
+
+        return self.send(request, 200, 'application/json', json.dumps(reading))
+
+    def send(self, request, code, contentType, body, etag = None):
+        request.send_response(code)
+        request.send_header('Content-Type', contentType)
+        request.send_header('Content-Length', str(len(body)))
+
+        if etag is not None:
+            request.send_header('ETag', etag)
+            request.send_header('Cache-Control', 'public, max-age=86400')
+        else:
+            request.send_header('Cache-Control', 'no-cache')
+
+        request.end_headers()
+        request.wfile.write(body)
+
+        return (code, 'sent')
+
+    def start(self):
+        self.server = ThreadingHTTPServer((self.bind, self.port), QueryHandler)
+        self.server.service = self
+
+        logging.info("Serving queries on http://%s:%d/", *self.server.server_address)
+
+        self.thread = threading.Thread(target = self.server.serve_forever, name = 'query')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+        if self.thread is not None:
+            self.thread.join(5)
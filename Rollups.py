@@ -0,0 +1,137 @@
+"""
+Pre-aggregated minute, hour and day rollups of the weather and water_temp
+readings.
+
+Each rollup row holds the count, min, max and sum of every metric for one
+bucket, so averages can be derived and buckets merged without going back to
+the raw rows. Buckets are keyed by their local start time in the same text
+form the raw recorded_at column uses.
+"""
+
+import logging
+
+RESOLUTIONS = [
+    ('minute', '%Y-%m-%d %H:%M:00'),
+    ('hour', '%Y-%m-%d %H:00:00'),
+    ('day', '%Y-%m-%d 00:00:00')
+]
+
+METRICS = {
+    'weather' : ('humidity', 'temperature'),
+    'water_temp' : ('temperature',)
+}
+
+def createTables(c):
+    for (table, metrics) in METRICS.items():
+        columns = ", ".join("%s_min REAL, %s_max REAL, %s_sum REAL" % (m, m, m) for m in metrics)
+
+        c.execute('''CREATE TABLE IF NOT EXISTS %s_rollup (resolution TEXT, bucket_start timestamp, count INT, %s, PRIMARY KEY (resolution, bucket_start))''' % (table, columns))
+
+def aggregate(table, rows):
+    """
+    Fold raw rows (recorded_at first, then the metrics in column order) into
+    {(resolution, bucket_start) : [count, min, max, sum, min, max, sum, ...]}
+    """
+    buckets = {}
+    metrics = len(METRICS[table])
+
+    for row in rows:
+        for (resolution, fmt) in RESOLUTIONS:
+            key = (resolution, row[0].strftime(fmt))
+            bucket = buckets.get(key)
+
+            if bucket is None:
+                bucket = buckets[key] = [0] + [None, None, 0.0] * metrics
+
+            bucket[0] += 1
+
+            for i in range(metrics):
+                value = row[i + 1]
+                offset = 1 + i * 3
+
+                if bucket[offset] is None or value < bucket[offset]:
+                    bucket[offset] = value
+
+                if bucket[offset + 1] is None or value > bucket[offset + 1]:
+                    bucket[offset + 1] = value
+
+                bucket[offset + 2] += value
+
+    return buckets
+
+def update(c, table, rows):
+    """
+    Merge a batch of raw rows into the rollups. Meant to run inside the same
+    transaction that inserts the raw rows.
+    """
+    metrics = METRICS[table]
+
+    assignments = ", ".join(
+        "%s_min = min(%s_min, ?), %s_max = max(%s_max, ?), %s_sum = %s_sum + ?" % (m, m, m, m, m, m) for m in metrics
+    )
+
+    placeholders = ", ".join(["?"] * (3 + 3 * len(metrics)))
+
+    for ((resolution, bucket_start), values) in aggregate(table, rows).items():
+        c.execute("UPDATE %s_rollup SET count = count + ?, %s WHERE resolution = ? AND bucket_start = ?" % (table, assignments),
+                  values + [resolution, bucket_start])
+
+        if c.rowcount == 0:
+            c.execute("INSERT INTO %s_rollup VALUES(%s)" % (table, placeholders), [resolution, bucket_start] + values)
+
+def prune(c, table, cutoff):
+    """Drop minute buckets older than the raw data retention, hours and days are kept"""
+    c.execute("DELETE FROM %s_rollup WHERE resolution = 'minute' AND bucket_start < ?" % table, (cutoff.strftime(RESOLUTIONS[0][1]),))
+
+    return c.rowcount
+
+def rebuild(c, table):
+    """
+    Recompute the rollups of a table from its raw rows. Only the buckets
+    after the one holding the oldest raw reading are recomputed. Pruning
+    may have removed the earlier rows of that bucket, so it is only filled
+    in if missing, and older buckets are left alone.
+    """
+    columns = ", ".join("min(%s), max(%s), total(%s)" % (m, m, m) for m in METRICS[table])
+    written = 0
+
+    for (resolution, fmt) in RESOLUTIONS:
+        c.execute("DELETE FROM %s_rollup WHERE resolution = ? AND bucket_start > (SELECT strftime(?, min(recorded_at)) FROM %s)" % (table, table),
+                  (resolution, fmt))
+
+        c.execute('''INSERT OR IGNORE INTO %s_rollup
+                     SELECT '%s', strftime('%s', recorded_at) AS bucket, count(*), %s
+                     FROM %s WHERE recorded_at IS NOT NULL GROUP BY bucket''' % (table, resolution, fmt, columns, table))
+
+        written += c.rowcount
+
+    return written
+
+def migrate(c):
+    """Schema migration: create the rollup tables and fill them from existing readings"""
+    createTables(c)
+
+    for table in METRICS:
+        rebuild(c, table)
+
+def backfill(sqlite, tables = None):
+    """
+    Rebuild the rollups for the given tables (all by default) from the raw
+    rows in a single transaction. Returns {table : rollup rows written}.
+    """
+    written = {}
+
+    c = sqlite.cursor()
+    c.execute("BEGIN")
+
+    try:
+        for table in (tables or METRICS.keys()):
+            logging.info("Rebuilding %s rollups", table)
+            written[table] = rebuild(c, table)
+    except Exception:
+        c.execute("ROLLBACK")
+        raise
+
+    c.execute("COMMIT")
+
+    return written
@@ -0,0 +1,300 @@
+import threading
+import collections
+import logging
+import datetime
+import time
+
+from Metrics import LatencyWindow, Histogram
+
+import DHT22
+
+class ThermSampler:
+    """
+    Reads a 1-wire temperature sensor on its own thread every `interval`
+    seconds, so the ~750ms conversion never holds up anything else.
+
+    The most recent reading is available from latest() together with when it
+    was taken. Each successful reading is also passed to `callback` as
+    callback(temperature, recorded_at), e.g. to queue it for storage.
+    """
+
+    def __init__(self, name, sensor, interval, unit, callback = None):
+        self.name = name
+        self.sensor = sensor
+        self.interval = interval
+        self.unit = unit
+        self.callback = callback
+
+        self.value = None
+        self.recorded_at = None
+        self.reads = 0
+        self.errors = 0
+        self.latency = LatencyWindow()
+        self.histogram = Histogram()
+
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def latest(self):
+        """Return (temperature, recorded_at) of the last good reading, or (None, None)"""
+        return (self.value, self.recorded_at)
+
+    def staleness(self):
+        """Seconds since the last good reading, or None if there hasn't been one"""
+        if self.recorded_at is None:
+            return None
+
+        return (datetime.datetime.now() - self.recorded_at).total_seconds()
+
+    def stats(self):
+        return {
+            'reads' : self.reads,
+            'errors' : self.errors,
+            'staleness' : self.staleness(),
+            'latency_ms' : self.latency.snapshot()
+        }
+
+    def sample(self):
+        started = time.time()
+
+        try:
+            value = self.sensor.get_temperature(self.unit)
+        except Exception:
+            self.errors += 1
+            logging.exception("Failed to read temperature sensor %s", self.name)
+            return
+        finally:
+            elapsed = time.time() - started
+            self.latency.add(elapsed)
+            self.histogram.observe(elapsed)
+
+        recorded_at = datetime.datetime.now()
+
+        (self.value, self.recorded_at) = (value, recorded_at)
+        self.reads += 1
+
+        if self.callback is not None:
+            self.callback(value, recorded_at)
+
+    def loop(self):
+        while not self.stopping.is_set():
+            started = time.time()
+
+            self.sample()
+
+            self.stopping.wait(max(self.interval - (time.time() - started), 0))
+
+    def start(self):
+        self.thread = threading.Thread(target = self.loop, name = 'sampler-%s' % self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+
+        if self.thread is not None:
+            self.thread.join(5)
+
+class Reading:
+    """
+    One DHT22 reading. status is the DHT22 outcome (DHT22.OK for a good
+    checksum, or IMPLAUSIBLE when a decoded value is out of the sensor's
+    range). humidity and temperature are the median of the recent valid
+    readings, raw_humidity and raw_temperature what this reading decoded to.
+    """
+
+    def __init__(self, status, raw_humidity, raw_temperature, latency, recorded_at):
+        self.status = status
+        self.raw_humidity = raw_humidity
+        self.raw_temperature = raw_temperature
+        self.humidity = None
+        self.temperature = None
+        self.latency = latency
+        self.recorded_at = recorded_at
+
+    @property
+    def valid(self):
+        return self.status == DHT22.OK
+
+    def describe(self):
+        return DHT22Sampler.STATUS_NAMES[self.status]
+
+    def temperatureF(self):
+        return ((self.temperature * 9) / 5) + 32
+
+def median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+
+    if len(ordered) % 2:
+        return ordered[middle]
+
+    return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+class DHT22Sampler:
+    """
+    Triggers the DHT22 from its own thread and waits for the driver's
+    callback to report the decoded reading, instead of sleeping on the
+    caller's thread and reading whatever value was left over.
+
+    Every `interval` seconds a reading is taken. A failed reading (bad
+    checksum, short or missing message, timeout or implausible values) is
+    retried up to `retries` times, never sooner than `spacing` seconds
+    (at least MIN_SPACING) after the previous trigger as the sensor hangs if
+    polled faster. Valid readings are median filtered over the last `window`
+    of them to reject single glitches. Every reading, valid or not, goes to
+    `callback` and to the `readings` queue if one is given.
+    """
+
+    MIN_SPACING = 2.0
+
+    # Outcomes beyond the driver's own
+    TIMEOUT = 'timeout'
+    IMPLAUSIBLE = 'implausible'
+
+    STATUS_NAMES = {
+        DHT22.OK : 'ok',
+        DHT22.BAD_CHECKSUM : 'bad_checksum',
+        DHT22.SHORT_MESSAGE : 'short_message',
+        DHT22.MISSING_MESSAGE : 'missing_message',
+        TIMEOUT : 'timeout',
+        IMPLAUSIBLE : 'implausible'
+    }
+
+    def __init__(self, sensor, config, callback = None, readings = None):
+        self.sensor = sensor
+        self.spacing = max(config.get('spacing', 2.5), self.MIN_SPACING)
+        self.interval = max(config.get('interval', 5), self.spacing)
+        self.retries = config.get('retries', 1)
+        self.timeout = config.get('timeout', 0.5)
+        self.window = collections.deque(maxlen = max(config.get('window', 3), 1))
+        self.callback = callback
+        self.readings = readings
+
+        self.latest = None
+        self.last_trigger = 0
+
+        self.counts = collections.defaultdict(int)
+        self.latency = LatencyWindow()
+        self.histogram = Histogram()
+
+        self.done = threading.Event()
+        self.result = None
+
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def stats(self):
+        total = sum(self.counts.values())
+        failed = total - self.counts[DHT22.OK]
+
+        return {
+            'readings' : total,
+            'errors' : dict((self.STATUS_NAMES[k], v) for (k, v) in self.counts.items() if k != DHT22.OK),
+            'error_rate' : (float(failed) / total) if total else 0.0,
+            'staleness' : self.staleness(),
+            'latency_ms' : self.latency.snapshot(),
+            'bad_checksum' : self.sensor.bad_checksum(),
+            'short_message' : self.sensor.short_message(),
+            'missing_message' : self.sensor.missing_message(),
+            'sensor_resets' : self.sensor.sensor_resets()
+        }
+
+    def staleness(self):
+        """Seconds since the last valid reading, or None if there hasn't been one"""
+        if self.latest is None:
+            return None
+
+        return (datetime.datetime.now() - self.latest.recorded_at).total_seconds()
+
+    def completed(self, status, humidity, temperature):
+        # Called on the pigpio callback thread
+        self.result = (status, humidity, temperature)
+        self.done.set()
+
+    def read(self):
+        """Trigger the sensor once and wait for the outcome, returns a Reading"""
+        wait = self.last_trigger + self.spacing - time.time()
+
+        if wait > 0:
+            self.stopping.wait(wait)
+
+        self.done.clear()
+        self.result = None
+
+        started = time.time()
+        self.last_trigger = started
+        self.sensor.trigger()
+
+        if self.done.wait(self.timeout):
+            (status, humidity, temperature) = self.result
+        else:
+            (status, humidity, temperature) = (self.TIMEOUT, None, None)
+
+        latency = time.time() - started
+
+        if status == DHT22.OK and not (0 <= humidity <= 100 and -40 <= temperature <= 80):
+            status = self.IMPLAUSIBLE
+        elif status != DHT22.OK:
+            # The driver still holds the last good values
+            (humidity, temperature) = (None, None)
+
+        self.counts[status] += 1
+
+        if status == DHT22.OK:
+            self.latency.add(latency)
+            self.histogram.observe(latency)
+
+        return Reading(status, humidity, temperature, latency, datetime.datetime.now())
+
+    def sample(self):
+        for attempt in range(self.retries + 1):
+            reading = self.read()
+
+            if reading.valid:
+                self.window.append((reading.raw_humidity, reading.raw_temperature))
+
+                reading.humidity = median([h for (h, t) in self.window])
+                reading.temperature = median([t for (h, t) in self.window])
+
+                self.latest = reading
+
+            self.publish(reading)
+
+            if reading.valid or self.stopping.is_set():
+                break
+
+            logging.debug("DHT22 reading failed (%s), attempt %d", self.STATUS_NAMES[reading.status], attempt + 1)
+
+    def publish(self, reading):
+        if self.callback is not None:
+            self.callback(reading)
+
+        if self.readings is not None:
+            self.readings.put(reading)
+
+    def loop(self):
+        while not self.stopping.is_set():
+            started = time.time()
+
+            try:
+                self.sample()
+            except Exception:
+                logging.exception("DHT22 sampling failed")
+
+            self.stopping.wait(max(self.interval - (time.time() - started), 0))
+
+    def start(self):
+        self.sensor.reading = self.completed
+
+        self.thread = threading.Thread(target = self.loop, name = 'sampler-dht22')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+
+        if self.thread is not None:
+            self.thread.join(5)
+
+        self.sensor.reading = None
@@ -0,0 +1,238 @@
+import threading
+import logging
+import datetime
+import heapq
+import time
+
+import cronex
+
+from Metrics import Histogram
+
+def epoch(timestamp):
+    return time.mktime(timestamp.timetuple()) + timestamp.microsecond / 1e6
+
+class Schedule:
+    """A compiled cron schedule for a single outlet"""
+
+    def __init__(self, outlet_id, expression):
+        self.outlet_id = outlet_id
+        self.expression = expression
+
+        # Scheduling hints: https://github.com/ericpruitt/cronex
+        self.job = cronex.CronExpression(expression.encode('ascii', 'ignore'))
+
+    def nextFire(self, after, horizon):
+        """
+        Return the start (epoch seconds) of the first minute at or after
+        `after` matching the expression, or None if nothing matches within
+        `horizon` minutes.
+        """
+        minute = int(after // 60) * 60
+
+        for i in range(horizon):
+            if self.job.check_trigger(time.localtime(minute)[:5]):
+                return minute
+
+            minute += 60
+
+        return None
+
+class OutletScheduler:
+    """
+    Fires outlet schedules from a heap of precomputed trigger times instead of
+    scanning the outlets table on every frame.
+
+    Schedules are compiled once when the outlets are loaded. The thread sleeps
+    until the earliest schedule is due, and in between only polls the
+    OutletCache to find out whether another connection (the web UI) has
+    changed the outlets, in which case everything is recompiled.
+
+    Outlets are read and switched through an OutletController. Every outlet
+    switched is reported to `callback` as callback(outlet_id, level), e.g.
+    so the motion detector can ignore the lamps coming on.
+    """
+
+    def __init__(self, outlets, controller, config = None, callback = None, clock = time.time):
+        self.outlets = outlets
+        self.controller = controller
+        self.callback = callback
+        self.clock = clock
+
+        self.schedules = {}
+        self.heap = []
+
+        self.fired = 0
+        self.reloads = 0
+        self.latency = Histogram()
+
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.thread = None
+
+        self.configure(config)
+
+    def configure(self, config):
+        """Apply the schedule config section, also used on a reload"""
+        config = config or {}
+
+        self.horizon = config.get('horizon_minutes', 1440)
+        self.poll_interval = config.get('poll_interval', 5)
+        self.next_poll = 0
+        self.wakeup.set()
+
+    def reload(self, now = None):
+        """Recompile every active schedule and rebuild the trigger heap"""
+        if now is None:
+            now = self.clock()
+
+        outlets = self.outlets.all()
+
+        if not outlets:
+            logging.warning("No outlets defined in database. Please define outlets!")
+
+        self.schedules = {}
+        self.heap = []
+        self.reloads += 1
+
+        for outlet in outlets:
+            if not outlet.schedule_active:
+                logging.debug("Ignoring outlet %d becuse schedule is disabled", outlet.outlet_id)
+                continue
+
+            try:
+                schedule = Schedule(outlet.outlet_id, outlet.schedule)
+            except Exception:
+                logging.exception("Invalid schedule '%s' for outlet %d", outlet.schedule, outlet.outlet_id)
+                continue
+
+            self.schedules[outlet.outlet_id] = schedule
+            self.push(schedule, now)
+
+    def push(self, schedule, after):
+        due = schedule.nextFire(after, self.horizon)
+
+        if due is None:
+            # Nothing within the horizon, look again once we get there
+            heapq.heappush(self.heap, (after + self.horizon * 60, schedule.outlet_id, False))
+        else:
+            heapq.heappush(self.heap, (due, schedule.outlet_id, True))
+
+    def runPending(self, now = None):
+        """
+        Fire every schedule that has come due and pick up outlet changes.
+        Returns the time at which this should next be called.
+        """
+        if now is None:
+            now = self.clock()
+
+        if now >= self.next_poll:
+            self.next_poll = now + self.poll_interval
+
+            if self.outlets.refresh():
+                logging.info("Outlets changed, reloading schedules")
+                self.reload(now)
+
+        while self.heap and self.heap[0][0] <= now:
+            (due, outlet_id, trigger) = heapq.heappop(self.heap)
+            schedule = self.schedules[outlet_id]
+
+            if not trigger:
+                self.push(schedule, due)
+                continue
+
+            retry = self.fire(schedule, now)
+
+            if retry is not None and retry < due + 60:
+                # Still inside the triggering minute when it's allowed to fire,
+                # the per-frame check would have caught it then too
+                heapq.heappush(self.heap, (retry, outlet_id, True))
+            else:
+                self.push(schedule, due + 60)
+
+        if self.heap:
+            return min(self.heap[0][0], self.next_poll)
+
+        return self.next_poll
+
+    def fire(self, schedule, now):
+        """
+        Toggle the outlet for a triggered schedule, honouring motion overrides
+        and the 60 second last_ran debounce. If either holds the outlet back,
+        returns the epoch time at which it would be allowed to fire.
+        """
+        outlet_id = schedule.outlet_id
+        current = datetime.datetime.fromtimestamp(now)
+
+        logging.debug("Cron job for outlet %d triggered", outlet_id)
+
+        outlet = self.outlets.get(outlet_id)
+
+        if outlet is None:
+            return None
+
+        (override_until, last_ran) = (outlet.override_until, outlet.last_ran)
+
+        if override_until is not None and override_until > current:
+            logging.debug("Override for outlet %d enabled", outlet_id)
+            return epoch(override_until)
+
+        if last_ran is None:
+            logging.debug("Last ran not provided for outlet %d", outlet_id)
+            secondsSinceExecution = 61
+        else:
+            secondsSinceExecution = (current - last_ran).total_seconds()
+            logging.debug("Outlet %d was last ran %s", outlet_id, secondsSinceExecution)
+
+        if secondsSinceExecution <= 60:
+            return epoch(last_ran) + 60.001
+
+        logging.debug("Updating outlet %d last run time to %s", outlet_id, current)
+
+        self.fired += 1
+
+        if self.controller.level(outlet_id):
+            logging.info("Outlet %i between switched to OFF per schedule %s", outlet_id, schedule.expression)
+            level = 0
+        else:
+            logging.info("Outlet %i between switched to ON per schedule %s", outlet_id, schedule.expression)
+            level = 1
+
+        self.outlets.update([outlet_id], last_ran = current, state = level)
+        self.controller.set([outlet_id], level)
+
+        if self.callback is not None:
+            self.callback(outlet_id, level)
+
+        return None
+
+    def loop(self):
+        self.outlets.reload()
+        self.reload()
+
+        while not self.stopping:
+            started = time.time()
+
+            # Cleared before looking at what's due, so a set() from here on
+            # (a reload, an override) cuts the wait short rather than being lost
+            self.wakeup.clear()
+
+            try:
+                wake = self.runPending()
+                self.latency.observe(time.time() - started)
+            except Exception:
+                logging.exception("Outlet scheduler failed")
+                wake = self.clock() + self.poll_interval
+
+            self.wakeup.wait(max(wake - self.clock(), 0))
+
+    def start(self):
+        self.thread = threading.Thread(target = self.loop, name = 'scheduler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopping = True
+        self.wakeup.set()
+
+        if self.thread is not None:
+            self.thread.join(5)
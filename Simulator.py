@@ -0,0 +1,256 @@
+"""
+Stand-ins for the birdhouse hardware so the daemon can run on any Linux box.
+
+pi mirrors the parts of pigpio.pi the daemon uses, including the edge
+callbacks: triggering the DHT22 gpio replays the edge timings of a real
+DHT22 reading into whatever callback is registered on it (normally
+DHT22.sensor._cb), from a separate thread just like pigpio's. ThermSensor
+stands in for a W1ThermSensor DS18B20 probe.
+
+The module level constants and tickDiff match pigpio's, so DHT22 can fall
+back on this module when pigpio isn't installed.
+"""
+
+import threading
+import random
+import time
+
+LOW = 0
+HIGH = 1
+TIMEOUT = 2
+
+INPUT = 0
+OUTPUT = 1
+
+PUD_OFF = 0
+PUD_DOWN = 1
+PUD_UP = 2
+
+RISING_EDGE = 0
+FALLING_EDGE = 1
+EITHER_EDGE = 2
+
+def tickDiff(t1, t2):
+    """Microseconds from tick t1 to t2, allowing for the 32 bit wrap"""
+    tDiff = t2 - t1
+
+    if tDiff < 0:
+        tDiff += (1 << 32)
+
+    return tDiff
+
+def tick():
+    return int(time.time() * 1000000) & 0xFFFFFFFF
+
+def dht22Edges(humidity, temperature, start, corrupt = False):
+    """
+    The (level, tick) edges of a DHT22 answering a trigger at tick `start`:
+    the 80us low/high response, then 40 bits each sent as 50us low followed
+    by 26us (0) or 70us (1) high. A corrupt reading gets a flipped data bit
+    so its checksum fails.
+    """
+    rh = int(round(humidity * 10)) & 0xFFFF
+    t = int(round(abs(temperature) * 10)) & 0x7FFF
+
+    if temperature < 0:
+        t |= 0x8000
+
+    data = [rh >> 8, rh & 0xFF, t >> 8, t & 0xFF]
+    data.append(sum(data) & 0xFF)
+
+    if corrupt:
+        data[1] ^= 0x01
+
+    edges = []
+    now = start + 30
+
+    edges.append((HIGH, now))   # Host released the line
+    now += 20
+    edges.append((LOW, now))    # Sensor response low
+    now += 80
+    edges.append((HIGH, now))
+    now += 80
+    edges.append((LOW, now))    # Response high ends, first bit starts
+
+    for byte in data:
+        for shift in range(7, -1, -1):
+            now += 50
+            edges.append((HIGH, now))
+            now += 70 if (byte >> shift) & 1 else 26
+            edges.append((LOW, now))
+
+    now += 50
+    edges.append((HIGH, now))   # Sensor releases the line
+
+    return [(level, t & 0xFFFFFFFF) for (level, t) in edges]
+
+class Callback:
+    def __init__(self, pi, gpio, edge, func):
+        self.pi = pi
+        self.gpio = gpio
+        self.edge = edge
+        self.func = func
+
+    def cancel(self):
+        self.pi.cancelCallback(self)
+
+class pi:
+    """
+    A simulated pigpio.pi. Outlet gpios simply remember their level.
+
+    The simulator config section describes the DHT22 being simulated:
+    humidity, temperature, noise (standard deviation added to each reading),
+    error_rate (fraction of readings with a bad checksum), missing_rate
+    (fraction of triggers that get no answer), glitch_rate (fraction of
+    readings that pass the checksum but are wildly off) and latency (seconds
+    before the edges are delivered).
+    """
+
+    def __init__(self, config):
+        simulator = config.get('simulator', {}).get('dht22', {})
+
+        self.connected = True
+        self.levels = {}
+        self.modes = {}
+        self.callbacks = []
+        self.watchdogs = {}
+        self.lock = threading.Lock()
+
+        self.dht22_gpio = config['dht22']['gpio']
+        self.humidity = simulator.get('humidity', 50.0)
+        self.temperature = simulator.get('temperature', 20.0)
+        self.noise = simulator.get('noise', 0.0)
+        self.error_rate = simulator.get('error_rate', 0.0)
+        self.missing_rate = simulator.get('missing_rate', 0.0)
+        self.glitch_rate = simulator.get('glitch_rate', 0.0)
+        self.latency = simulator.get('latency', 0.005)
+        self.random = random.Random(simulator.get('seed', 0))
+
+        self.calls = 0
+        self.readings = 0
+
+    def read(self, gpio):
+        self.calls += 1
+        return self.levels.get(gpio, 0)
+
+    def write(self, gpio, level):
+        self.calls += 1
+        self.levels[gpio] = 1 if level else 0
+        self.modes[gpio] = OUTPUT
+
+    def read_bank_1(self):
+        self.calls += 1
+        return sum(1 << gpio for (gpio, level) in self.levels.items() if level and gpio < 32)
+
+    def set_bank_1(self, bits):
+        self.calls += 1
+
+        for gpio in range(32):
+            if bits & (1 << gpio):
+                self.levels[gpio] = 1
+
+    def clear_bank_1(self, bits):
+        self.calls += 1
+
+        for gpio in range(32):
+            if bits & (1 << gpio):
+                self.levels[gpio] = 0
+
+    def set_pull_up_down(self, gpio, pud):
+        self.calls += 1
+
+    def set_watchdog(self, gpio, timeout):
+        self.calls += 1
+        self.watchdogs[gpio] = timeout
+
+    def set_mode(self, gpio, mode):
+        self.calls += 1
+        self.modes[gpio] = mode
+
+        if gpio == self.dht22_gpio and mode == INPUT and self.levels.get(gpio, 1) == LOW:
+            # The DHT22 driver pulls the line low then releases it to trigger
+            self.levels[gpio] = HIGH
+            self.triggerDHT22()
+
+    def callback(self, gpio, edge = RISING_EDGE, func = None):
+        cb = Callback(self, gpio, edge, func)
+
+        with self.lock:
+            self.callbacks.append(cb)
+
+        return cb
+
+    def cancelCallback(self, cb):
+        with self.lock:
+            if cb in self.callbacks:
+                self.callbacks.remove(cb)
+
+    def deliver(self, gpio, edges):
+        with self.lock:
+            callbacks = [cb for cb in self.callbacks if cb.gpio == gpio]
+
+        for (level, t) in edges:
+            for cb in callbacks:
+                if level == TIMEOUT or cb.edge == EITHER_EDGE or cb.edge == (FALLING_EDGE if level == LOW else RISING_EDGE):
+                    cb.func(gpio, level, t)
+
+    def triggerDHT22(self):
+        self.readings += 1
+        start = tick()
+
+        if self.random.random() < self.missing_rate:
+            # Only the line being released, then pigpio's watchdog times out.
+            # The driver arms the watchdog just after releasing the line.
+            timeout = (self.watchdogs.get(self.dht22_gpio) or 200) / 1000.0
+            edges = [(HIGH, (start + 30) & 0xFFFFFFFF), (TIMEOUT, (start + int(timeout * 1000000)) & 0xFFFFFFFF)]
+            delay = timeout
+        else:
+            humidity = min(max(self.random.gauss(self.humidity, self.noise), 0), 100)
+            temperature = self.random.gauss(self.temperature, self.noise)
+
+            if self.random.random() < self.glitch_rate:
+                temperature += self.random.choice((-1, 1)) * self.random.uniform(20, 40)
+
+            edges = dht22Edges(humidity, temperature, start, self.random.random() < self.error_rate)
+            delay = self.latency
+
+        timer = threading.Timer(delay, self.deliver, (self.dht22_gpio, edges))
+        timer.daemon = True
+        timer.start()
+
+    def stop(self):
+        self.connected = False
+
+class ThermSensor:
+    """
+    A simulated DS18B20. get_temperature() blocks for the configured latency
+    (a 12 bit conversion takes about 750ms) like the real 1-wire read.
+    """
+
+    DEGREES_C = 0x01
+    DEGREES_F = 0x02
+    KELVIN = 0x03
+
+    def __init__(self, config, sensor_id = None):
+        simulator = config.get('simulator', {}).get('ds18b20', {})
+
+        self.id = sensor_id
+        self.temperature = simulator.get('temperature', 15.0)
+        self.noise = simulator.get('noise', 0.0)
+        self.latency = simulator.get('latency', 0.75)
+        self.random = random.Random(simulator.get('seed', 0))
+
+        self.reads = 0
+
+    def get_temperature(self, unit = DEGREES_C):
+        time.sleep(self.latency)
+
+        self.reads += 1
+        celsius = self.random.gauss(self.temperature, self.noise)
+
+        if unit == self.DEGREES_F:
+            return celsius * 9.0 / 5.0 + 32.0
+        elif unit == self.KELVIN:
+            return celsius + 273.15
+
+        return celsius
@@ -0,0 +1,181 @@
+"""
+Several birdhouses run from one daemon process.
+
+Each entry of the sites list in birdhouse.json is laid over the rest of the
+config, so it only needs whatever differs for that nest box, typically its
+name, camera, sensor gpios and motion parameters:
+
+    "sites" : [
+        { "name" : "oak", "camera" : { "source" : "picamera" } },
+        { "name" : "pine", "camera" : { "source" : "video", "video_file" : "rtsp://pine.local/cam" },
+          "dht22" : { "gpio" : 17 }, "ds18b20" : { "id" : "000005e2fdc3" } }
+    ]
+
+Without a sites list the config describes a single site, as it always has.
+Every site keeps its own frame source, sensors, outlets, database, archive,
+clips directory and stream port (see Config.sites). What they share is the
+pool of pipeline.workers analysis threads (by default one per site, up to
+the number of cores), a single telemetry writer thread, the metrics
+endpoint, where every series is labelled with its site, and the dashboard's
+query service (see Query).
+A site with pipeline.processes hands its motion detection on to worker
+processes of its own (see MotionProcesses).
+Sites are built in parallel, each opening its own hardware and database
+(see Startup).
+"""
+
+from BirdHouse import BirdHouse
+from Pipeline import Pipeline
+from Telemetry import WriterGroup
+from Metrics import Registry, MetricsServer
+from Query import QueryServer
+
+import multiprocessing
+import logging
+import signal
+import Config
+import LogPipeline
+import Startup
+
+class Sites:
+
+    def __init__(self, config, path = None, startup = None):
+        self.config = config
+        self.path = path
+        self.startup = startup or Startup.Phases()
+        sites = Config.sites(config)
+
+        # Before the sites log anything from threads of their own
+        LogPipeline.configure(config)
+
+        with self.startup.phase('sites'):
+            self.sites = Startup.parallel([lambda name = name, site = site: BirdHouse(site, name) for (name, site) in sites])
+
+        logging.info("Built %d site(s): %s", len(self.sites), self.startup.describe())
+
+        pipeline = config.get('pipeline', {})
+
+        self.workers = pipeline.get('workers') or min(len(self.sites), multiprocessing.cpu_count())
+
+        if (len(self.sites) > 1 or self.workers > 1) and any(site.settings.show_video for site in self.sites):
+            raise ValueError('show_video needs a single site analysed by a single worker')
+
+        self.writer = WriterGroup([site.telemetry for site in self.sites])
+
+        self.metrics = Registry()
+        self.metricsServer = MetricsServer(self.metrics, config) if config.get('metrics', {}).get('enabled') else None
+
+        # The dashboard's read-only view of every site's readings
+        self.queryServer = QueryServer(sites, config) if config.get('query', {}).get('enabled') else None
+
+        # Extra (interval, callable) housekeeping tasks, e.g. a heartbeat
+        self.tasks = []
+
+        self.pipeline = None
+        self.stopped = False
+
+    def requestReload(self):
+        """
+        Load and check the config file again (on SIGHUP) and hand each site
+        its part of it. Sites can't be added or removed without a restart.
+        """
+        if self.path is None:
+            logging.warning("Not reloading, the config wasn't loaded from a file")
+            return
+
+        try:
+            sites = dict(Config.sites(Config.load(self.path)))
+
+            for site in sites.values():
+                Config.compileSettings(site)
+        except Exception:
+            logging.exception("Not reloading, %s is invalid", self.path)
+            return
+
+        logging.info("Reloading configuration from %s", self.path)
+
+        if sorted(sites) != sorted(site.name for site in self.sites):
+            logging.warning("Restart the daemon to add or remove sites")
+
+        for site in self.sites:
+            if site.name in sites:
+                site.requestReload(sites[site.name])
+
+    def stop(self):
+        """Stop running (on SIGTERM), run() returns once the buffered telemetry is written"""
+        self.stopped = True
+
+        if self.pipeline is not None:
+            self.pipeline.stop()
+
+    def collectMetrics(self):
+        stats = self.pipeline.stats()
+
+        return [
+            ('birdhouse_sites', 'gauge', "Sites run by this daemon", {}, len(self.sites)),
+            ('birdhouse_analysis_workers', 'gauge', "Threads analysing frames for all sites", {}, self.pipeline.workers),
+            ('birdhouse_housekeeping_overruns_total', 'counter', "Housekeeping tasks that took longer than their interval", {}, stats['tasks']['dropped'])
+        ] + self.startup.samples()
+
+    def logStats(self):
+        # Gathering the stats costs more than the records, skip it unless they're wanted
+        if not logging.getLogger().isEnabledFor(logging.DEBUG):
+            return
+
+        logging.debug("Housekeeping stats: %s", self.pipeline.stats()['tasks'])
+
+        for site in self.sites:
+            site.logStats()
+
+    def run(self):
+        logging.info("Running %d site(s) on %d analysis worker(s)", len(self.sites), self.workers)
+
+        # Before any thread is started, see MotionProcesses
+        for site in self.sites:
+            site.startProcesses()
+
+        pipeline = self.config.get('pipeline', {})
+
+        # Background models are snapshotted by the analysis workers and written out here
+        persist = [(site.motion.persist_interval, site.motion.save) for site in self.sites if site.motion.persist]
+        reconcile = [(site.controller.reconcile_interval, site.controller.reconcile) for site in self.sites]
+
+        self.pipeline = Pipeline([site.feed for site in self.sites], [
+            (pipeline.get('stats_interval', 60), self.logStats)
+        ] + persist + reconcile + self.tasks, workers = self.workers)
+
+        # Stop cleanly on SIGTERM (Daemon.stop) so buffered telemetry is written
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.requestReload())
+
+        for site in self.sites:
+            site.registerMetrics(self.metrics)
+
+        self.metrics.collector(self.collectMetrics)
+        self.metrics.collector(LogPipeline.collectMetrics)
+
+        if self.queryServer is not None:
+            self.metrics.collector(self.queryServer.collectMetrics)
+            self.queryServer.start()
+
+        if self.metricsServer is not None:
+            self.metricsServer.start()
+
+        self.writer.start()
+
+        for site in self.sites:
+            site.start()
+
+        try:
+            self.pipeline.run()
+        finally:
+            if self.metricsServer is not None:
+                self.metricsServer.stop()
+
+            if self.queryServer is not None:
+                self.queryServer.stop()
+
+            for site in self.sites:
+                site.stop()
+
+            self.writer.stop()
@@ -0,0 +1,95 @@
+"""
+Getting the daemon from its start to analysing frames quickly.
+
+Most of starting is waiting rather than working: the DHT22 is given 2s to
+come up after being powered, the camera module takes a while to open and
+the schema migration waits on the SD card. parallel() runs such
+independent pieces on threads of their own, so starting takes as long as
+the slowest of them rather than all of them together.
+
+Phases times each piece. A site's phases (hardware, database, then
+first_frame and detecting counted from when the daemon starts running) are
+logged once it is detecting motion and exported as
+birdhouse_startup_seconds, so slow starts and restarts can be told apart by
+what held them up.
+"""
+
+import collections
+import contextlib
+import threading
+import time
+import sys
+
+def parallel(calls):
+    """Run the callables on threads of their own, returns their results in order or raises the first failure"""
+    if len(calls) < 2:
+        return [call() for call in calls]
+
+    results = [None] * len(calls)
+    failures = [None] * len(calls)
+
+    def run(i, call):
+        try:
+            results[i] = call()
+        except Exception:
+            failures[i] = sys.exc_info()
+
+    threads = [threading.Thread(target = run, args = (i, call), name = 'startup') for (i, call) in enumerate(calls)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    for failure in failures:
+        if failure is not None:
+            raise failure[0], failure[1], failure[2]
+
+    return results
+
+class Phases:
+    """Seconds taken by each phase of starting, in the order they finished"""
+
+    def __init__(self):
+        self.durations = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.started = None
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.durations[name] = seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.time()
+
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - started)
+
+    def timed(self, name, call, *args):
+        """call(*args), timed as the phase `name`"""
+        with self.phase(name):
+            return call(*args)
+
+    def start(self, now = None):
+        """Where mark()ed phases are counted from"""
+        self.started = now or time.time()
+
+    def mark(self, name, now = None):
+        """Record the time since start() as the phase `name`, once"""
+        if self.started is not None and name not in self.durations:
+            self.record(name, (now or time.time()) - self.started)
+
+    def items(self):
+        with self.lock:
+            return self.durations.items()
+
+    def describe(self):
+        return ', '.join('%s %.2fs' % (name, seconds) for (name, seconds) in self.items())
+
+    def samples(self, **labels):
+        return [('birdhouse_startup_seconds', 'gauge', "Time taken by each phase of starting", dict(labels, phase = name), seconds)
+                for (name, seconds) in self.items()]
@@ -0,0 +1,256 @@
+"""
+Live MJPEG stream of the annotated camera feed over HTTP.
+
+BirdHouse.processFrame hands each annotated frame to a StreamServer with
+publish(), which only swaps a reference. A single encoder thread JPEG
+encodes the newest frame once (and not at all while nobody is watching),
+and every viewer's handler thread sends whichever encoding is newest when
+it is ready for another. A viewer that can't keep up simply skips frames,
+so neither the capture loop nor the other viewers ever wait on it.
+
+    /stream.mjpg   multipart/x-mixed-replace stream for browsers and VLC
+    /snapshot.jpg  the latest frame as a single JPEG
+"""
+
+from Metrics import LatencyWindow
+
+import BaseHTTPServer
+import SocketServer
+import threading
+import logging
+import socket
+import time
+import cv2
+
+BOUNDARY = 'birdhouseframe'
+
+class EncodedFrame:
+    def __init__(self, seq, jpeg, timestamp):
+        self.seq = seq
+        self.jpeg = jpeg
+        self.timestamp = timestamp
+
+class StreamHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.stream = self.server.stream
+
+        if self.path == '/stream.mjpg':
+            self.sendStream()
+        elif self.path == '/snapshot.jpg':
+            self.sendSnapshot()
+        else:
+            self.send_error(404)
+
+    def sendSnapshot(self):
+        # Counts as a viewer until a fresh frame has been encoded for it
+        self.stream.attach()
+
+        try:
+            encoded = self.stream.next(self.stream.seq, 5)
+        finally:
+            self.stream.detach()
+
+        if encoded is None:
+            self.send_error(503, "No frames available")
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(encoded.jpeg)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(encoded.jpeg)
+
+    def sendStream(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=%s' % BOUNDARY)
+        self.send_header('Cache-Control', 'no-cache, private')
+        self.send_header('Pragma', 'no-cache')
+        self.end_headers()
+
+        self.stream.attach()
+        seq = 0
+
+        try:
+            while not self.stream.stopping.is_set():
+                encoded = self.stream.next(seq, 1)
+
+                if encoded is None:
+                    continue
+
+                # Anything published while we were writing the last one is skipped
+                if seq:
+                    self.stream.dropped += encoded.seq - seq - 1
+
+                seq = encoded.seq
+
+                self.wfile.write('--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % (BOUNDARY, len(encoded.jpeg)))
+                self.wfile.write(encoded.jpeg)
+                self.wfile.write('\r\n')
+                self.wfile.flush()
+
+                self.stream.sent += 1
+                self.stream.bytes_sent += len(encoded.jpeg)
+        except (socket.error, IOError):
+            pass
+        finally:
+            self.stream.detach()
+
+    def log_message(self, format, *args):
+        logging.debug("Stream client %s: " + format, self.client_address[0], *args)
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # Viewers going away mid-frame is routine, not worth a traceback
+        logging.debug("Stream client %s disconnected", client_address[0])
+
+class StreamServer:
+    """
+    Serves the stream section of the config: bind, port (0 picks a free
+    one), quality (JPEG quality 0-100) and max_fps (the most frames encoded
+    per second, however many are published).
+    """
+
+    def __init__(self, config):
+        stream = config.get('stream', {})
+
+        self.bind = stream.get('bind', '0.0.0.0')
+        self.port = stream.get('port', 8080)
+        self.quality = stream.get('quality', 80)
+        self.interval = 1.0 / stream['max_fps'] if stream.get('max_fps') else 0
+
+        self.cond = threading.Condition()
+        self.pending = None
+        self.pending_timestamp = None
+        self.latest = None
+        self.seq = 0
+        self.clients = 0
+
+        self.published = 0
+        self.encoded = 0
+        self.sent = 0
+        self.dropped = 0
+        self.bytes_sent = 0
+        self.latency = LatencyWindow()
+
+        self.stopping = threading.Event()
+        self.server = None
+        self.threads = []
+
+    def stats(self):
+        return {
+            'clients' : self.clients,
+            'published' : self.published,
+            'encoded' : self.encoded,
+            'sent' : self.sent,
+            'dropped' : self.dropped,
+            'bytes_sent' : self.bytes_sent,
+            'encode_ms' : self.latency.snapshot()
+        }
+
+    def publish(self, frame, timestamp = None):
+        """
+        Offer a frame for streaming. Only a reference is kept, so the caller
+        must not modify the frame afterwards. Never blocks on the encoder.
+        """
+        with self.cond:
+            self.pending = frame
+            self.pending_timestamp = timestamp
+            self.published += 1
+            self.cond.notify_all()
+
+    def attach(self):
+        with self.cond:
+            self.clients += 1
+            self.cond.notify_all()
+
+    def detach(self):
+        with self.cond:
+            self.clients -= 1
+
+    def next(self, seq, timeout):
+        """Wait up to timeout for an encoding newer than seq, or return None"""
+        deadline = time.time() + timeout
+
+        with self.cond:
+            # Woken by clients attaching and frames published too, not only new encodings
+            while (self.latest is None or self.latest.seq <= seq) and not self.stopping.is_set():
+                remaining = deadline - time.time()
+
+                if remaining <= 0:
+                    return None
+
+                self.cond.wait(remaining)
+
+            if self.latest is None or self.latest.seq <= seq:
+                return None
+
+            return self.latest
+
+    def encode(self):
+        params = [int(cv2.IMWRITE_JPEG_QUALITY), self.quality]
+
+        while not self.stopping.is_set():
+            with self.cond:
+                while (self.pending is None or self.clients == 0) and not self.stopping.is_set():
+                    self.cond.wait(1)
+
+                if self.stopping.is_set():
+                    break
+
+                (frame, timestamp) = (self.pending, self.pending_timestamp)
+                self.pending = None
+
+            if frame is None:
+                continue
+
+            started = time.time()
+            (ok, jpeg) = cv2.imencode('.jpg', frame, params)
+            self.latency.add(time.time() - started)
+
+            if not ok:
+                logging.warning("Failed to encode stream frame")
+                continue
+
+            with self.cond:
+                self.seq += 1
+                self.latest = EncodedFrame(self.seq, jpeg.tostring(), timestamp)
+                self.encoded += 1
+                self.cond.notify_all()
+
+            if self.interval:
+                self.stopping.wait(max(started + self.interval - time.time(), 0))
+
+    def address(self):
+        return self.server.server_address if self.server is not None else None
+
+    def start(self):
+        self.server = ThreadingHTTPServer((self.bind, self.port), StreamHandler)
+        self.server.stream = self
+
+        logging.info("Streaming video on http://%s:%d/stream.mjpg", *self.address())
+
+        self.threads = [
+            threading.Thread(target = self.encode, name = 'stream-encoder'),
+            threading.Thread(target = self.server.serve_forever, name = 'stream-server')
+        ]
+
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def stop(self):
+        self.stopping.set()
+
+        with self.cond:
+            self.cond.notify_all()
+
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+        for t in self.threads:
+            t.join(5)
@@ -0,0 +1,354 @@
+"""
+Keeping the daemon running through crashes and hangs.
+
+With supervisor.enabled the daemon process doesn't run the sites itself.
+It forks a worker that does, and watches it:
+
+    heartbeat_interval - seconds between the worker's heartbeats. Beats are
+                         sent by a housekeeping task, and only while every
+                         feed still capturing keeps capturing and analysing,
+                         so a hung camera or analysis worker stops them.
+    startup_timeout    - seconds a new worker has to send its first beat
+    stall_timeout      - seconds without a beat after which the worker is
+                         taken to have hung
+    grace              - seconds a worker being stopped gets to exit on
+                         SIGTERM before it is killed
+    backoff            - delay before the first restart, doubled for each
+                         restart in a row up to max_backoff, and reset once
+                         a worker has stayed up for stable_after seconds
+
+A worker that exits without having been told to stop, or stops beating, is
+restarted. Everything the daemon imports is loaded by the supervisor before
+forking, so a restart only pays for opening the hardware and databases
+again. The GPIO levels outlive the worker and are restored from the outlets
+table on start, so outlets aren't switched back to their initial state by a
+restart (see BirdHouse.start).
+
+The restart counts and downtime are inherited by each worker and exported
+on its metrics endpoint.
+"""
+
+from Sites import Sites
+from Metrics import LatencyWindow
+
+import collections
+import logging
+import select
+import signal
+import errno
+import fcntl
+import time
+import os
+
+import LogPipeline
+
+class Heartbeat:
+    """
+    The worker's end of the heartbeat pipe, run as a housekeeping task.
+    Beats only while the feeds make progress. `ready` is called with the
+    first beat, and if the supervisor has gone `orphaned` is called, so the
+    worker doesn't run on unsupervised.
+    """
+
+    def __init__(self, fd, feeds, orphaned, ready = None):
+        self.fd = fd
+        self.feeds = feeds
+        self.orphaned = orphaned
+        self.ready = ready
+        self.last = None
+        self.beats = 0
+
+    def progress(self):
+        """(captured, analysed, waiting) of each feed still capturing"""
+        return dict((feed.name, (feed.capture_stats.processed, feed.analysis_stats.processed, len(feed.ring.pending)))
+                    for feed in self.feeds if not feed.ring.closed)
+
+    def alive(self, progress):
+        if self.last is None:
+            return True
+
+        for (name, (captured, analysed, waiting)) in progress.items():
+            (lastCaptured, lastAnalysed, _) = self.last.get(name, (-1, -1, 0))
+
+            if captured == lastCaptured:
+                return False
+
+            if analysed == lastAnalysed and waiting:
+                return False
+
+        return True
+
+    def beat(self):
+        progress = self.progress()
+
+        if not self.alive(progress):
+            logging.warning("Frames stopped moving, holding back the heartbeat")
+            return
+
+        self.last = progress
+
+        try:
+            os.write(self.fd, '.')
+        except OSError as e:
+            if e.errno == errno.EPIPE:
+                logging.error("The supervisor has gone, stopping")
+                self.orphaned()
+            elif e.errno != errno.EAGAIN:
+                raise
+
+            return
+
+        self.beats += 1
+
+        if self.beats == 1 and self.ready is not None:
+            self.ready()
+
+class Supervisor:
+
+    def __init__(self, config, path = None):
+        self.config = config
+        self.path = path
+
+        supervisor = config.get('supervisor', {})
+
+        self.interval = supervisor.get('heartbeat_interval', 2)
+        self.startup_timeout = supervisor.get('startup_timeout', 60)
+        self.stall_timeout = supervisor.get('stall_timeout', 20)
+        self.grace = supervisor.get('grace', 5)
+        self.backoff = supervisor.get('backoff', 1)
+        self.max_backoff = supervisor.get('max_backoff', 60)
+        self.stable_after = supervisor.get('stable_after', 60)
+
+        self.pid = None
+        self.fd = None
+        self.up = False
+        self.stopping = False
+
+        self.restarts = collections.defaultdict(int)
+        self.consecutive = 0
+        self.downtime = 0.0
+        self.last_downtime = None
+        self.down_since = None
+        self.started_at = None
+
+        # Seen from the supervisor: from a worker failing to the next one's first beat
+        self.recovery = LatencyWindow()
+
+        LogPipeline.configure(config)
+
+    def collectMetrics(self):
+        samples = [('birdhouse_worker_restarts_total', 'counter', "Times the supervisor restarted the daemon's worker", {'reason' : reason}, count)
+                   for (reason, count) in sorted(self.restarts.items())]
+
+        samples.extend([
+            ('birdhouse_downtime_seconds_total', 'counter', "Time without a working daemon between a worker failing and its replacement running", {}, self.downtime),
+            ('birdhouse_last_restart_seconds', 'gauge', "How long the most recent restart left the daemon down", {}, self.last_downtime),
+            ('birdhouse_worker_uptime_seconds', 'gauge', "Seconds since this worker was started", {}, time.time() - self.started_at)
+        ])
+
+        return samples
+
+    def ready(self):
+        """In the worker, once it's running: what the restart that started it cost"""
+        if self.down_since is not None:
+            self.last_downtime = time.time() - self.down_since
+            self.downtime += self.last_downtime
+
+    def work(self, fd):
+        """The worker: run the sites, beating on fd, then exit the process"""
+        status = 1
+
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+            # A beat that can't be written straight away is a beat missed
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+            sites = Sites(self.config, self.path)
+            heartbeat = Heartbeat(fd, [site.feed for site in sites.sites], sites.stop, self.ready)
+
+            sites.tasks.append((self.interval, heartbeat.beat))
+            sites.metrics.collector(self.collectMetrics)
+            sites.run()
+
+            if sites.stopped:
+                status = 0
+            else:
+                logging.error("The daemon stopped without being asked to")
+        except Exception:
+            logging.exception("The daemon failed")
+        finally:
+            logging.shutdown()
+
+            # Not sys.exit, the supervisor's atexit handlers (the pidfile)
+            # aren't the worker's to run
+            os._exit(status)
+
+    def spawn(self):
+        (r, w) = os.pipe()
+
+        self.started_at = time.time()
+        pid = os.fork()
+
+        if pid == 0:
+            os.close(r)
+            self.work(w)
+
+        os.close(w)
+
+        self.pid = pid
+        self.fd = r
+
+        logging.info("Started worker %d", pid)
+
+    def reap(self, block = False):
+        """The worker's exit status once it has exited, otherwise None"""
+        while True:
+            try:
+                (pid, status) = os.waitpid(self.pid, 0 if block else os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+
+                if e.errno == errno.ECHILD:
+                    return 0
+
+                raise
+
+            if pid == 0:
+                return None
+
+            return status
+
+    def terminate(self):
+        """Stop the worker, killing it if it doesn't exit within the grace period"""
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+        deadline = time.time() + self.grace
+
+        while time.time() < deadline:
+            status = self.reap()
+
+            if status is not None:
+                return status
+
+            time.sleep(0.05)
+
+        logging.warning("Worker %d didn't stop, killing it", self.pid)
+
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+        return self.reap(block = True)
+
+    def watch(self):
+        """Wait for the worker to exit or hang, returns why it was lost (None if stopped)"""
+        beats = 0
+        last = time.time()
+        deadline = last + self.startup_timeout
+
+        while not self.stopping:
+            try:
+                (ready, _, _) = select.select([self.fd], [], [], max(min(deadline - time.time(), 1), 0))
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+
+                raise
+
+            if ready:
+                data = os.read(self.fd, 4096)
+
+                if data:
+                    if not beats and self.down_since is not None:
+                        self.recovery.add(time.time() - self.down_since)
+                        logging.info("Worker %d is up, %.2fs after the last one failed", self.pid, time.time() - self.down_since)
+                        self.down_since = None
+
+                    self.up = True
+
+                    beats += len(data)
+                    last = time.time()
+                    deadline = last + self.stall_timeout
+                    continue
+
+            status = self.reap()
+
+            if status is not None:
+                self.up = False
+                self.down_since = time.time()
+
+                if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                    return None
+
+                logging.error("Worker %d exited (%s)", self.pid, describe(status))
+                return 'crash'
+
+            if ready:
+                # The pipe closed but the process hasn't exited yet
+                time.sleep(0.05)
+                continue
+
+            if time.time() >= deadline:
+                # Down since it last showed any sign of life
+                self.up = False
+                self.down_since = last
+                logging.error("Worker %d hasn't sent a heartbeat for %ds, restarting it", self.pid, self.stall_timeout if beats else self.startup_timeout)
+                self.terminate()
+                return 'stall'
+
+        self.terminate()
+        return None
+
+    def stop(self):
+        self.stopping = True
+
+    def forward(self, signum):
+        if self.pid is not None:
+            try:
+                os.kill(self.pid, signum)
+            except OSError:
+                pass
+
+    def run(self):
+        logging.info("Supervising the birdhouse daemon")
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.forward(signal.SIGHUP))
+
+        while not self.stopping:
+            self.spawn()
+
+            reason = self.watch()
+            uptime = time.time() - self.started_at
+
+            os.close(self.fd)
+
+            if reason is None:
+                break
+
+            self.restarts[reason] += 1
+            self.consecutive = 1 if uptime >= self.stable_after else self.consecutive + 1
+
+            delay = min(self.backoff * 2 ** (self.consecutive - 1), self.max_backoff)
+
+            logging.warning("Restarting the worker in %.1fs (restart %d in a row)", delay, self.consecutive)
+
+            deadline = time.time() + delay
+
+            while not self.stopping and time.time() < deadline:
+                time.sleep(min(deadline - time.time(), 0.1))
+
+        logging.info("Supervisor stopped")
+
+def describe(status):
+    if os.WIFSIGNALED(status):
+        return "killed by signal %d" % os.WTERMSIG(status)
+
+    return "exit status %d" % os.WEXITSTATUS(status)
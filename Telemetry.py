@@ -0,0 +1,270 @@
+import threading
+import logging
+import datetime
+import sqlite3
+import time
+
+import Rollups
+import Archive
+
+from Metrics import Histogram
+
+TABLES = {
+    'weather' : "INSERT OR IGNORE INTO weather VALUES(?, ?, ?)",
+    'water_temp' : "INSERT OR IGNORE INTO water_temp VALUES(?, ?)"
+}
+
+def rollback(c):
+    """
+    Roll back the transaction a failed statement left open. A failed COMMIT
+    (SQLITE_BUSY) leaves it open, other failures may already have ended it.
+    """
+    try:
+        c.execute("ROLLBACK")
+    except sqlite3.OperationalError:
+        # No transaction is active
+        pass
+
+class TelemetryWriter:
+    """
+    Buffers sensor readings in memory and writes them to SQLite in a single
+    transaction, either every flush_interval seconds or as soon as batch_size
+    readings are waiting, whichever comes first.
+
+    Expired rows are pruned by a separate job every prune_interval seconds
+    rather than on every insert; the recorded_at indexes keep that a range
+    delete instead of a full table scan. With the archive enabled they are
+    moved into the Archive first rather than lost.
+
+    The minute, hour and day rollups are updated in the same transaction as
+    the raw rows they summarise.
+
+    A batch that can't be written (the web UI holding a lock) is kept for
+    the next flush, up to max_pending readings per table. Past that the
+    oldest are dropped, so a database that stays locked can't run the
+    daemon out of memory.
+    """
+
+    def __init__(self, sqlite, lock, config):
+        telemetry = config.get('telemetry', {})
+
+        self.sqlite = sqlite
+        self.lock = lock
+        self.flush_interval = telemetry.get('flush_interval', 60)
+        self.batch_size = telemetry.get('batch_size', 50)
+        self.prune_interval = telemetry.get('prune_interval', 3600)
+        self.max_pending = telemetry.get('max_pending', 10000)
+
+        self.retention = {
+            'weather' : config['dht22']['history_days'],
+            'water_temp' : config['ds18b20']['history_days']
+        }
+
+        self.archive = Archive.create(config)
+
+        self.pending = dict((table, []) for table in TABLES)
+        self.buffered = 0
+        self.bufferLock = threading.Lock()
+
+        self.flushes = 0
+        self.written = 0
+        self.pruned = 0
+        self.archived = 0
+        self.dropped = 0
+        self.flush_latency = Histogram()
+        self.commit_latency = Histogram()
+
+        self.next_flush = time.time() + self.flush_interval
+        self.next_prune = time.time()
+
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.thread = None
+
+    def record(self, table, row):
+        """Queue a row (recorded_at first) for the given table"""
+        with self.bufferLock:
+            self.pending[table].append(row)
+            self.buffered += 1
+
+            if self.buffered >= self.batch_size:
+                self.wakeup.set()
+
+    def flush(self):
+        with self.bufferLock:
+            if not self.buffered:
+                return 0
+
+            (batch, self.pending) = (self.pending, dict((table, []) for table in TABLES))
+            count = self.buffered
+            self.buffered = 0
+
+        started = time.time()
+
+        try:
+            with self.lock:
+                c = self.sqlite.cursor()
+                c.execute("BEGIN")
+
+                try:
+                    for (table, rows) in batch.items():
+                        if rows:
+                            c.executemany(TABLES[table], rows)
+                            Rollups.update(c, table, rows)
+
+                    committing = time.time()
+                    c.execute("COMMIT")
+                    self.commit_latency.observe(time.time() - committing)
+                except Exception:
+                    rollback(c)
+                    raise
+        except Exception:
+            # Keep the readings for the next attempt (e.g. the web UI held a lock)
+            self.requeue(batch)
+            raise
+
+        elapsed = time.time() - started
+
+        self.flushes += 1
+        self.written += count
+        self.flush_latency.observe(elapsed)
+
+        logging.debug("Flushed %d readings in %.1fms", count, elapsed * 1000)
+
+        return count
+
+    def requeue(self, batch):
+        """Put a batch that failed back in front of what has arrived since, within max_pending"""
+        dropped = 0
+
+        with self.bufferLock:
+            for (table, rows) in batch.items():
+                pending = self.pending[table]
+                pending[0:0] = rows
+
+                if len(pending) > self.max_pending:
+                    dropped += len(pending) - self.max_pending
+                    del pending[:len(pending) - self.max_pending]
+
+            self.buffered = sum(len(rows) for rows in self.pending.values())
+            self.dropped += dropped
+
+        if dropped:
+            logging.warning("Dropped the %d oldest readings, more than %d per table are waiting on the database", dropped, self.max_pending)
+
+    def prune(self):
+        now = datetime.datetime.now()
+        deleted = 0
+
+        if self.archive is not None:
+            for (table, days) in self.retention.items():
+                self.archived += self.archive.expire(self.sqlite, self.lock, table, now - datetime.timedelta(days = days))
+
+        with self.lock:
+            c = self.sqlite.cursor()
+            c.execute("BEGIN")
+
+            try:
+                for (table, days) in self.retention.items():
+                    previousHistoryCut = now - datetime.timedelta(days = days)
+
+                    logging.debug("Deleting historic %s data older than %s", table, previousHistoryCut)
+
+                    c.execute("DELETE FROM %s WHERE recorded_at <= :history_cutoff" % table, { 'history_cutoff' : previousHistoryCut })
+                    deleted += c.rowcount
+
+                    Rollups.prune(c, table, previousHistoryCut)
+
+                c.execute("COMMIT")
+            except Exception:
+                rollback(c)
+                raise
+
+        self.pruned += deleted
+
+        return deleted
+
+    def service(self, now, stopping = False):
+        """Flush and prune if either is due, returns when one next will be"""
+        try:
+            if self.buffered >= self.batch_size or now >= self.next_flush or stopping:
+                self.next_flush = now + self.flush_interval
+                self.flush()
+
+            if now >= self.next_prune and not stopping:
+                self.next_prune = now + self.prune_interval
+                self.prune()
+        except Exception:
+            logging.exception("Failed to write telemetry")
+
+        return min(self.next_flush, self.next_prune)
+
+    def loop(self):
+        due = time.time()
+
+        while not self.stopping:
+            self.wakeup.wait(max(due - time.time(), 0))
+            self.wakeup.clear()
+
+            due = self.service(time.time(), self.stopping)
+
+    def start(self):
+        self.thread = threading.Thread(target = self.loop, name = 'telemetry')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the writer thread and write out anything still buffered"""
+        self.stopping = True
+        self.wakeup.set()
+
+        if self.thread is not None:
+            self.thread.join(5)
+
+        self.flush()
+
+class WriterGroup:
+    """
+    Runs the flushes and prunes of several TelemetryWriters, one for each
+    site's database, from a single thread. Each database still gets its
+    readings in batches, one transaction per flush, however many sites
+    there are.
+    """
+
+    def __init__(self, writers):
+        self.writers = writers
+
+        # A writer filling its batch wakes the shared thread
+        self.wakeup = threading.Event()
+
+        for writer in writers:
+            writer.wakeup = self.wakeup
+
+        self.stopping = False
+        self.thread = None
+
+    def loop(self):
+        due = time.time()
+
+        while not self.stopping:
+            self.wakeup.wait(max(due - time.time(), 0))
+            self.wakeup.clear()
+
+            now = time.time()
+            due = min([writer.service(now, self.stopping) for writer in self.writers] or [now + 60])
+
+    def start(self):
+        self.thread = threading.Thread(target = self.loop, name = 'telemetry')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the writer thread and write out anything still buffered"""
+        self.stopping = True
+        self.wakeup.set()
+
+        if self.thread is not None:
+            self.thread.join(5)
+
+        for writer in self.writers:
+            writer.flush()
@@ -5,4 +5,6 @@ namespace App\Models;
 class Outlet extends \Eloquent
 {
     protected $table = "outlets";
-}
\ No newline at end of file
+    
+    protected $primaryKey = "outlet_id";
+}
@@ -11,24 +11,94 @@
 ### END INIT INFO
 
 from Daemon import Daemon
-from BirdHouse import BirdHouse
-import json, sys, time, os
+import json, sys, time, os, sqlite3, datetime, csv
+import Migrations, Rollups, Config, Startup
+
+# Process start, for the startup phases
+STARTED = time.time()
+
+def backfill():
+    """Rebuild the weather and water_temp rollups from the raw readings"""
+    path = Config.locate()
+    
+    if path is None:
+        print "Could not locate birdhouse configuration file"
+        sys.exit(1)
+    
+    for (name, config) in Config.sites(Config.load(path)):
+        db = sqlite3.connect(config['sqlite_db'], detect_types = sqlite3.PARSE_DECLTYPES, isolation_level = None)
+        Migrations.migrate(db, config)
+        
+        for (table, written) in sorted(Rollups.backfill(db).items()):
+            print "Rebuilt %d %s rollup buckets for %s" % (written, table, name)
+
+def parseTime(value):
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d', '%Y-%m'):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    
+    print "Invalid time: %s" % value
+    sys.exit(2)
+
+def export(table, start = None, end = None):
+    """
+    Write the table's readings from start up to end, live and archived, to
+    stdout as CSV, one site after another
+    """
+    if table not in Rollups.METRICS:
+        print "Unknown table %s, expected one of %s" % (table, ', '.join(sorted(Rollups.METRICS)))
+        sys.exit(2)
+    
+    path = Config.locate()
+    
+    if path is None:
+        print "Could not locate birdhouse configuration file"
+        sys.exit(1)
+    
+    import Archive
+    
+    start = parseTime(start) if start else None
+    end = parseTime(end) if end else None
+    
+    writer = csv.writer(sys.stdout)
+    writer.writerow(['site', 'recorded_at'] + list(Rollups.METRICS[table]))
+    
+    for (name, config) in Config.sites(Config.load(path)):
+        db = sqlite3.connect(config['sqlite_db'], detect_types = sqlite3.PARSE_DECLTYPES, isolation_level = None)
+        archive = Archive.Archive(Archive.directory(config))
+        
+        for row in Archive.query(db, table, start, end, archive):
+            writer.writerow([name, row[0].isoformat(' ')] + ['' if v is None else '%.6g' % v for v in row[1:]])
+        
+        db.close()
 
 class BirdhouseDaemon(Daemon):
     def run(self):
         print "Starting Birdhouse Daemon"
         
-        for cloc in os.curdir, os.path.expanduser('~'), '/etc/birdhouse/', os.environ.get('BIRDHOUSE_CONF'):
-            if cloc is not None:
-                try:
-                    with open(os.path.join(cloc, "birdhouse.json")) as source:
-                        config = json.load(source)
-                        birdhouse = BirdHouse(config)
-                        birdhouse.run()
-                except IOError:
-                    pass
-            
-        print "Could not locate birdhouse configuration file"
+        path = Config.locate()
+        
+        if path is None:
+            print "Could not locate birdhouse configuration file"
+            sys.exit(1)
+        
+        config = Config.load(path)
+        
+        # Only the commands that run the daemon need OpenCV, numpy and the
+        # camera, stop, reload and the rest start without them
+        startup = Startup.Phases()
+        startup.record('launch', time.time() - STARTED)
+        
+        with startup.phase('imports'):
+            from Sites import Sites
+            from Supervisor import Supervisor
+        
+        if config.get('supervisor', {}).get('enabled', False):
+            Supervisor(config, path).run()
+        else:
+            Sites(config, path, startup).run()
 
 if __name__ == "__main__":
         
@@ -36,6 +106,10 @@ if __name__ == "__main__":
         
         daemon = BirdhouseDaemon('/var/run/birdhouse.pid')
         
+        if len(sys.argv) in (3, 4, 5) and 'export' == sys.argv[1]:
+                export(*sys.argv[2:])
+                sys.exit(0)
+        
         if len(sys.argv) == 2:
                 if 'start' == sys.argv[1]:
                     daemon.start()
@@ -43,12 +117,16 @@ if __name__ == "__main__":
                     daemon.stop()
                 elif 'restart' == sys.argv[1]:
                     daemon.restart()
-		elif 'run' == sys.argv[1]:
-		    daemon.run()
+                elif 'reload' == sys.argv[1]:
+                    daemon.reload()
+                elif 'run' == sys.argv[1]:
+                    daemon.run()
+                elif 'backfill' == sys.argv[1]:
+                    backfill()
                 else:
                         print "Unknown command"
                         sys.exit(2)
                 sys.exit(0)
         else:
-                print "usage: %s start|stop|restart" % sys.argv[0]
+                print "usage: %s start|stop|restart|reload|run|backfill|export TABLE [START [END]]" % sys.argv[0]
                 sys.exit(2)
@@ -0,0 +1,5 @@
+"""
+Unit tests, run from the top of the tree with:
+
+    python -m unittest discover
+"""
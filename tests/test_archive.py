@@ -0,0 +1,69 @@
+import unittest
+import threading
+import datetime
+import tempfile
+import sqlite3
+import shutil
+import os
+
+import Archive
+import Config
+import Migrations
+
+START = datetime.datetime(2024, 6, 1, 0, 0, 0)
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.lock = threading.RLock()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def config(self, *sites):
+        return {
+            'sqlite_db' : os.path.join(self.directory, 'birdhouse.db'),
+            'archive' : { 'enabled' : True, 'directory' : os.path.join(self.directory, 'birdhouse-archive') },
+            'sites' : list(sites)
+        }
+
+    def database(self, site, hours):
+        sqlite = sqlite3.connect(site['sqlite_db'], detect_types = sqlite3.PARSE_DECLTYPES, isolation_level = None)
+        Migrations.migrate(sqlite)
+
+        for hour in hours:
+            sqlite.execute("INSERT INTO weather (recorded_at, humidity, temperature) VALUES(?, ?, ?)", (START + datetime.timedelta(hours = hour), 50.0, float(hour)))
+
+        return sqlite
+
+    def testTwoSites(self):
+        sites = dict(Config.sites(self.config({ 'name' : 'oak' }, { 'name' : 'pine' })))
+
+        self.assertNotEqual(Archive.directory(sites['oak']), Archive.directory(sites['pine']))
+
+        oak = self.database(sites['oak'], range(48))
+        pine = self.database(sites['pine'], range(0, 48, 2))
+
+        # oak archives further than pine first, pine's older rows must still be kept
+        Archive.create(sites['oak']).expire(oak, self.lock, 'weather', START + datetime.timedelta(hours = 40))
+        Archive.create(sites['pine']).expire(pine, self.lock, 'weather', START + datetime.timedelta(hours = 20))
+
+        self.assertEqual([row[2] for row in Archive.query(oak, 'weather', archive = Archive.create(sites['oak']))], [float(hour) for hour in range(48)])
+        self.assertEqual([row[2] for row in Archive.query(pine, 'weather', archive = Archive.create(sites['pine']))], [float(hour) for hour in range(0, 48, 2)])
+        self.assertEqual(pine.execute("SELECT COUNT(*) FROM weather").fetchone()[0], 13)
+
+        oak.close()
+        pine.close()
+
+    def testSharedDirectoryRejected(self):
+        shared = { 'enabled' : True, 'directory' : os.path.join(self.directory, 'shared') }
+
+        self.assertRaises(ValueError, Config.sites, self.config({ 'name' : 'oak', 'archive' : shared }, { 'name' : 'pine', 'archive' : shared }))
+
+        # Both named after their own database
+        sites = dict(Config.sites(dict(self.config({ 'name' : 'oak' }, { 'name' : 'pine' }), archive = { 'enabled' : True })))
+        self.assertEqual(Archive.directory(sites['oak']), os.path.join(self.directory, 'birdhouse-oak-archive'))
+
+if __name__ == '__main__':
+    unittest.main()
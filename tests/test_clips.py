@@ -0,0 +1,64 @@
+import unittest
+import threading
+import datetime
+import tempfile
+import sqlite3
+import shutil
+import os
+
+import Migrations
+from Clips import Clip, ClipRecorder
+
+START = datetime.datetime(2024, 6, 1, 12, 0, 0)
+
+class ClipRecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.sqlite = sqlite3.connect(':memory:', detect_types = sqlite3.PARSE_DECLTYPES, isolation_level = None)
+        Migrations.migrate(self.sqlite)
+
+        self.recorder = ClipRecorder(self.sqlite, threading.RLock(), { 'clips' : { 'directory' : self.directory, 'max_mb' : 1 } })
+
+    def tearDown(self):
+        self.sqlite.close()
+        shutil.rmtree(self.directory)
+
+    def record(self, minutes, size):
+        clip = Clip(minutes, None, START + datetime.timedelta(minutes = minutes))
+        clip.path = self.recorder.clipPath(clip.started_at, '.avi')
+        clip.ended_at = clip.started_at + datetime.timedelta(seconds = 30)
+
+        with open(clip.path, 'wb') as f:
+            f.write('\0' * size)
+
+        self.recorder.store(clip)
+
+        return clip.path
+
+    def kept(self):
+        return [path for (path,) in self.sqlite.execute("SELECT path FROM clips ORDER BY started_at")]
+
+    def testOversizedClipKept(self):
+        path = self.record(0, 2 * 1024 * 1024)
+
+        self.assertEqual(self.kept(), [path])
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(self.recorder.stats()['evicted'], 0)
+
+    def testOldestEvicted(self):
+        paths = [self.record(minutes, 400 * 1024) for minutes in range(4)]
+
+        self.assertEqual(self.kept(), paths[2:])
+        self.assertFalse(os.path.exists(paths[0]))
+        self.assertFalse(os.path.exists(paths[1]))
+        self.assertEqual(self.recorder.stats()['evicted'], 2)
+
+        # However big the newest is, it stays
+        path = self.record(10, 3 * 1024 * 1024)
+
+        self.assertEqual(self.kept(), [path])
+        self.assertEqual(self.recorder.stats()['evicted'], 4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+
+import Config
+
+BASE = {
+    'sqlite_db' : 'birdhouse.db',
+    'stream' : { 'enabled' : True, 'port' : 8080 },
+    'clips' : { 'enabled' : True, 'directory' : 'clips' }
+}
+
+class SitesTest(unittest.TestCase):
+
+    def sites(self, *overrides):
+        return dict(Config.sites(dict(BASE, sites = list(overrides))))
+
+    def testSingleSiteUnchanged(self):
+        self.assertEqual(Config.sites(BASE), [('birdhouse', BASE)])
+
+    def testOwnDefaults(self):
+        sites = self.sites({ 'name' : 'oak' }, { 'name' : 'pine' })
+
+        self.assertEqual([sites[name]['sqlite_db'] for name in ('oak', 'pine')], ['birdhouse-oak.db', 'birdhouse-pine.db'])
+        self.assertEqual([sites[name]['clips']['directory'] for name in ('oak', 'pine')], ['clips-oak', 'clips-pine'])
+        self.assertEqual([sites[name]['stream']['port'] for name in ('oak', 'pine')], [8080, 8081])
+
+    def testOverridesKept(self):
+        sites = self.sites({ 'name' : 'oak', 'stream' : { 'port' : 9000 }, 'clips' : { 'directory' : '/mnt/oak' } }, { 'name' : 'pine' })
+
+        self.assertEqual(sites['oak']['stream']['port'], 9000)
+        self.assertEqual(sites['oak']['clips']['directory'], '/mnt/oak')
+        self.assertEqual(sites['pine']['stream']['port'], 8081)
+
+    def testFreePortsNotShifted(self):
+        sites = Config.sites(dict(BASE, stream = { 'enabled' : True, 'port' : 0 }, sites = [{ 'name' : 'oak' }, { 'name' : 'pine' }]))
+
+        self.assertEqual([site['stream']['port'] for (name, site) in sites], [0, 0])
+
+    def testDuplicatesRejected(self):
+        self.assertRaises(ValueError, self.sites, { 'name' : 'oak' }, { 'name' : 'oak' })
+        self.assertRaises(ValueError, self.sites, { 'name' : 'oak', 'stream' : { 'port' : 8081 } }, { 'name' : 'pine' })
+        self.assertRaises(ValueError, self.sites, { 'name' : 'oak', 'clips' : { 'directory' : 'clips' } }, { 'name' : 'pine', 'clips' : { 'directory' : 'clips' } })
+
+        # Not a clash while clips are off
+        self.sites({ 'name' : 'oak', 'clips' : { 'enabled' : False, 'directory' : 'clips' } }, { 'name' : 'pine', 'clips' : { 'directory' : 'clips' } })
+
+if __name__ == '__main__':
+    unittest.main()
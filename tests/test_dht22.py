@@ -0,0 +1,148 @@
+import unittest
+import time
+
+import Simulator
+import DHT22
+from Sampler import DHT22Sampler
+
+GPIO = 4
+
+def good(humidity, temperature):
+    return lambda start: Simulator.dht22Edges(humidity, temperature, start)
+
+def badChecksum(start):
+    return Simulator.dht22Edges(50.0, 20.0, start, corrupt = True)
+
+def short(start):
+    # The response and 20 of the 40 bits, then the watchdog fires
+    edges = Simulator.dht22Edges(50.0, 20.0, start)[:4 + 2 * 20]
+    return edges + [(Simulator.TIMEOUT, start + 200000)]
+
+def missing(start):
+    # Only the host releasing the line
+    return [(Simulator.HIGH, start + 30), (Simulator.TIMEOUT, start + 200000)]
+
+class ScriptedPi(Simulator.pi):
+    """A simulated pi answering each DHT22 trigger with the next scripted edge train, on the caller's thread"""
+
+    def __init__(self, trains):
+        Simulator.pi.__init__(self, { 'dht22' : { 'gpio' : GPIO } })
+        self.trains = list(trains)
+        self.triggered = []
+        self.start = 0
+
+    def write(self, gpio, level):
+        if gpio == GPIO and level == Simulator.LOW:
+            # The driver pulling the line low starts a trigger
+            self.triggered.append(time.time())
+
+        Simulator.pi.write(self, gpio, level)
+
+    def triggerDHT22(self):
+        # A second apart in sensor ticks, so the driver sees each train as a new message
+        self.start += 1000000
+        self.deliver(GPIO, self.trains.pop(0)(self.start))
+
+class SensorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.readings = []
+
+    def feed(self, *trains):
+        pi = ScriptedPi(trains)
+        sensor = DHT22.sensor(pi, GPIO)
+        sensor.reading = lambda *reading: self.readings.append(reading)
+
+        for _ in trains:
+            sensor.trigger()
+
+        sensor.cancel()
+        return sensor
+
+    def testGoodReading(self):
+        sensor = self.feed(good(55.3, 21.7), good(40.0, -3.2))
+
+        self.assertEqual([status for (status, _, _) in self.readings], [DHT22.OK, DHT22.OK])
+        self.assertAlmostEqual(self.readings[0][1], 55.3)
+        self.assertAlmostEqual(self.readings[0][2], 21.7)
+        self.assertAlmostEqual(self.readings[1][2], -3.2)
+        self.assertEqual(sensor.bad_checksum() + sensor.short_message() + sensor.missing_message(), 0)
+
+    def testBadChecksum(self):
+        sensor = self.feed(badChecksum)
+
+        self.assertEqual([status for (status, _, _) in self.readings], [DHT22.BAD_CHECKSUM])
+        self.assertEqual(sensor.bad_checksum(), 1)
+
+    def testShortMessage(self):
+        sensor = self.feed(short)
+
+        self.assertEqual([status for (status, _, _) in self.readings], [DHT22.SHORT_MESSAGE])
+        self.assertEqual(sensor.short_message(), 1)
+
+    def testMissingMessage(self):
+        sensor = self.feed(missing, missing, missing)
+
+        self.assertEqual([status for (status, _, _) in self.readings], [DHT22.MISSING_MESSAGE] * 3)
+        self.assertEqual(sensor.missing_message(), 3)
+        self.assertEqual(sensor.sensor_resets(), 1)
+
+class SamplerTest(unittest.TestCase):
+
+    def sampler(self, trains, config):
+        self.pi = ScriptedPi(trains)
+        self.readings = []
+
+        sensor = DHT22.sensor(self.pi, GPIO)
+        sampler = DHT22Sampler(sensor, config, callback = self.readings.append)
+        sensor.reading = sampler.completed
+
+        return sampler
+
+    def testRetriesFailedReading(self):
+        sampler = self.sampler([badChecksum, short, good(50.0, 20.0)], { 'retries' : 2 })
+
+        sampler.sample()
+
+        self.assertEqual([reading.status for reading in self.readings], [DHT22.BAD_CHECKSUM, DHT22.SHORT_MESSAGE, DHT22.OK])
+        self.assertAlmostEqual(sampler.latest.temperature, 20.0)
+        self.assertEqual(sampler.stats()['errors'], { 'bad_checksum' : 1, 'short_message' : 1 })
+
+    def testRetryCountLimited(self):
+        sampler = self.sampler([missing, missing, good(50.0, 20.0)], { 'retries' : 1 })
+
+        sampler.sample()
+
+        self.assertEqual([reading.status for reading in self.readings], [DHT22.MISSING_MESSAGE, DHT22.MISSING_MESSAGE])
+        self.assertEqual(len(self.pi.trains), 1)
+        self.assertEqual(sampler.latest, None)
+
+    def testMinimumSpacing(self):
+        sampler = self.sampler([badChecksum, good(50.0, 20.0)], { 'retries' : 1, 'spacing' : 0.1 })
+
+        self.assertEqual(sampler.spacing, DHT22Sampler.MIN_SPACING)
+
+        sampler.sample()
+
+        self.assertEqual(len(self.pi.triggered), 2)
+        # Less the few microseconds between the sampler noting the first trigger and the line going low
+        self.assertGreaterEqual(self.pi.triggered[1] - self.pi.triggered[0], DHT22Sampler.MIN_SPACING - 0.001)
+
+    def testMedianRejectsGlitch(self):
+        sampler = self.sampler([good(50.0, 20.0), good(50.4, 20.2), good(50.2, 61.0), good(50.1, 20.1)], { 'window' : 3 })
+
+        temperatures = []
+
+        for _ in range(4):
+            # Skip the spacing wait, the scripted sensor doesn't hang
+            sampler.last_trigger = 0
+            sampler.sample()
+            temperatures.append(sampler.latest.temperature)
+
+        self.assertEqual([round(reading.raw_temperature, 1) for reading in self.readings], [20.0, 20.2, 61.0, 20.1])
+        self.assertAlmostEqual(temperatures[2], 20.2)
+        self.assertAlmostEqual(temperatures[3], 20.2)
+        self.assertAlmostEqual(sampler.latest.humidity, 50.2)
+
+if __name__ == '__main__':
+    unittest.main()
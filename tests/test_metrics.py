@@ -0,0 +1,39 @@
+import unittest
+import threading
+
+from Metrics import Histogram, Registry
+
+class HistogramTest(unittest.TestCase):
+
+    def testCumulative(self):
+        histogram = Histogram((0.01, 0.1))
+
+        for seconds in (0.005, 0.01, 0.05, 0.5):
+            histogram.observe(seconds)
+
+        self.assertEqual(histogram.cumulative(), [(0.01, 2), (0.1, 3), (float('inf'), 4)])
+        self.assertEqual(histogram.snapshot(), ([2, 1, 1], 0.565, 4))
+
+    def testRenderConsistentWhileObserved(self):
+        registry = Registry()
+        histogram = registry.histogram('latency_seconds', "Latency")
+        stopping = threading.Event()
+
+        def observe():
+            while not stopping.is_set():
+                histogram.observe(0.001)
+
+        observer = threading.Thread(target = observe)
+        observer.start()
+
+        try:
+            for _ in range(200):
+                lines = dict(line.rsplit(' ', 1) for line in registry.render().splitlines() if not line.startswith('#'))
+
+                self.assertEqual(lines['latency_seconds_bucket{le="+Inf"}'], lines['latency_seconds_count'])
+        finally:
+            stopping.set()
+            observer.join()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import unittest
+import datetime
+import tempfile
+import sqlite3
+import shutil
+import os
+
+import Migrations
+
+# The schema BirdHouse created before migrations were versioned
+LEGACY = [
+    '''CREATE TABLE outlets (outlet_id INT, name TEXT, schedule TEXT, override_until timestamp, last_ran timestamp, initial_state INT, schedule_active INT)''',
+    '''CREATE TABLE weather (recorded_at timestamp, humidity REAL, temperature REAL)''',
+    '''CREATE TABLE water_temp(recorded_at timestamp, temperature REAL)'''
+]
+
+START = datetime.datetime(2024, 6, 1, 10, 58, 30)
+
+class MigrationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.sqlite = self.connect()
+
+        for statement in LEGACY:
+            self.sqlite.execute(statement)
+
+        # outlet 1 defined twice, the later row should win; a row without an id is dropped
+        self.sqlite.executemany("INSERT INTO outlets VALUES(?, ?, '* * * * *', NULL, NULL, 0, 1)", [(1, 'old lamp'), (2, 'heater'), (1, 'lamp'), (None, 'stray')])
+
+        # Every 30s for 3 minutes from 10:58:30, across an hour boundary, with one timestamp repeated
+        stamps = [START + datetime.timedelta(seconds = 30 * i) for i in range(6)]
+        self.sqlite.executemany("INSERT INTO weather VALUES(?, ?, ?)", [(t, 40.0 + i, 70.0) for (i, t) in enumerate(stamps)] + [(stamps[0], 40.0, 70.0)])
+        self.sqlite.executemany("INSERT INTO water_temp VALUES(?, 60.0)", [(t,) for t in stamps])
+
+    def tearDown(self):
+        self.sqlite.close()
+        shutil.rmtree(self.directory)
+
+    def connect(self):
+        return sqlite3.connect(os.path.join(self.directory, 'birdhouse.db'), detect_types = sqlite3.PARSE_DECLTYPES, isolation_level = None)
+
+    def schema(self):
+        return sorted(self.sqlite.execute("SELECT type, name, sql FROM sqlite_master").fetchall())
+
+    def testUpgradesLegacyDatabase(self):
+        self.assertEqual(Migrations.version(self.sqlite), 0)
+        self.assertEqual(Migrations.migrate(self.sqlite), len(Migrations.MIGRATIONS))
+        self.assertEqual(Migrations.version(self.sqlite), len(Migrations.MIGRATIONS))
+
+    def testRecordedAtIndexes(self):
+        Migrations.migrate(self.sqlite)
+
+        indexes = dict(self.sqlite.execute("SELECT name, tbl_name FROM sqlite_master WHERE type = 'index'").fetchall())
+
+        self.assertEqual(indexes.get('weather_recorded_at'), 'weather')
+        self.assertEqual(indexes.get('water_temp_recorded_at'), 'water_temp')
+
+        plan = ' '.join(str(row) for row in self.sqlite.execute("EXPLAIN QUERY PLAN SELECT * FROM weather WHERE recorded_at > ?", (START,)))
+        self.assertIn('weather_recorded_at', plan)
+
+    def testOutletPrimaryKeyDeduplicates(self):
+        Migrations.migrate(self.sqlite)
+
+        self.assertEqual(self.sqlite.execute("SELECT outlet_id, name FROM outlets ORDER BY outlet_id").fetchall(), [(1, 'lamp'), (2, 'heater')])
+
+        columns = dict((row[1], row) for row in self.sqlite.execute("PRAGMA table_info(outlets)"))
+        self.assertEqual(columns['outlet_id'][5], 1)
+        self.assertIn('state', columns)
+
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.sqlite.execute("INSERT INTO outlets (outlet_id, name) VALUES(2, 'again')")
+
+    def testRollupsFilledFromExistingReadings(self):
+        Migrations.migrate(self.sqlite)
+
+        rollup = lambda resolution: self.sqlite.execute('''SELECT bucket_start, count, humidity_min, humidity_max, humidity_sum FROM weather_rollup
+                                                           WHERE resolution = ? ORDER BY bucket_start''', (resolution,)).fetchall()
+
+        self.assertEqual(rollup('minute'), [
+            (datetime.datetime(2024, 6, 1, 10, 58), 2, 40.0, 40.0, 80.0),
+            (datetime.datetime(2024, 6, 1, 10, 59), 2, 41.0, 42.0, 83.0),
+            (datetime.datetime(2024, 6, 1, 11, 0), 2, 43.0, 44.0, 87.0),
+            (datetime.datetime(2024, 6, 1, 11, 1), 1, 45.0, 45.0, 45.0)
+        ])
+        self.assertEqual(rollup('hour'), [
+            (datetime.datetime(2024, 6, 1, 10, 0), 4, 40.0, 42.0, 163.0),
+            (datetime.datetime(2024, 6, 1, 11, 0), 3, 43.0, 45.0, 132.0)
+        ])
+        self.assertEqual(rollup('day'), [(datetime.datetime(2024, 6, 1, 0, 0), 7, 40.0, 45.0, 295.0)])
+
+        self.assertEqual(self.sqlite.execute("SELECT sum(count) FROM water_temp_rollup WHERE resolution = 'day'").fetchone()[0], 6)
+
+    def testEventTablesCreated(self):
+        Migrations.migrate(self.sqlite)
+
+        tables = set(row[0] for row in self.sqlite.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+
+        self.assertTrue(set(['motion_events', 'clips', 'weather_rollup', 'water_temp_rollup']) <= tables)
+
+    def testSecondRunDoesNothing(self):
+        Migrations.migrate(self.sqlite)
+
+        schema = self.schema()
+        changes = self.sqlite.total_changes
+
+        self.assertEqual(Migrations.migrate(self.sqlite), len(Migrations.MIGRATIONS))
+        self.assertEqual(self.sqlite.total_changes, changes)
+        self.assertEqual(self.schema(), schema)
+
+    def testWithoutRowidConversion(self):
+        config = { 'storage' : { 'without_rowid' : True } }
+
+        Migrations.migrate(self.sqlite, config)
+
+        for table in Migrations.TIME_SERIES:
+            self.assertTrue(Migrations.isWithoutRowid(self.sqlite, table))
+
+        # The repeated timestamp is collapsed, the rest survive in order
+        rows = self.sqlite.execute("SELECT recorded_at, humidity FROM weather").fetchall()
+        self.assertEqual([humidity for (_, humidity) in rows], [40.0, 41.0, 42.0, 43.0, 44.0, 45.0])
+        self.assertEqual(rows[0][0], START)
+
+        schema = self.schema()
+        changes = self.sqlite.total_changes
+
+        Migrations.migrate(self.sqlite, config)
+
+        self.assertEqual(self.sqlite.total_changes, changes)
+        self.assertEqual(self.schema(), schema)
+
+    def testFailedMigrationRollsBack(self):
+        self.sqlite.execute("CREATE TABLE outlets_new (x INT)")
+
+        with self.assertRaises(sqlite3.OperationalError):
+            Migrations.migrate(self.sqlite)
+
+        # Versions 1 and 2 went through, 3 left no trace
+        self.assertEqual(Migrations.version(self.sqlite), 2)
+        self.assertEqual(self.sqlite.execute("SELECT count(*) FROM outlets").fetchone()[0], 4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import unittest
+
+import Simulator
+from Outlets import OutletController
+
+class RecordingPi(Simulator.pi):
+    """A simulated pi that also records the calls made to it, sent() returns and forgets them"""
+
+    def __init__(self):
+        Simulator.pi.__init__(self, { 'dht22' : { 'gpio' : 4 } })
+        self.log = []
+
+    def read(self, gpio):
+        self.log.append(('read', gpio))
+        return Simulator.pi.read(self, gpio)
+
+    def write(self, gpio, level):
+        self.log.append(('write', gpio, level))
+        Simulator.pi.write(self, gpio, level)
+
+    def read_bank_1(self):
+        self.log.append(('read_bank_1',))
+        return Simulator.pi.read_bank_1(self)
+
+    def set_bank_1(self, bits):
+        self.log.append(('set_bank_1', bits))
+        Simulator.pi.set_bank_1(self, bits)
+
+    def clear_bank_1(self, bits):
+        self.log.append(('clear_bank_1', bits))
+        Simulator.pi.clear_bank_1(self, bits)
+
+    def sent(self):
+        (log, self.log) = (self.log, [])
+        return log
+
+class OutletControllerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pi = RecordingPi()
+        self.controller = OutletController(self.pi)
+
+    def testReadsFromShadow(self):
+        self.pi.levels[17] = 1
+
+        self.assertEqual(self.controller.level(17), 1)
+        self.assertEqual(self.pi.sent(), [('read', 17)])
+
+        self.controller.set([17], 0)
+        self.pi.sent()
+
+        for _ in range(3):
+            self.assertEqual(self.controller.level(17), 0)
+
+        self.assertEqual(self.pi.sent(), [])
+
+    def testFirstUseIsPlainWrite(self):
+        self.assertEqual(self.controller.set([17, 27], 1), [17, 27])
+        self.assertEqual(sorted(self.pi.sent()), [('write', 17, 1), ('write', 27, 1)])
+        self.assertEqual(self.pi.modes[17], Simulator.OUTPUT)
+
+        # Claimed, so now through the bank
+        self.controller.set([17], 0)
+        self.assertEqual(self.pi.sent(), [('clear_bank_1', 1 << 17)])
+
+    def testRestoreClaims(self):
+        self.controller.restore({ 17 : 1, 27 : 0 })
+        self.assertEqual(sorted(self.pi.sent()), [('write', 17, 1), ('write', 27, 0)])
+
+        # Written even though the shadow already has the level
+        self.controller.restore({ 17 : 1 })
+        self.assertEqual(self.pi.sent(), [('write', 17, 1)])
+
+    def testOneBankCallPerBatch(self):
+        self.controller.restore({ 17 : 0, 22 : 0, 27 : 1 })
+        self.pi.sent()
+
+        self.assertEqual(self.controller.set([17, 22, 27], 1), [17, 22])
+        self.assertEqual(self.pi.sent(), [('set_bank_1', (1 << 17) | (1 << 22))])
+
+        self.assertEqual(self.controller.set([17, 22, 27], 0), [17, 22, 27])
+        self.assertEqual(self.pi.sent(), [('clear_bank_1', (1 << 17) | (1 << 22) | (1 << 27))])
+        self.assertEqual((self.pi.levels[17], self.pi.levels[22], self.pi.levels[27]), (0, 0, 0))
+
+        # Already there, nothing is sent
+        self.assertEqual(self.controller.set([17, 22, 27], 0), [])
+        self.assertEqual(self.pi.sent(), [])
+
+    def testMixedBatch(self):
+        self.controller.restore({ 17 : 0 })
+        self.pi.sent()
+
+        # 5 is new and gets a plain write, 40 is beyond bank 1
+        self.controller.set([5, 17, 40], 1)
+
+        self.assertEqual(sorted(self.pi.sent()), [('set_bank_1', 1 << 17), ('write', 5, 1), ('write', 40, 1)])
+
+        self.controller.set([5, 17, 40], 0)
+
+        self.assertEqual(sorted(self.pi.sent()), [('clear_bank_1', (1 << 5) | (1 << 17)), ('write', 40, 0)])
+
+    def testReconcile(self):
+        self.controller.restore({ 17 : 1, 22 : 0, 27 : 1 })
+        self.pi.sent()
+
+        self.assertEqual(self.controller.reconcile(), [])
+        self.assertEqual(self.pi.sent(), [('read_bank_1',)])
+
+        # pigpiod restarted and someone switched 22 by hand
+        self.pi.levels[17] = 0
+        self.pi.levels[27] = 0
+        self.pi.levels[22] = 1
+
+        self.assertEqual(self.controller.reconcile(), [17, 22, 27])
+        self.assertEqual(self.pi.sent(), [('read_bank_1',), ('write', 17, 1), ('write', 22, 0), ('write', 27, 1)])
+        self.assertEqual((self.pi.levels[17], self.pi.levels[22], self.pi.levels[27]), (1, 0, 1))
+
+        self.assertEqual(self.controller.reconcile(), [])
+        self.assertEqual(self.controller.stats()['drifted'], 3)
+        self.assertEqual(self.controller.stats()['reconciles'], 3)
+
+    def testAvoidedCounters(self):
+        self.controller.restore({ 17 : 1, 27 : 0 })     # 2 writes requested, 2 made
+        self.controller.set([17, 27], 0)                # 2 requested, 1 clear_bank_1
+        self.controller.set([17, 27], 0)                # 2 requested, none made
+        self.controller.level(17)                       # 3 reads requested, none made
+        self.controller.level(27)
+        self.controller.level(17)
+        self.controller.reconcile()                     # Not something a caller asked for
+
+        stats = self.controller.stats()
+
+        self.assertEqual(stats['requested'], { 'write' : 6, 'read' : 3 })
+        self.assertEqual(stats['calls'], { 'write' : 2, 'clear_bank_1' : 1, 'read_bank_1' : 1 })
+        self.assertEqual(stats['avoided'], 6)
+        self.assertEqual(stats['switched'], 1)
+
+        # The calls sent match what the pi saw
+        self.assertEqual(len([call for call in self.pi.sent() if call[0] != 'read_bank_1']), 3)
+
+        metrics = dict((name, value) for (name, kind, help, labels, value) in self.controller.collectMetrics(site = 'nest') if 'call' not in labels)
+        self.assertEqual(metrics['birdhouse_gpio_calls_avoided_total'], 6)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+
+import numpy
+
+from Pipeline import FrameRing, StageStats
+
+class FrameRingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.allocated = []
+
+    def allocate(self, frame, slot = None):
+        self.allocated.append(frame.shape)
+        return numpy.empty_like(frame)
+
+    def ring(self, size):
+        return FrameRing(size, StageStats('capture'), self.allocate)
+
+    def testHoldsSizeFrames(self):
+        ring = self.ring(4)
+
+        for i in range(7):
+            ring.put(numpy.full((2, 2), i, dtype = numpy.uint8), i)
+
+        self.assertEqual(len(self.allocated), 4)
+        self.assertEqual(ring.stats.dropped, 3)
+        self.assertEqual([ring.get(0)[1] for _ in range(4)], [3, 4, 5, 6])
+
+        # The frame being analysed is one of the four
+        ring.put(numpy.zeros((2, 2), dtype = numpy.uint8), 7)
+        self.assertEqual(len(self.allocated), 4)
+
+    def testSizeOne(self):
+        ring = self.ring(1)
+
+        ring.put(numpy.zeros((2, 2), dtype = numpy.uint8), 0)
+        ring.get(0)
+
+        # One slot being analysed and one filling
+        ring.put(numpy.zeros((2, 2), dtype = numpy.uint8), 1)
+        ring.put(numpy.zeros((2, 2), dtype = numpy.uint8), 2)
+
+        self.assertEqual(len(self.allocated), 2)
+        self.assertEqual(ring.stats.dropped, 1)
+        self.assertEqual(ring.get(0)[1], 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,249 @@
+import unittest
+import threading
+import datetime
+import tempfile
+import sqlite3
+import urllib2
+import shutil
+import json
+import math
+import time
+import os
+
+import numpy
+
+import Migrations
+import Query
+from Telemetry import TelemetryWriter
+
+START = datetime.datetime(2024, 6, 1, 0, 0, 0)
+DAYS = 3
+
+# A reading a minute, with one spike
+SPIKE = 2000
+
+def humidity(i):
+    return 95.0 if i == SPIKE else 50.0 + 10 * math.sin(i / 60.0)
+
+def at(minutes):
+    return (START + datetime.timedelta(minutes = minutes)).strftime('%Y-%m-%d %H:%M:%S')
+
+class LTTBTest(unittest.TestCase):
+
+    def setUp(self):
+        self.x = numpy.arange(1000, dtype = float)
+        self.y = numpy.random.RandomState(0).normal(0, 1, 1000)
+        self.y[400] = 50.0
+
+    def testEndpointsKept(self):
+        kept = Query.lttb(self.x, self.y, 50)
+
+        self.assertEqual(kept[0], 0)
+        self.assertEqual(kept[-1], 999)
+
+    def testPointCount(self):
+        for points in (3, 10, 50, 999):
+            self.assertEqual(len(Query.lttb(self.x, self.y, points)), points)
+
+        self.assertEqual(list(Query.lttb(self.x, self.y, 1000)), range(1000))
+        self.assertEqual(list(Query.lttb(self.x, self.y, 2000)), range(1000))
+
+    def testOrderPreserved(self):
+        kept = Query.lttb(self.x, self.y, 50)
+
+        self.assertTrue((numpy.diff(kept) > 0).all())
+
+    def testPeakKept(self):
+        self.assertIn(400, Query.lttb(self.x, self.y, 50))
+
+class QueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'birdhouse.db')
+        self.sqlite = sqlite3.connect(self.path, detect_types = sqlite3.PARSE_DECLTYPES, isolation_level = None, check_same_thread = False)
+        Migrations.migrate(self.sqlite)
+
+        telemetry = TelemetryWriter(self.sqlite, threading.RLock(), { 'dht22' : { 'history_days' : 60 }, 'ds18b20' : { 'history_days' : 60 } })
+
+        for i in range(DAYS * 1440):
+            recorded_at = START + datetime.timedelta(minutes = i)
+            telemetry.record('weather', (recorded_at, humidity(i), 20.0))
+            telemetry.record('water_temp', (recorded_at, 15.0))
+
+        telemetry.flush()
+
+        self.database = Query.Database(self.path)
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.stop()
+
+        self.sqlite.close()
+        shutil.rmtree(self.directory)
+
+    def series(self, method, start, end, points, max_input = 100000):
+        series = Query.Series('weather', { 'method' : method, 'start' : start, 'end' : end, 'points' : str(points) }, max_input = max_input)
+
+        with self.database.connection() as sqlite:
+            rows = list(series.rows(sqlite))
+
+        return (series, rows)
+
+    def testAveragesFromRollups(self):
+        # 500 points over 3 days are ~9 minutes apart, 50 points ~1.4 hours apart
+        (series, rows) = self.series('avg', at(0), at(DAYS * 1440), 500)
+        self.assertEqual(series.source, 'minute')
+        self.assertEqual(len(rows), 500)
+
+        (series, rows) = self.series('avg', at(0), at(DAYS * 1440), 50)
+        self.assertEqual(series.source, 'hour')
+        self.assertEqual(len(rows), 50)
+
+        # 500 points over an hour are closer than a minute
+        (series, rows) = self.series('avg', at(0), at(60), 500)
+        self.assertEqual(series.source, 'raw')
+        self.assertEqual(len(rows), 60)
+
+    def testAveragesMatchRawRows(self):
+        (series, rows) = self.series('avg', at(0), at(DAYS * 1440), DAYS * 24)
+
+        self.assertEqual(series.source, 'hour')
+
+        for (hour, row) in enumerate(rows[:5]):
+            self.assertEqual(row[0], START + datetime.timedelta(hours = hour))
+            self.assertAlmostEqual(row[1], sum(humidity(i) for i in range(hour * 60, hour * 60 + 60)) / 60)
+            self.assertAlmostEqual(row[2], 20.0)
+
+    def testPrunedMinutesFallBackToRaw(self):
+        self.sqlite.execute("DELETE FROM weather_rollup WHERE resolution = 'minute' AND bucket_start < ?", (START + datetime.timedelta(days = 1),))
+
+        (series, rows) = self.series('avg', at(0), at(DAYS * 1440), 500)
+        self.assertEqual(series.source, 'raw')
+
+        # Starting after the pruned minutes they are used again
+        (series, rows) = self.series('avg', at(1440), at(DAYS * 1440), 500)
+        self.assertEqual(series.source, 'minute')
+
+    def testMinutesCoverWithoutHours(self):
+        self.sqlite.execute("DELETE FROM weather_rollup WHERE resolution = 'hour'")
+
+        with self.database.connection() as sqlite:
+            self.assertTrue(Query.Series('weather', { 'start' : at(0), 'end' : at(60) }).minutesCover(sqlite))
+            self.assertFalse(Query.Series('weather', { 'start' : at(-60), 'end' : at(60) }).minutesCover(sqlite))
+
+    def testLargestTriangles(self):
+        (series, rows) = self.series('lttb', at(0), at(DAYS * 1440), 100)
+
+        self.assertEqual(series.source, 'raw')
+        self.assertEqual(len(rows), 100)
+        self.assertEqual(rows[0][0], START)
+        self.assertEqual(rows[-1][0], START + datetime.timedelta(minutes = DAYS * 1440 - 1))
+        self.assertEqual([row[0] for row in rows], sorted(row[0] for row in rows))
+        self.assertIn((START + datetime.timedelta(minutes = SPIKE), 95.0, 20.0), rows)
+
+        # Too many raw rows, the finest rollup small enough is used instead
+        (series, rows) = self.series('lttb', at(0), at(DAYS * 1440), 50, max_input = 1000)
+
+        self.assertEqual(series.source, 'hour')
+        self.assertEqual(len(rows), 50)
+
+    def serve(self, **query):
+        self.server = Query.QueryServer([('nest', { 'sqlite_db' : self.path }), ('garden', { 'sqlite_db' : self.path })], { 'query' : dict(query, port = 0) })
+        self.server.start()
+
+    def fetch(self, url, etag = None):
+        """Returns (status, headers, body)"""
+        request = urllib2.Request('http://%s:%d%s' % (self.server.server.server_address + (url,)), headers = { 'If-None-Match' : etag } if etag else {})
+
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError as e:
+            return (e.code, e.info(), e.read())
+
+        return (response.getcode(), response.info(), response.read())
+
+    def results(self, requests):
+        """How the server answered, once it has counted `requests` of them (it does so after replying)"""
+        deadline = time.time() + 5
+
+        while sum(self.server.results.values()) < requests and time.time() < deadline:
+            time.sleep(0.01)
+
+        return dict(self.server.results)
+
+    def testETag(self):
+        self.serve()
+
+        url = '/weather?start=2024-06-01&end=2024-06-02&points=24'
+
+        (status, headers, body) = self.fetch(url)
+        etag = headers.get('ETag')
+
+        self.assertEqual(status, 200)
+        self.assertIsNotNone(etag)
+        self.assertEqual(len(json.loads(body)['rows']), 24)
+
+        (status, headers, body) = self.fetch(url, etag)
+        self.assertEqual(status, 304)
+        self.assertEqual(headers.get('ETag'), etag)
+
+        (status, headers, body) = self.fetch(url, '"stale"')
+        self.assertEqual(status, 200)
+
+        self.assertEqual(self.results(3), { 'miss' : 1, 'hit' : 1, 'not_modified' : 1 })
+
+    def testUnsettledRangeNotCached(self):
+        self.serve()
+
+        (status, headers, body) = self.fetch('/weather?points=10')
+
+        self.assertEqual(status, 200)
+        self.assertIsNone(headers.get('ETag'))
+        self.assertEqual(headers.get('Cache-Control'), 'no-cache')
+        self.assertEqual(self.results(1), { 'streamed' : 1 })
+
+    def testLargeRangeStreamed(self):
+        # Room for an hour of raw rows, not a day
+        self.serve(cache_mb = 0.01)
+
+        (status, headers, body) = self.fetch('/weather?start=2024-06-01&end=2024-06-02&method=raw')
+
+        self.assertEqual(status, 200)
+        self.assertIsNone(headers.get('ETag'))
+        self.assertEqual(len(json.loads(body)['rows']), 1440)
+        self.assertLess(len(body), Query.Series('weather', { 'start' : at(0), 'end' : at(1440), 'method' : 'raw' }).estimatedBytes(self.sqlite))
+
+        (status, headers, body) = self.fetch('/weather?start=2024-06-01%2000:00&end=2024-06-01%2001:00&method=raw')
+
+        self.assertEqual(status, 200)
+        self.assertIsNotNone(headers.get('ETag'))
+        self.assertEqual(self.results(2), { 'streamed' : 1, 'miss' : 1 })
+        self.assertEqual(self.server.stats()['cached'], 1)
+
+    def testWhitelist(self):
+        self.serve()
+
+        (status, headers, body) = self.fetch('/weather?start=2024-06-01&end=2024-06-02&metrics=temperature&site=garden&format=csv')
+        self.assertEqual(status, 200)
+        self.assertEqual(body.splitlines()[0], 'recorded_at,temperature')
+
+        for url in ('/weather?metrics=humidity,temperature%3BDROP%20TABLE%20weather', '/weather?metrics=sqlite_master', '/weather?format=xml', '/weather?method=max'):
+            self.assertEqual(self.fetch(url)[0], 400, url)
+
+        for url in ('/sqlite_master', '/weather_rollup', '/weather?site=shed', '/weather/oldest', '/weather/latest/1'):
+            self.assertEqual(self.fetch(url)[0], 404, url)
+
+        self.assertEqual(self.sqlite.execute("SELECT count(*) FROM weather").fetchone()[0], DAYS * 1440)
+
+    def testLatest(self):
+        self.serve()
+
+        (status, headers, body) = self.fetch('/water_temp/latest')
+
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), { 'recorded_at' : at(DAYS * 1440 - 1), 'temperature' : 15.0 })
+
+if __name__ == '__main__':
+    unittest.main()
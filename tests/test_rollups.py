@@ -0,0 +1,73 @@
+import unittest
+import datetime
+import sqlite3
+
+import Migrations
+import Rollups
+
+START = datetime.datetime(2024, 6, 1, 10, 0, 0)
+
+class RollupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sqlite = sqlite3.connect(':memory:', detect_types = sqlite3.PARSE_DECLTYPES, isolation_level = None)
+        Migrations.migrate(self.sqlite)
+
+        # A reading a minute, humidity counting up, for three hours
+        self.stamps = [START + datetime.timedelta(minutes = i) for i in range(180)]
+        self.insert([(t, float(i), 70.0) for (i, t) in enumerate(self.stamps)])
+
+    def insert(self, rows):
+        c = self.sqlite.cursor()
+        c.executemany("INSERT INTO weather VALUES(?, ?, ?)", rows)
+        Rollups.update(c, 'weather', rows)
+
+    def buckets(self, resolution):
+        return self.sqlite.execute('''SELECT bucket_start, count, humidity_min, humidity_max, humidity_sum FROM weather_rollup
+                                      WHERE resolution = ? ORDER BY bucket_start''', (resolution,)).fetchall()
+
+    def testUpdateMatchesRebuild(self):
+        batched = dict((resolution, self.buckets(resolution)) for (resolution, _) in Rollups.RESOLUTIONS)
+
+        self.sqlite.execute("DELETE FROM weather_rollup")
+        Rollups.backfill(self.sqlite, ['weather'])
+
+        for (resolution, _) in Rollups.RESOLUTIONS:
+            self.assertEqual(self.buckets(resolution), batched[resolution])
+
+        self.assertEqual(self.buckets('hour')[0], (START, 60, 0.0, 59.0, float(sum(range(60)))))
+
+    def testRebuildAfterPruneKeepsPartialBuckets(self):
+        hours = self.buckets('hour')
+        days = self.buckets('day')
+
+        # Pruned half way through the first hour
+        cutoff = START + datetime.timedelta(minutes = 30)
+        c = self.sqlite.cursor()
+        c.execute("DELETE FROM weather WHERE recorded_at < ?", (cutoff,))
+        Rollups.prune(c, 'weather', cutoff)
+
+        Rollups.backfill(self.sqlite, ['weather'])
+
+        self.assertEqual(self.buckets('hour'), hours)
+        self.assertEqual(self.buckets('day'), days)
+        self.assertEqual(len(self.buckets('minute')), 150)
+
+    def testRebuildFillsMissingBuckets(self):
+        self.sqlite.execute("DELETE FROM weather WHERE recorded_at < ?", (START + datetime.timedelta(minutes = 30),))
+        self.sqlite.execute("DELETE FROM weather_rollup")
+
+        Rollups.backfill(self.sqlite, ['weather'])
+
+        self.assertEqual(self.buckets('hour')[0], (START, 30, 30.0, 59.0, float(sum(range(30, 60)))))
+        self.assertEqual(self.buckets('day')[0][1], 150)
+
+    def testRebuildRepairsLaterBuckets(self):
+        self.sqlite.execute("UPDATE weather_rollup SET count = 1 WHERE resolution = 'hour' AND bucket_start > ?", (START,))
+
+        Rollups.backfill(self.sqlite, ['weather'])
+
+        self.assertEqual([count for (_, count, _, _, _) in self.buckets('hour')], [60, 60, 60])
+
+if __name__ == '__main__':
+    unittest.main()
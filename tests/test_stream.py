@@ -0,0 +1,62 @@
+import unittest
+import threading
+import urllib2
+import time
+
+import numpy
+
+from Stream import StreamServer
+
+class StreamServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = StreamServer({ 'stream' : { 'bind' : '127.0.0.1', 'port' : 0 } })
+        self.frame = numpy.zeros((48, 64, 3), dtype = numpy.uint8)
+        self.publishing = threading.Event()
+
+    def tearDown(self):
+        self.publishing.clear()
+        self.stream.stop()
+
+    def publish(self, interval):
+        while self.publishing.is_set():
+            self.stream.publish(self.frame)
+            time.sleep(interval)
+
+    def testNextWaitsThroughOtherWakeups(self):
+        started = time.time()
+        answers = []
+
+        waiter = threading.Thread(target = lambda: answers.append(self.stream.next(0, 0.5)))
+        waiter.start()
+
+        # Neither is a new encoding
+        for _ in range(5):
+            time.sleep(0.02)
+            self.stream.attach()
+            self.stream.publish(self.frame)
+
+        waiter.join()
+
+        self.assertEqual(answers, [None])
+        self.assertGreaterEqual(time.time() - started, 0.5)
+
+    def testSnapshots(self):
+        self.stream.start()
+        self.publishing.set()
+
+        publisher = threading.Thread(target = self.publish, args = (0.05,))
+        publisher.daemon = True
+        publisher.start()
+
+        url = 'http://%s:%d/snapshot.jpg' % self.stream.address()
+
+        for _ in range(10):
+            response = urllib2.urlopen(url)
+
+            self.assertEqual(response.getcode(), 200)
+            self.assertEqual(response.info().get('Content-Type'), 'image/jpeg')
+            self.assertEqual(response.read()[:2], '\xff\xd8')
+
+if __name__ == '__main__':
+    unittest.main()